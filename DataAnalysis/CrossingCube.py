@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue May 20 09:41:12 2025
+
+@author: J. Cabrera-Moreno
+    Postdoctoral Fellow
+    Evolutionary Cognition Group
+    Institute of Evolutionary Anthropology
+    University of Zurich
+
+    Description: Crossing counts per machine, animal, direction and time bin,
+                built once from the movement table (see
+                MovementAnalysis.movement_events) as a dense numpy cube. The
+                crossing frequency and temporal trend plots read the cube, or
+                its daily, weekly, hour of day and weekday rollups, instead of
+                grouping the movements again, and the cube is saved as a .npz
+                file next to the data.
+
+                python3 CrossingCube.py checkpoints Lima Kiwi --output crossings.npz
+"""
+import os
+import argparse
+import numpy as np
+import pandas as pd
+
+from MovementAnalysis import MOVEMENTS
+
+# Directions of the cube, every labelled movement
+DIRECTIONS = tuple(MOVEMENTS[1:])
+# Axes of the counts
+AXES = ('machine', 'animal', 'direction', 'time')
+
+
+class CrossingCube:
+
+    def __init__(self, counts, machines, animals, directions, times, freq):
+        """
+        :param counts: uint32 array of shape (machines, animals, directions, times).
+        :param machines: Names of the machines.
+        :param animals: Names of the animals.
+        :param directions: Movements counted.
+        :param times: pd.DatetimeIndex with the start of every time bin.
+        :param freq: Size of the time bins (e.g. '1h'), or the period of a
+                     rollup ('D', 'W').
+        """
+        self.counts = counts
+        self.machines = np.asarray(machines, dtype=str)
+        self.animals = np.asarray(animals, dtype=str)
+        self.directions = np.asarray(directions, dtype=str)
+        self.times = pd.DatetimeIndex(times)
+        self.freq = freq
+
+    @classmethod
+    def fromMovements(cls, result_df, freq='1h', directions=DIRECTIONS, machine=''):
+        """
+        Count the movements of every machine, animal and direction per time bin.
+        :param result_df: Movements with 'time', 'monkey', 'event' and, for
+                          several machines, 'machineID' (see movement_events).
+        :param freq: Size of the time bins.
+        :param directions: Movements counted, the others are left out.
+        :param machine: Name of the machine when result_df has no 'machineID'.
+        :return: CrossingCube covering every bin from the first to the last movement.
+        """
+        df = result_df[result_df['event'].isin(directions) & result_df['monkey'].notna()]
+        machineCodes, machines = pd.factorize(df['machineID'] if 'machineID' in df else
+                                              pd.Series(machine, index=df.index), sort=True)
+        animalCodes, animals = pd.factorize(df['monkey'], sort=True)
+        directionCodes = pd.Categorical(df['event'], categories=list(directions)).codes
+
+        step = pd.Timedelta(freq).value
+        start = df['time'].min().floor(freq) if len(df) else pd.Timestamp(0)
+        timeCodes = (df['time'] - start).to_numpy().astype('timedelta64[ns]').astype(np.int64) // step
+        bins = int(timeCodes.max()) + 1 if len(df) else 0
+
+        shape = (len(machines), len(animals), len(directions), bins)
+        flat = np.ravel_multi_index((machineCodes, animalCodes, directionCodes, timeCodes), shape)
+        counts = np.bincount(flat, minlength=int(np.prod(shape))).astype(np.uint32).reshape(shape)
+        return cls(counts, machines, animals, directions, pd.date_range(start, periods=bins, freq=freq), freq)
+
+    def rollup(self, freq):
+        """
+        Coarser cube, e.g. hours to days ('D') or weeks ('W'). The time bins
+        of a period are consecutive, so every period is one np.add.reduceat.
+        :param freq: Period of the new bins, a multiple of the bins of the cube.
+        :return: CrossingCube with one bin per period.
+        """
+        labels = self.times.to_period(freq).start_time
+        if len(labels) == 0:
+            return CrossingCube(self.counts.copy(), self.machines, self.animals, self.directions, labels, freq)
+        first = np.flatnonzero(np.r_[True, labels[1:] != labels[:-1]])
+        counts = np.add.reduceat(self.counts, first, axis=3).astype(np.uint32)
+        return CrossingCube(counts, self.machines, self.animals, self.directions, labels[first], freq)
+
+    def profile(self, by='hour'):
+        """
+        Counts folded over a cycle: per hour of the day or per weekday.
+        :param by: 'hour' (24 bins) or 'weekday' (7 bins, Monday first).
+        :return: uint32 array of shape (machines, animals, directions, 24 or 7).
+        """
+        if by == 'hour':
+            keys, size = self.times.hour.to_numpy(), 24
+        elif by == 'weekday':
+            keys, size = self.times.weekday.to_numpy(), 7
+        else:
+            raise ValueError(f"Unknown profile {by}, use 'hour' or 'weekday'")
+        # Sum of the bins of every key, as a product with their one-hot matrix
+        onehot = (keys[:, None] == np.arange(size)).astype(np.uint64)
+        return (self.counts.astype(np.uint64) @ onehot).astype(np.uint32)
+
+    def total(self, keep=('animal', 'direction')):
+        """
+        Counts summed over every axis not in keep.
+        :param keep: Axes kept, in AXES order.
+        :return: uint64 array with the kept axes.
+        """
+        unknown = set(keep) - set(AXES)
+        if unknown:
+            raise ValueError(f"Unknown axes {', '.join(sorted(unknown))}, use {', '.join(AXES)}")
+        return self.counts.sum(axis=tuple(i for i, axis in enumerate(AXES) if axis not in keep), dtype=np.uint64)
+
+    def toFrame(self):
+        """
+        The non-zero cells as a long table (machineID, monkey, event, time,
+        count), ready for seaborn.
+        """
+        machine, animal, direction, time = np.nonzero(self.counts)
+        return pd.DataFrame({'machineID': self.machines[machine],
+                             'monkey': self.animals[animal],
+                             'event': self.directions[direction],
+                             'time': self.times[time],
+                             'count': self.counts[machine, animal, direction, time]})
+
+    def save(self, path):
+        """
+        Write the cube to a compressed .npz file.
+        """
+        np.savez_compressed(os.path.expanduser(path), counts=self.counts, machines=self.machines,
+                            animals=self.animals, directions=self.directions,
+                            times=self.times.as_unit('ns').asi8, freq=np.array(self.freq))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read a cube written by save.
+        """
+        with np.load(os.path.expanduser(path), allow_pickle=False) as data:
+            return cls(data['counts'], data['machines'], data['animals'], data['directions'],
+                       pd.to_datetime(data['times']), str(data['freq']))
+
+
+if __name__ == '__main__':
+
+    from IncrementalAnalysis import IncrementalAnalyzer
+    from MovementAnalysis import movement_events
+
+    parser = argparse.ArgumentParser(description='Build the crossing cube of the analyzed machines.')
+    parser.add_argument('checkpoint', help='folder with the results of IncrementalAnalysis')
+    parser.add_argument('machines', nargs='+', help='machines to include')
+    parser.add_argument('--freq', default='1h', help='size of the time bins')
+    parser.add_argument('--output', default='crossings.npz', help='.npz file to write')
+    args = parser.parse_args()
+
+    analyzer = IncrementalAnalyzer(args.checkpoint)
+    movements = []
+    for machine in args.machines:
+        results = analyzer.results(machine)
+        if not results.empty:
+            movements.append(movement_events(results))
+    if not movements:
+        parser.exit(1, f"No analyzed logs of {', '.join(args.machines)} in {args.checkpoint}, "
+                       "run IncrementalAnalysis first\n")
+    cube = CrossingCube.fromMovements(pd.concat(movements, ignore_index=True), args.freq)
+    cube.save(args.output)
+    print(f"{args.output}: {' x '.join(map(str, cube.counts.shape))} (machines x animals x directions x bins)")
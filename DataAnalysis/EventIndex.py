@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Wed May 21 10:05:37 2025
+
+@author: J. Cabrera-Moreno
+    Postdoctoral Fellow
+    Evolutionary Cognition Group
+    Institute of Evolutionary Anthropology
+    University of Zurich
+
+    Description: Sorted index of the gate logs (or of the movement table) for
+                the "what happened between t0 and t1" questions of the
+                analyses. It is built once over the merged frame: int64
+                timestamps sorted per machine, per machine and object, and
+                per animal, so every range or nearest event query is a binary
+                search and every slice is a view instead of a boolean mask
+                over the whole frame. Queries return row positions of the
+                frame (df.iloc), in time order.
+"""
+import numpy as np
+import pandas as pd
+
+
+class _Segments:
+    """
+    Times sorted by (key, time), with the bounds of every key.
+    """
+
+    def __init__(self, times, keys):
+        # lexsort is stable: equal times keep the order of the rows
+        self.rows = np.lexsort((times, keys))
+        self.times = times[self.rows]
+        sortedKeys = keys[self.rows]
+        starts = np.flatnonzero(np.r_[True, sortedKeys[1:] != sortedKeys[:-1]]) if len(keys) else np.empty(0, int)
+        ends = np.r_[starts[1:], len(keys)]
+        self.bounds = dict(zip(sortedKeys[starts].tolist(), zip(starts.tolist(), ends.tolist())))
+
+    def get(self, key):
+        start, end = self.bounds.get(key, (0, 0))
+        return self.times[start:end], self.rows[start:end]
+
+
+class EventIndex:
+
+    def __init__(self, df, time='datetime', kind='object', animal='monkey', by=None):
+        """
+        :param df: Logs (or movements) to index. Queries answer with positions
+                   of its rows, keep the frame in the same order while the
+                   index is used.
+        :param time: Column of the timestamps.
+        :param kind: Column of the kind of every row (e.g. 'object', 'event').
+        :param animal: Column of the animal, None if the frame has none.
+        :param by: Columns that tell the machines apart (e.g. ['machineID']),
+                   None or [] for a single machine.
+        """
+        self.times = df[time].to_numpy().astype('datetime64[ns]').astype(np.int64)
+        by = list(by or [])
+        if by:
+            machineCodes, machines = pd.factorize(pd.MultiIndex.from_frame(df[by]) if len(by) > 1 else df[by[0]])
+        else:
+            machineCodes, machines = np.zeros(len(df), dtype=np.int64), [None]
+        self.machines = list(machines)
+        self._machineCodes = {machine: code for code, machine in enumerate(self.machines)}
+        self._machineCodesOfRows = np.asarray(machineCodes, dtype=np.int64)
+        self._byMachine = _Segments(self.times, self._machineCodesOfRows)
+
+        # The kind and animal orders are only sorted when first queried
+        self._kindColumn = df[kind]
+        self._animalColumn = df[animal] if animal is not None else None
+        self._byKind = None
+        self._byAnimal = None
+
+    def _kindSegments(self):
+        if self._byKind is None:
+            kindCodes, kinds = pd.factorize(self._kindColumn)
+            self._kindCodes = {value: code for code, value in enumerate(kinds)}
+            self._kinds = len(kinds) + 1
+            self._byKind = _Segments(self.times, self._machineCodesOfRows * self._kinds + kindCodes + 1)
+            self._kindColumn = None
+        return self._byKind
+
+    def _animalSegments(self):
+        if self._byAnimal is None:
+            if self._animalColumn is None:
+                raise ValueError("The index was built without an animal column")
+            animalCodes, animals = pd.factorize(self._animalColumn)
+            self._animalCodes = {value: code for code, value in enumerate(animals)}
+            self._byAnimal = _Segments(self.times, animalCodes)
+            self._animalColumn = None
+        return self._byAnimal
+
+    def __len__(self):
+        return len(self.times)
+
+    def _machineCode(self, machine):
+        if machine is None:
+            if len(self.machines) > 1:
+                raise ValueError("The index has several machines, choose one")
+            return 0
+        return self._machineCodes.get(machine, -1)
+
+    def _segment(self, code, kinds):
+        if code < 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        if kinds is None:
+            return self._byMachine.get(code)
+        if isinstance(kinds, str):
+            kinds = [kinds]
+        byKind = self._kindSegments()
+        parts = [byKind.get(code * self._kinds + self._kindCodes[value] + 1)
+                 for value in kinds if value in self._kindCodes]
+        if len(parts) == 1:
+            return parts[0]
+        return self._merge(parts)
+
+    @staticmethod
+    def _merge(parts):
+        # Sorted slices merged in time order, equal times in row order
+        if not parts:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        times = np.concatenate([part[0] for part in parts])
+        rows = np.concatenate([part[1] for part in parts])
+        order = np.lexsort((rows, times))
+        return times[order], rows[order]
+
+    def segment(self, machine=None, kinds=None):
+        """
+        Sorted timestamps and row positions of a machine, optionally of some
+        kinds only. A single kind (or no kinds) gives views of the index.
+        :param machine: Machine (value of the `by` columns), None when the
+                        index has a single machine.
+        :param kinds: Kind or list of kinds, None for every row.
+        :return: (int64 ns times, row positions), both in time order.
+        """
+        return self._segment(self._machineCode(machine), kinds)
+
+    def animal(self, name):
+        """
+        Sorted timestamps and row positions of an animal (every machine),
+        views of the index.
+        """
+        byAnimal = self._animalSegments()
+        if name not in self._animalCodes:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        return byAnimal.get(self._animalCodes[name])
+
+    @staticmethod
+    def _toNs(values):
+        # Timestamps, strings or datetime64 (scalars or arrays) to int64 ns
+        values = np.asarray(values)
+        if not np.issubdtype(values.dtype, np.integer):
+            values = np.asarray(values, dtype='datetime64[ns]').astype(np.int64)
+        return values
+
+    def _codes(self, machine):
+        # Every machine when none is given
+        return range(len(self.machines)) if machine is None else [self._machineCode(machine)]
+
+    def range(self, t0, t1, kinds=None, machine=None):
+        """
+        Rows with t0 <= time < t1.
+        :param t0, t1: Bounds of the range (timestamps or int64 ns).
+        :param kinds: Kind or list of kinds, None for every row.
+        :param machine: Machine of the rows, None for every machine.
+        :return: Row positions in time order.
+        """
+        t0, t1 = self._toNs(t0), self._toNs(t1)
+        parts = []
+        for code in self._codes(machine):
+            times, rows = self._segment(code, kinds)
+            lo, hi = np.searchsorted(times, [t0, t1], side='left')
+            parts.append((times[lo:hi], rows[lo:hi]))
+        return parts[0][1] if len(parts) == 1 else self._merge(parts)[1]
+
+    def count(self, t0, t1, kinds=None, machine=None):
+        """
+        Number of rows with t0 <= time < t1, for arrays of bounds.
+        """
+        t0, t1 = self._toNs(t0), self._toNs(t1)
+        total = np.zeros(np.broadcast(t0, t1).shape, dtype=np.int64)
+        for code in self._codes(machine):
+            times, _ = self._segment(code, kinds)
+            total += np.searchsorted(times, t1, side='left') - np.searchsorted(times, t0, side='left')
+        return total
+
+    def _nearest(self, t, kinds, machine, before, strict):
+        t = self._toNs(t)
+        times, rows = self.segment(machine, kinds)
+        if before:
+            position = np.searchsorted(times, t, side='left' if strict else 'right') - 1
+            found = position >= 0
+        else:
+            position = np.searchsorted(times, t, side='right' if strict else 'left')
+            found = position < len(times)
+        return np.where(found, rows[np.where(found, position, 0)] if len(rows) else -1, -1)
+
+    def nearest_before(self, t, kinds=None, machine=None, strict=True):
+        """
+        Last row before every time of t (at or before if not strict).
+        :param t: Timestamp or array of timestamps (or int64 ns).
+        :return: Row positions, -1 where there is none.
+        """
+        return self._nearest(t, kinds, machine, True, strict)
+
+    def nearest_after(self, t, kinds=None, machine=None, strict=True):
+        """
+        First row after every time of t (at or after if not strict).
+        :param t: Timestamp or array of timestamps (or int64 ns).
+        :return: Row positions, -1 where there is none.
+        """
+        return self._nearest(t, kinds, machine, False, strict)
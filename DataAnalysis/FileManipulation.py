@@ -8,40 +8,369 @@ Created on Tue Jan 14 22:07:44 2025
         Evolutionary Cognition Group
         Institute of Evolutionary Anthropology
         University of Zurich
-        
+
         Description: Data files meta hanlding
 """
 
+import os
+import sys
 import glob
+import hashlib
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
 
+# The binary log format is shared with the gates
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'RaspberryPi'))
+from BinaryLog import binary_log_to_dataframe, iter_binary_log, records_to_dataframe
+
+# Columns logged by the gates and their fixed types
+LOG_DTYPES = {'date': 'int64', 'object': 'category', 'state': 'category', 'monkey': 'category'}
+CATEGORY_COLUMNS = [col for col, dtype in LOG_DTYPES.items() if dtype == 'category']
+# Partitions of the columnar session store
+STORE_PARTITIONS = ['machineID', 'day']
+
+
+def _headerRows(file):
+    # find if the file has header or footer
+    with open(file) as doc:
+        firstLine = doc.readline().strip()
+    return 1 if ':' in firstLine else 0
+
+
+def logFiles(folder, modifiedAfter=None):
+    """
+    Log files of a gate folder. A CSV export of a binary log (BinaryLog.py
+    --csv) left next to it is skipped, its rows would be read twice.
+    :param folder: Folder with the log files of the gate.
+    :param modifiedAfter: Only the files modified at or after this timestamp
+                          (seconds since epoch), None lists all.
+    :return: Sorted list of paths.
+    """
+    pathFiles = sorted(glob.glob(f"{folder}/*"))
+    binaries = {os.path.splitext(file)[0] for file in pathFiles if file.endswith('.bin')}
+    pathFiles = [file for file in pathFiles
+                 if not (file.endswith('.txt') and os.path.splitext(file)[0] in binaries)]
+    if modifiedAfter is not None:
+        pathFiles = [file for file in pathFiles if os.path.getmtime(file) >= modifiedAfter]
+    return pathFiles
+
+
+def readLogFile(file):
+    """
+    Parse a single gate log file with the fixed LOG_DTYPES.
+    :param file: Path of the log file, binary logs (.bin) are read without parsing.
+    :return: DataFrame with the rows of the file.
+    """
+    if file.endswith('.bin'):
+        return binary_log_to_dataframe(file)[1].astype(LOG_DTYPES)
+
+    skiprows = _headerRows(file)
+
+    try:
+        return pd.read_csv(file, skiprows=skiprows, engine='c', on_bad_lines='skip', dtype=LOG_DTYPES)
+    except pd.errors.EmptyDataError:
+        # Empty or header only, e.g. after a power loss when the file was created
+        return pd.DataFrame({col: pd.Series(dtype=dtype) for col, dtype in LOG_DTYPES.items()})
+    except ValueError:
+        # A line cut by a power loss can hold a partial date, drop those rows
+        df = pd.read_csv(file, skiprows=skiprows, engine='c', on_bad_lines='skip')
+        df['date'] = pd.to_numeric(df['date'], errors='coerce')
+        df = df.dropna(subset=['date']).reset_index(drop=True)
+        return df.astype(LOG_DTYPES)
+
 
-class FilesToDataframe: 
-    
-    def __init__(self, mainPath):    
+def gateDateToDatetime(date):
+    """
+    Convert the int64 dates logged by the gates (YYYYMMDDHHMMSSffff) to datetime
+    with arithmetic instead of a round-trip through strings. As formatDate, the
+    result is truncated to milliseconds.
+    :param date: Series of int64 dates.
+    :return: Series of datetime64[ns].
+    """
+    seconds, fraction = np.divmod(date.to_numpy(dtype=np.int64), 10**4)
+    parts = pd.DataFrame({'year': seconds // 10**10,
+                          'month': seconds // 10**8 % 100,
+                          'day': seconds // 10**6 % 100,
+                          'hour': seconds // 10**4 % 100,
+                          'minute': seconds // 10**2 % 100,
+                          'second': seconds % 100})
+    datetime = pd.to_datetime(parts) + pd.to_timedelta(fraction // 10, unit='ms')
+    return pd.Series(datetime.to_numpy(dtype='datetime64[ns]'), index=date.index)
+
+
+def readLogChunks(file, chunkRows):
+    """
+    Parse a gate log file in chunks, so that only part of it is in memory.
+    :param file: Path of the log file.
+    :param chunkRows: Rows per chunk.
+    :return: Generator of DataFrames with the LOG_DTYPES columns and the
+             'datetime' of every row (see gateDateToDatetime), every chunk
+             sorted by datetime.
+    """
+    if file.endswith('.bin'):
+        # Binary logs are memory mapped, only the records of a chunk are copied
+        pieces = (records_to_dataframe(names, records).astype(LOG_DTYPES)
+                  for _, names, records in iter_binary_log(file, chunkRows))
+    else:
+        try:
+            pieces = pd.read_csv(file, skiprows=_headerRows(file), engine='c', on_bad_lines='skip',
+                                 chunksize=chunkRows, dtype={col: 'category' for col in CATEGORY_COLUMNS})
+        except pd.errors.EmptyDataError:
+            return
+
+    for piece in pieces:
+        # A line cut by a power loss can hold a partial date, drop those rows
+        date = pd.to_numeric(piece['date'], errors='coerce')
+        piece = piece[date.notna()].copy()
+        piece['date'] = date[date.notna()].astype('int64')
+        piece['datetime'] = gateDateToDatetime(piece['date'])
+        yield piece.sort_values('datetime', kind='stable').reset_index(drop=True)
+
+
+def _firstTimestamp(file):
+    # Time of the first row of a log file (the start of its session)
+    for chunk in readLogChunks(file, 1):
+        if not chunk.empty:
+            return chunk['datetime'].iloc[0]
+    return None
+
+
+class FilesToDataframe:
+
+    def __init__(self, mainPath, cachePath='~/.cache/MonkeyGate', workers=8):
+        """
+        :param mainPath: Folder with the log files of a gate.
+        :param cachePath: Folder where parsed files are cached, None disables the cache.
+        :param workers: Number of files parsed at the same time.
+        """
         self.mainPathFolder = mainPath
-    
-    def createSingleDf(self):
+        self.cachePathFolder = os.path.expanduser(cachePath) if cachePath else None
+        self.workers = workers
+
+        if self.cachePathFolder and not os.path.exists(self.cachePathFolder):
+            os.makedirs(self.cachePathFolder)
+
+    def _cacheFile(self, file):
+        # One cache entry per log file, named after its absolute path
+        key = hashlib.sha1(os.path.abspath(file).encode('utf-8')).hexdigest()
+        return os.path.join(self.cachePathFolder, f"{key}.pkl")
+
+    def _loadFile(self, file):
+        """
+        Parse a log file, reusing the cached DataFrame if the file did not change
+        (same path, modification time and size) since it was cached.
+        """
+        if not self.cachePathFolder:
+            return readLogFile(file)
+
+        stat = os.stat(file)
+        signature = (os.path.abspath(file), stat.st_mtime_ns, stat.st_size)
+        cacheFile = self._cacheFile(file)
+        try:
+            with open(cacheFile, 'rb') as doc:
+                cachedSignature, df = pickle.load(doc)
+            if cachedSignature == signature:
+                return df
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+            pass
+
+        df = readLogFile(file)
+        # Write to a temporary file first so that a concurrent run never reads half an entry
+        tmpFile = f"{cacheFile}.{os.getpid()}.tmp"
+        with open(tmpFile, 'wb') as doc:
+            pickle.dump((signature, df), doc, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpFile, cacheFile)
+
+        return df
+
+    def createSingleDf(self, modifiedAfter=None):
+        """
+        Merge the log files of the gate in a single DataFrame.
+        :param modifiedAfter: Only read the files modified at or after this
+                              timestamp (seconds since epoch), None reads all.
+        :return: DataFrame with the rows of all the files.
+        """
         # List of all file's path
-        pathFiles = glob.glob(f"{self.mainPathFolder}/*")
-        
-        # Build a single df
-        dfs = []
-        for idx, file in enumerate(pathFiles):
-            # find if the file has header or footer
-            with open (file) as doc:
-                firstLine = doc.readline().strip()
-                if ':' in firstLine:
-                    # has a header
-                    df = pd.read_csv(file,skiprows=1, engine='c', on_bad_lines='skip')
-
-            dfs.append(df)
-        
+        pathFiles = logFiles(self.mainPathFolder, modifiedAfter)
+        if not pathFiles:
+            return pd.DataFrame({col: pd.Series(dtype=dtype) for col, dtype in LOG_DTYPES.items()}).reset_index()
+
+        # Parse the files in parallel, most of the time is spent waiting on the file share
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            dfs = list(executor.map(self._loadFile, pathFiles))
+
         allDataframes = pd.concat(dfs, ignore_index=False).reset_index()
-        
+        # Files hold different categories, concat falls back to object columns
+        for col in CATEGORY_COLUMNS:
+            allDataframes[col] = allDataframes[col].astype('category')
+
         return allDataframes
 
+    def iterChunks(self, chunkRows=10**6, modifiedAfter=None, lateness=pd.Timedelta(seconds=10)):
+        """
+        Stream the log files of the gate as DataFrame chunks in global time
+        order, so that long histories can be analyzed with bounded memory (see
+        IncrementalAnalyzer.run). The files are read in chunks and merged:
+        a file is only opened once the merge reaches the start of its session,
+        and rows are only released once every open file has been read past
+        them.
+        :param chunkRows: Rows read at a time from a file, the chunks returned
+                          hold about as many rows.
+        :param modifiedAfter: Only read the files modified at or after this
+                              timestamp (seconds since epoch), None reads all.
+        :param lateness: How much earlier than the rows before it a row of a
+                         file can be (crossings are logged after their RFID
+                         reads). Later rows are returned in the next chunk and
+                         a warning is printed, IncrementalAnalyzer.update
+                         counts them as dropped when its checkpoint already
+                         moved past them.
+        :return: Generator of DataFrames with the columns of createSingleDf and
+                 'datetime', sorted by datetime. Rows with the same datetime
+                 are never split between two chunks.
+        """
+        pathFiles = logFiles(self.mainPathFolder, modifiedAfter)
+        # Files are opened in the order of their first row
+        starts = sorted((start, file) for file, start in ((file, _firstTimestamp(file)) for file in pathFiles)
+                        if start is not None)
+        lateness = pd.Timedelta(lateness)
+
+        # Open files: chunk generator, rows read and not returned yet, latest row read
+        sources = []
+        nextFile = 0
+        released = None
+        ready, readyRows = [], 0
+
+        def readNext(source):
+            for chunk in source['chunks']:
+                if chunk.empty:
+                    continue
+                if released is not None and chunk['datetime'].iloc[0] < released:
+                    late = int((chunk['datetime'] < released).sum())
+                    print(f"Warning: {late} rows of {source['file']} are more than {lateness} out of order")
+                if source['pending'] is not None:
+                    chunk = pd.concat([source['pending'], chunk]).sort_values('datetime', kind='stable')
+                source['pending'] = chunk
+                source['high'] = max(source['high'], chunk['datetime'].iloc[-1])
+                return
+            source['done'] = True
+
+        while True:
+            # Rows before the watermark cannot be preceded by any row still to read
+            limits = [(source['high'] - lateness, index) for index, source in enumerate(sources)
+                      if not source['done']]
+            if nextFile < len(starts):
+                limits.append((starts[nextFile][0] - lateness, -1))
+            watermark, limiter = min(limits) if limits else (None, None)
+            limiter = sources[limiter] if limiter is not None and limiter >= 0 else limiter
+
+            pieces = []
+            for source in sources:
+                pending = source['pending']
+                if pending is None:
+                    continue
+                cut = len(pending) if watermark is None else \
+                    np.searchsorted(pending['datetime'].to_numpy(), watermark.to_datetime64(), side='left')
+                if cut:
+                    pieces.append(pending.iloc[:cut])
+                    source['pending'] = pending.iloc[cut:]
+            if pieces:
+                ready.append(pd.concat(pieces).sort_values('datetime', kind='stable'))
+                readyRows += len(ready[-1])
+                released = watermark
+            sources = [source for source in sources
+                       if not (source['done'] and (source['pending'] is None or source['pending'].empty))]
+
+            if readyRows >= chunkRows or (watermark is None and ready):
+                chunk = pd.concat(ready, ignore_index=True)
+                # Files hold different categories, concat falls back to object columns
+                for col in CATEGORY_COLUMNS:
+                    chunk[col] = chunk[col].astype('category')
+                yield chunk
+                ready, readyRows = [], 0
+            if watermark is None:
+                break
+
+            if limiter == -1:
+                limiter = {'file': starts[nextFile][1], 'chunks': readLogChunks(starts[nextFile][1], chunkRows),
+                           'pending': None, 'high': starts[nextFile][0], 'done': False}
+                nextFile += 1
+                sources.append(limiter)
+            readNext(limiter)
+
+    def consolidateStore(self, storePath, machineID):
+        """
+        Convert the raw log files of the gate into a columnar session store
+        (Parquet dataset partitioned by machineID and day). The timestamps are
+        stored as datetime64[ns], object/state/monkey are dictionary encoded
+        and the session number of every row is precomputed. The partitions of
+        the machine are overwritten, so the store can be refreshed at any time.
+        :param storePath: Folder of the session store.
+        :param machineID: Name of the gate the logs belong to.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        df = self.createSingleDf()
+        df['datetime'] = gateDateToDatetime(df['date'])
+        df = df.sort_values('datetime', kind='stable').reset_index(drop=True)
+        # Same numbering as createSession: one session per calendar day
+        day = df['datetime'].dt.normalize()
+        df['session'] = (day.diff().dt.days.fillna(0) > 0).cumsum().astype('int32') + 1
+        df['day'] = day.dt.strftime('%Y-%m-%d')
+        df['machineID'] = machineID
+
+        table = pa.Table.from_pandas(df[['datetime', 'object', 'state', 'monkey', 'session'] + STORE_PARTITIONS],
+                                     preserve_index=False)
+        pq.write_to_dataset(table, storePath, partition_cols=STORE_PARTITIONS,
+                            existing_data_behavior='delete_matching')
+
+    @staticmethod
+    def readStore(storePath, columns=None, machines=None, start=None, end=None):
+        """
+        Read a session store written by consolidateStore. Only the partitions of
+        the requested machines and days, and the requested columns, are read.
+        :param storePath: Folder of the session store.
+        :param columns: Columns to load besides 'datetime', None loads all of them.
+        :param machines: List of machineIDs to load, None loads all of them.
+        :param start: First timestamp to load (inclusive), None for no limit.
+        :param end: Last timestamp to load (exclusive), None for no limit.
+        :return: DataFrame sorted by datetime, shaped as the output of
+                 formatDate and createSession.
+        """
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+
+        # Days are kept as ISO strings so that they compare in time order
+        partitioning = ds.partitioning(pa.schema([('machineID', pa.string()), ('day', pa.string())]),
+                                       flavor='hive')
+        dataset = ds.dataset(storePath, format='parquet', partitioning=partitioning)
+
+        filters = []
+        if machines is not None:
+            filters.append(ds.field('machineID').isin(list(machines)))
+        if start is not None:
+            start = pd.Timestamp(start)
+            filters.append(ds.field('day') >= start.strftime('%Y-%m-%d'))
+            filters.append(ds.field('datetime') >= start)
+        if end is not None:
+            end = pd.Timestamp(end)
+            filters.append(ds.field('day') <= end.strftime('%Y-%m-%d'))
+            filters.append(ds.field('datetime') < end)
+        expression = None
+        for condition in filters:
+            expression = condition if expression is None else expression & condition
+
+        if columns is not None:
+            columns = list(dict.fromkeys(['datetime'] + list(columns)))
+        df = dataset.to_table(columns=columns, filter=expression).to_pandas()
+        df = df.sort_values('datetime', kind='stable').reset_index(drop=True)
+        df['date'] = df['datetime'].dt.date
+
+        return df
+
 
 if __name__ == '__main__':
     FTDF = FilesToDataframe('/Volumes/G_IEA_PRS$/PS/2_ERC/AutomatedChallenges/eSeesaw/piz-ecg2')
-    df = FTDF.createSingleDf()
\ No newline at end of file
+    df = FTDF.createSingleDf()
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Apr 14 09:12:31 2025
+
+@author: J. Cabrera-Moreno
+    Postdoctoral Fellow
+    Evolutionary Cognition Group
+    Institute of Evolutionary Anthropology
+    University of Zurich
+
+    Description: Incremental analysis of the monkey gate logs. A checkpoint per
+                machine keeps the last processed timestamp and the RFID events
+                that can still change, so every run only processes the logs
+                written since the previous one and gives the same event ids,
+                windows and movements as analyzing the whole history again.
+"""
+import os
+import glob
+import time
+import pickle
+import argparse
+import numpy as np
+import pandas as pd
+
+from FileManipulation import FilesToDataframe
+from MovementAnalysis import formatDate, segment_events, assign_ir_to_rfid_events, classify_movements
+
+# Size of the before and after windows of every RFID event
+WINDOW = pd.Timedelta(seconds=2)
+# Version of the event ids kept in the checkpoints (2: stable ids of segment_events)
+ID_VERSION = 2
+# Columns that identify a log, with its occurrence among identical logs
+ROW_IDENTITY = ['datetime', 'object', 'state', 'monkey']
+
+
+def analyzeMachine(machineDF, window=WINDOW):
+    """
+    Full (non incremental) analysis of the logs of a single machine: RFID event
+    ids, IR window assignment and movement classification.
+    :param machineDF: Logs of the machine, as returned by formatDate. The
+                      'machineID' column, if any, is part of the ids.
+    :param window: Size of the before and after windows of every RFID event.
+    :return: DataFrame sorted by datetime with 'session_id', 'event_id',
+             'movement' and 'confidence' columns.
+    """
+    df = segment_events(machineDF, by=['machineID'] if 'machineID' in machineDF else [])
+    df = assign_ir_to_rfid_events(df, window)
+    return classify_movements(df)
+
+
+def _rowKeys(df):
+    # Identity of every row: its ROW_IDENTITY values and how many identical rows come before it
+    columns = [col for col in ROW_IDENTITY if col in df]
+    keys = df[columns].astype(str).fillna('')
+    keys['occurrence'] = keys.groupby(columns).cumcount()
+    return pd.MultiIndex.from_frame(keys)
+
+
+class IncrementalAnalyzer:
+
+    def __init__(self, checkpointPath, window=WINDOW):
+        """
+        :param checkpointPath: Folder holding one checkpoint and the finalized
+                               results per machine.
+        :param window: Size of the before and after windows of every RFID event.
+        """
+        self.checkpointPath = os.path.expanduser(checkpointPath)
+        self.window = window
+
+    def _machinePath(self, machine):
+        path = os.path.join(self.checkpointPath, machine)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        return path
+
+    def loadState(self, machine):
+        try:
+            with open(os.path.join(self._machinePath(machine), 'state.pkl'), 'rb') as doc:
+                return pickle.load(doc)
+        except FileNotFoundError:
+            return None
+
+    def _saveState(self, machine, state):
+        # Write to a temporary file first so that a crash never leaves half a checkpoint
+        stateFile = os.path.join(self._machinePath(machine), 'state.pkl')
+        with open(f"{stateFile}.tmp", 'wb') as doc:
+            pickle.dump(state, doc, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f"{stateFile}.tmp", stateFile)
+
+    def _appendResults(self, machine, df):
+        resultsPath = os.path.join(self._machinePath(machine), 'results')
+        if not os.path.exists(resultsPath):
+            os.makedirs(resultsPath)
+        chunk = len(glob.glob(os.path.join(resultsPath, '*.pkl')))
+        df.to_pickle(os.path.join(resultsPath, f"{chunk:06d}.pkl"))
+
+    def results(self, machine):
+        """
+        All the analyzed logs of a machine: the finalized chunks followed by the
+        rows whose events can still change with the next logs.
+        """
+        state = self.loadState(machine)
+        chunks = sorted(glob.glob(os.path.join(self._machinePath(machine), 'results', '*.pkl')))
+        dfs = [pd.read_pickle(chunk) for chunk in chunks]
+        if state is not None:
+            dfs.append(state['tail'])
+        if not dfs:
+            return pd.DataFrame()
+        return pd.concat(dfs, ignore_index=True)
+
+    def update(self, machine, machineDF, analyzedUntil=None):
+        """
+        Analyze the logs of a machine written after its checkpoint.
+        :param machine: Name of the machine.
+        :param machineDF: Logs of the machine, as returned by formatDate. Rows
+                          before the last processed timestamp are skipped, rows
+                          at it are skipped if they were already processed
+                          (see ROW_IDENTITY).
+        :param analyzedUntil: Timestamp up to which the rows of machineDF were
+                              analyzed before (files read again). Skipped rows
+                              after it came too late to be analyzed: they are
+                              counted in the 'droppedRows' of the checkpoint.
+                              None takes every skipped row as analyzed.
+        :return: (number of new rows processed, number of late rows dropped).
+        """
+        state = self.loadState(machine)
+        if state is not None and state.get('idVersion') != ID_VERSION:
+            raise ValueError(f"The checkpoint of {machine} has the old event ids, analyze the machine again "
+                             "from an empty checkpoint folder")
+        df = machineDF.sort_values('datetime', kind='stable').reset_index(drop=True)
+        dropped = 0
+        if state is not None:
+            # Logs have second resolution: rows at the last processed timestamp
+            # can be new, they are told apart by their identity
+            lastTimestamp = state['lastTimestamp']
+            tail = state['tail']
+            atLast = (df['datetime'] == lastTimestamp).to_numpy()
+            unseen = np.zeros(len(df), dtype=bool)
+            unseen[atLast] = ~_rowKeys(df[atLast]).isin(_rowKeys(tail[tail['datetime'] == lastTimestamp]))
+            if analyzedUntil is not None:
+                dropped = int(((df['datetime'] > analyzedUntil) & (df['datetime'] < lastTimestamp)).sum())
+            df = df[(df['datetime'] > lastTimestamp).to_numpy() | unseen].reset_index(drop=True)
+        if dropped:
+            print(f"Warning: {dropped} rows of {machine} are older than its checkpoint and were not analyzed")
+        if df.empty:
+            if dropped:
+                state['droppedRows'] = state.get('droppedRows', 0) + dropped
+                self._saveState(machine, state)
+            return 0, dropped
+        df['machineID'] = machine
+        newRows = len(df)
+
+        # Sessions: one per calendar day, continuing the numbering of the checkpoint
+        day = df['datetime'].dt.normalize().to_numpy()
+        lastDay = state['lastDay'] if state is not None else day[0]
+        lastSession = state['lastSession'] if state is not None else 1
+        df['session'] = lastSession + np.cumsum(np.diff(np.r_[lastDay, day]) > np.timedelta64(0, 'ns'))
+
+        # Re-analyze the rows of the open events together with the new rows
+        if state is not None:
+            df = pd.concat([state['tail'], df], ignore_index=True)
+        is_rfid = (df['object'] == 'rfid').to_numpy()
+
+        # Stable ids of the new rows, the rows of the tail keep their stored ids.
+        # The tail can start in the middle of an older RFID run, so the ids are
+        # computed from the row before the ms of the last processed timestamp:
+        # the events starting in that ms keep their order, and new RFID rows
+        # that continue the last run of the tail take its stored id.
+        tailRows = len(df) - newRows
+        first = 0
+        if tailRows:
+            times = df['datetime'].to_numpy()
+            lastMs = np.datetime64(state['lastTimestamp'], 'ms').astype(times.dtype)
+            first = max(np.searchsorted(times, lastMs, side='left') - 1, 0)
+        ids = segment_events(df.iloc[first:][['datetime', 'object', 'machineID']], by=['machineID'])
+        sessions = ids['session_id'].to_numpy()[tailRows - first:]
+        stored = ids['event_id'].iloc[tailRows - first:]
+        if tailRows:
+            sessions = np.r_[df['session_id'].to_numpy()[:tailRows].astype(np.int64), sessions]
+            stored = pd.concat([df['event_id'].iloc[:tailRows], stored], ignore_index=True).astype('Int64')
+            if is_rfid[tailRows - 1]:
+                continued = tailRows + np.argmin(np.r_[is_rfid[tailRows:], False])
+                stored.iloc[tailRows:continued] = stored.iloc[tailRows - 1]
+        df['session_id'] = sessions
+        base = df.drop(columns=['movement', 'confidence'], errors='ignore')
+        base['event_id'] = stored.where(is_rfid).array
+        base = assign_ir_to_rfid_events(base, self.window)
+
+        # Events closed at the checkpoint keep their rows and movements
+        firstOpenEvent = state['firstOpenEvent'] if state is not None else None
+        if firstOpenEvent is None:
+            result = classify_movements(base)
+        else:
+            closed = (stored < firstOpenEvent).fillna(False).to_numpy()
+            base.loc[closed, 'event_id'] = stored[closed].to_numpy()
+            result = classify_movements(base)
+            result.loc[closed, 'movement'] = df.loc[closed, 'movement']
+            result.loc[closed, 'confidence'] = df.loc[closed, 'confidence']
+
+        # An event stays open while new logs (at or after the last timestamp) can
+        # still land in its after window
+        times = result['datetime'].to_numpy()
+        lastTimestamp = times[-1]
+        window = np.timedelta64(pd.Timedelta(self.window).value, 'ns')
+        rfid = result[is_rfid]
+        if rfid.empty:
+            firstOpenEvent = None
+            carry = np.searchsorted(times, lastTimestamp - window, side='left')
+        else:
+            bounds = rfid.groupby('event_id')['datetime'].agg(['min', 'max'])
+            isOpen = (bounds['max'] + self.window >= lastTimestamp).to_numpy(copy=True)
+            isOpen[-1] = True
+            firstOpenEvent = int(bounds.index[isOpen.argmax()])
+            # Keep every row that the before window of that event could reach
+            carry = np.searchsorted(times, bounds['min'].to_numpy()[isOpen.argmax()] - window, side='left')
+
+        if carry > 0:
+            self._appendResults(machine, result.iloc[:carry].reset_index(drop=True))
+        self._saveState(machine, {'lastTimestamp': lastTimestamp,
+                                  'lastDay': day[-1],
+                                  'lastSession': int(result['session'].iloc[-1]),
+                                  'idVersion': ID_VERSION,
+                                  'firstOpenEvent': firstOpenEvent,
+                                  'lastModified': state['lastModified'] if state is not None else None,
+                                  'droppedRows': (state.get('droppedRows', 0) if state is not None else 0) + dropped,
+                                  'tail': result.iloc[carry:].reset_index(drop=True)})
+
+        return newRows, dropped
+
+    def run(self, machine, machinePath, chunkRows=None):
+        """
+        Load the log files of a machine changed since its checkpoint and
+        analyze their new rows.
+        :param machine: Name of the machine.
+        :param machinePath: Folder with the log files of the machine.
+        :param chunkRows: Stream the logs in chunks of about this many rows
+                          (see FilesToDataframe.iterChunks) instead of loading
+                          them all, None loads them at once.
+        :return: (number of new rows processed, number of rows dropped because
+                 they were read after later rows of their chunk stream, see
+                 update).
+        """
+        state = self.loadState(machine)
+        loadStarted = time.time()
+        modifiedAfter = state['lastModified'] if state is not None else None
+
+        processed, dropped = 0, 0
+        if chunkRows:
+            # Every chunk is a regular update, the checkpoint carries the events across
+            # chunks. Rows up to the checkpoint of the previous run were analyzed then,
+            # older rows of a later chunk than the checkpoint are lost.
+            analyzedUntil = state['lastTimestamp'] if state is not None else pd.Timestamp.min
+            for chunk in FilesToDataframe(machinePath).iterChunks(chunkRows, modifiedAfter=modifiedAfter):
+                chunk['date'] = chunk['datetime'].dt.date
+                chunkProcessed, chunkDropped = self.update(machine, chunk, analyzedUntil)
+                processed += chunkProcessed
+                dropped += chunkDropped
+        else:
+            # As the chunks, rows older than the checkpoint of the previous run are
+            # only counted when they were not analyzed then
+            analyzedUntil = state['lastTimestamp'] if state is not None else pd.Timestamp.min
+            machineDF = FilesToDataframe(machinePath).createSingleDf(modifiedAfter=modifiedAfter)
+            if not machineDF.empty:
+                processed, dropped = self.update(machine, formatDate(machineDF), analyzedUntil)
+
+        # Files still being written when loading started are read again next time
+        state = self.loadState(machine)
+        if state is not None:
+            state['lastModified'] = loadStarted - 1
+            self._saveState(machine, state)
+
+        return processed, dropped
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Analyze the logs written since the last run.')
+    parser.add_argument('checkpoint', help='folder holding the checkpoints and results')
+    parser.add_argument('mainPath', help='folder with one log folder per machine')
+    parser.add_argument('machines', nargs='+', help='machines to analyze')
+    parser.add_argument('--chunk-rows', type=int, default=None,
+                        help='stream the logs in chunks of this many rows to bound the memory')
+    args = parser.parse_args()
+
+    analyzer = IncrementalAnalyzer(args.checkpoint)
+    for machine in args.machines:
+        processed, dropped = analyzer.run(machine, os.path.join(args.mainPath, machine), args.chunk_rows)
+        print(f"{machine}: {processed} new rows analyzed" + (f", {dropped} late rows dropped" if dropped else ''))
@@ -15,6 +15,9 @@ Created on Mon Mar 24 10:35:08 2025
                 and direction of movement across two home enclosures.
 """
 import os
+import sys
+import hashlib
+import argparse
 import pandas as pd
 import numpy as np
 from datetime import timedelta
@@ -22,6 +25,11 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 
 from FileManipulation import FilesToDataframe
+from EventIndex import EventIndex
+# The movement rules are shared with the online detector of the gates
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'RaspberryPi'))
+import MovementCodes
+from MovementCodes import IR_SEQUENCE_BITS, MAX_IR_SEQUENCE, encode_ir_sequence
 
 
 def formatDate(df):
@@ -31,18 +39,447 @@ def formatDate(df):
     # Extract the date part
     df['date'] = df['datetime'].dt.date
 
-    # Sort by date (important for accurate session assignment)
-    df = df.sort_values(by='date')
+    # Sort by date (important for accurate session assignment). The sort is
+    # stable: rows logged in the same ms keep the order of the files, so a
+    # part of the history is ordered as in the whole history
+    df = df.sort_values(by=['date', 'datetime'], kind='stable')
     
     return df
 
 def createSession(df):
-    df = df.sort_values('date').copy()
+    df = df.sort_values('date', kind='stable').copy()
     df['session'] = (df['date'].diff().dt.days.fillna(0) > 0).cumsum() + 1
     return df
 
+# Layout of the stable ids of segment_events
+MACHINE_KEY_BITS = 15
+TIE_BITS = 6
+
+def machine_key(values):
+    """
+    Stable MACHINE_KEY_BITS key of a machine (or of the values of the `by`
+    columns of segment_events), the same in every run and on every computer.
+    """
+    if not isinstance(values, tuple):
+        values = (values,)
+    digest = hashlib.blake2b('\x1f'.join(map(str, values)).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') & ((1 << MACHINE_KEY_BITS) - 1)
+
+def segment_events(df, by=('machineID',)):
+    """
+    Session and RFID event ids of the logs of one or several machines, that
+    only depend on the logs themselves: adding files, other machines or days
+    does not change the ids of the events already there, so results cached
+    per event stay valid and every machine can be processed on its own.
+
+    Both ids are int64 and sort in time order:
+      - session_id: days since 1970 << MACHINE_KEY_BITS | machine key
+      - event_id: ms since 1970 of the first RFID read of the event
+                  << (MACHINE_KEY_BITS + TIE_BITS) | machine key << TIE_BITS
+                  | number of earlier events of the machine starting in the
+                  same ms
+    An event is a run of consecutive RFID rows of the same machine.
+
+    Parameters:
+      df (pd.DataFrame): Logs with 'datetime', 'object' and the `by` columns.
+      by (tuple or list): Columns that tell the machines apart, empty for a single machine.
+
+    Returns:
+      pd.DataFrame: A copy of df sorted by `by` and 'datetime' with the int64
+                    'session_id' and the nullable Int64 'event_id' (set on the
+                    'rfid' rows only).
+    """
+    by = list(by or [])
+    df = df.sort_values(by + ['datetime'], kind='stable').reset_index(drop=True)
+
+    # Key of the machine of every row, only hashed once per machine
+    if by:
+        groups, machines = pd.factorize(pd.MultiIndex.from_frame(df[by]) if len(by) > 1 else df[by[0]])
+        keys = np.array([machine_key(machine) for machine in machines], dtype=np.int64)[groups]
+    else:
+        groups, keys = np.zeros(len(df), dtype=np.int64), np.zeros(len(df), dtype=np.int64)
+
+    times = df['datetime'].to_numpy().astype('datetime64[ms]')
+    days = times.astype('datetime64[D]').astype(np.int64)
+    df['session_id'] = (days << MACHINE_KEY_BITS) | keys
+
+    # A new event starts on every RFID row that does not follow an RFID row of its machine
+    is_rfid = (df['object'] == 'rfid').to_numpy()
+    same_machine = np.r_[False, groups[1:] == groups[:-1]]
+    starts = np.flatnonzero(is_rfid & ~(np.r_[False, is_rfid[:-1]] & same_machine))
+    start_ms = times[starts].astype(np.int64)
+    # Events of a machine starting in the same ms are numbered in row order
+    new_moment = np.r_[True, (start_ms[1:] != start_ms[:-1]) | (groups[starts][1:] != groups[starts][:-1])]
+    first = np.flatnonzero(new_moment)
+    tie = np.arange(len(starts)) - np.repeat(first, np.diff(np.r_[first, len(starts)]))
+    if len(tie) and tie.max() >= 1 << TIE_BITS:
+        raise ValueError(f"More than {1 << TIE_BITS} RFID events start in the same ms")
+    ids = (start_ms << (MACHINE_KEY_BITS + TIE_BITS)) | (keys[starts] << TIE_BITS) | tie
+
+    # Every RFID row takes the id of the start of its run
+    run = np.cumsum(np.isin(np.arange(len(df)), starts)) - 1
+    event_col = np.zeros(len(df), dtype=np.int64)
+    event_col[is_rfid] = ids[run[is_rfid]]
+    df['event_id'] = pd.arrays.IntegerArray(event_col, ~is_rfid)
+    return df
+
+def _expand_intervals(lo, hi):
+    """
+    Expand the positional intervals [lo[k], hi[k]) without looping over them
+    in Python.
+
+    Returns:
+      tuple: (positions, k) with every covered position and the index of the
+             interval that covers it.
+    """
+    lengths = np.maximum(hi - lo, 0)
+    owner = np.repeat(np.arange(len(lo)), lengths)
+    # Position of every covered row: start of its interval plus its offset in it
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return lo[owner] + offsets, owner
+
+def assign_ir_to_rfid_events(df, window=pd.Timedelta(seconds=2), by=None, index=None):
+    """
+    Extend every RFID event with the logs happening up to `window` before its
+    first RFID read and up to `window` after its last one.
+
+    A window never crosses an RFID row: the before window only keeps the logs
+    after the last RFID row inside it and the after window only keeps the logs
+    before the first RFID row inside it. Earlier events have precedence, so a
+    log that falls in the windows of two events stays with the earlier one.
+
+    Parameters:
+      df (pd.DataFrame): Logs with 'datetime', 'object' and an 'event_id'
+                         column that is set on the 'rfid' rows only.
+      window (pd.Timedelta): Size of the before and after windows.
+      by (list): Columns that tell the machines apart (e.g. ['machineID']),
+                 the windows of a machine only take its own logs.
+      index (EventIndex): Index of df with the same `by`, shared with the
+                          other windowed analyses. Built here if None.
+
+    Returns:
+      pd.DataFrame: A copy of df where the 'event_id' of the logs inside the
+                    windows is set to the id of their RFID event.
+    """
+    df = df.copy()
+    if index is None:
+        index = EventIndex(df, by=by, animal=None)
+    # The stable ids of segment_events are 64-bit integers, float64 would round them
+    integer = pd.api.types.is_integer_dtype(df['event_id'].dtype)
+    has_event = df['event_id'].notna().to_numpy(copy=True)
+    event_col = df['event_id'].to_numpy(dtype=np.int64 if integer else float,
+                                        na_value=0 if integer else np.nan, copy=True)
+    is_rfid = (df['object'] == 'rfid').to_numpy() & has_event
+    window = pd.Timedelta(window).value
+
+    for machine in index.machines:
+        # Positions below are in the time order of the machine
+        times, rows = index.segment(machine)
+        rfid_pos = np.flatnonzero(is_rfid[rows])
+        if rfid_pos.size == 0:
+            continue
+
+        # First and last row of every RFID event (consecutive RFID rows sharing an id)
+        rfid_ids = event_col[rows[rfid_pos]]
+        is_first = np.r_[True, rfid_ids[1:] != rfid_ids[:-1]]
+        is_last = np.r_[is_first[1:], True]
+        event_ids = rfid_ids[is_first]
+        start, end = times[rfid_pos[is_first]], times[rfid_pos[is_last]]
+        # Sentinels so that every window has a previous and a next RFID row
+        rfid_bounds = np.r_[-1, rfid_pos, len(rows)]
+
+        # BEFORE window: [start - window, start), after the last RFID row in it
+        before_lo = np.searchsorted(times, start - window, side='left')
+        before_hi = np.searchsorted(times, start, side='left')
+        last_rfid = rfid_bounds[np.searchsorted(rfid_bounds, before_hi, side='left') - 1]
+        before_lo = np.maximum(before_lo, last_rfid + 1)
+
+        # AFTER window: (end, end + window], before the first RFID row in it
+        after_lo = np.searchsorted(times, end, side='right')
+        after_hi = np.searchsorted(times, end + window, side='right')
+        first_rfid = rfid_bounds[np.searchsorted(rfid_bounds, after_lo, side='left')]
+        after_hi = np.minimum(after_hi, first_rfid)
+
+        # Events are processed in time order, each one with its before window
+        # first. Every log keeps the first window (lowest rank) that covers it.
+        lo = np.column_stack([before_lo, after_lo]).ravel()
+        hi = np.column_stack([before_hi, after_hi]).ravel()
+        positions, rank = _expand_intervals(lo, hi)
+        first_rank = np.full(len(rows), len(lo))
+        np.minimum.at(first_rank, positions, rank)
+        covered = np.flatnonzero(first_rank < len(lo))
+        event_col[rows[covered]] = event_ids[first_rank[covered] // 2]
+        has_event[rows[covered]] = True
+
+    df['event_id'] = pd.arrays.IntegerArray(event_col, ~has_event) if integer else event_col
+    return df
+
+# Labels indexed by the movement code stored in the lookup table
+MOVEMENTS = np.array(MovementCodes.MOVEMENTS, dtype=object)
+
+def _build_movement_table(max_length=MAX_IR_SEQUENCE):
+    """
+    Lookup table from every IR sequence code (see MovementCodes) up to
+    max_length logs to a movement (index in MOVEMENTS) and its confidence.
+    """
+    movement = np.zeros(1 << (max_length + 1), dtype=np.int8)
+    confidence = np.full(1 << (max_length + 1), np.nan)
+    for code in range(len(movement)):
+        movement[code], rule_confidence = MovementCodes.movement_of(code)
+        if rule_confidence is not None:
+            confidence[code] = rule_confidence
+    return movement, confidence
+
+MOVEMENT_TABLE, CONFIDENCE_TABLE = _build_movement_table()
+
+def _ir_sequence_codes(ir):
+    """
+    Code of the IR sequence of every event in ir (IR logs in time order with an
+    'event_id'). Events longer than MAX_IR_SEQUENCE get the code 0.
+    """
+    position = ir.groupby('event_id').cumcount().to_numpy()
+    bits = ir['object'].map(IR_SEQUENCE_BITS).to_numpy(dtype=np.int64)
+    bits = pd.Series(bits << np.minimum(position, MAX_IR_SEQUENCE), index=ir['event_id'].to_numpy())
+    grouped = bits.groupby(level=0)
+    length = grouped.size().to_numpy()
+    codes = grouped.sum().to_numpy() | np.left_shift(1, np.minimum(length, MAX_IR_SEQUENCE))
+    codes[length > MAX_IR_SEQUENCE] = 0
+    return pd.Series(codes, index=grouped.size().index)
+
+def classify_movements(df):
+    """
+    Label every event with the movement of the animal through the gate, based
+    on the order in which its IR beams were broken.
+
+    The IR sequence of every event is encoded with encode_ir_sequence and looked up
+    in MOVEMENT_TABLE, built from the rules in MovementCodes that the gates use
+    online. Events with intertwined innerIR and outerIR logs fall back
+    to the IR logs happening before their first RFID read, as most of the correct
+    IR logs happen before the animal is identified; a single crossing found there
+    gets a confidence of 0.8.
+
+    Parameters:
+      df (pd.DataFrame): Logs sorted by 'datetime', with 'object' and 'event_id'
+                         (see assign_ir_to_rfid_events).
+
+    Returns:
+      pd.DataFrame: A copy of df with two new columns:
+                    - movement: 'entered', 'exited', 'inSniff', 'outSniff',
+                      missing when the event cannot be classified.
+                    - confidence: Score from 0.0 to 1.0, NaN if not classified.
+    """
+    df = df.copy()
+    # The stable ids of segment_events are 64-bit integers, float64 would merge
+    # events of the same ms
+    integer = pd.api.types.is_integer_dtype(df['event_id'].dtype)
+    event_ids = df['event_id'].to_numpy(dtype=np.int64 if integer else float, na_value=0 if integer else np.nan)
+    is_event = df['event_id'].notna().to_numpy()
+    is_ir = df['object'].isin(IR_SEQUENCE_BITS).to_numpy() & is_event
+    is_rfid = (df['object'] == 'rfid').to_numpy() & is_event
+
+    # Flag the IR logs happening before the first RFID read of their event
+    row = np.arange(len(df))
+    first_rfid = pd.Series(row[is_rfid]).groupby(event_ids[is_rfid]).min()
+    before_rfid = row < pd.Series(event_ids).map(first_rfid).to_numpy(dtype=float, na_value=np.nan)
+
+    codes = _ir_sequence_codes(df[is_ir])
+    pre_codes = _ir_sequence_codes(df[is_ir & before_rfid]).reindex(codes.index, fill_value=0)
+
+    movement = MOVEMENT_TABLE[codes.to_numpy()]
+    confidence = CONFIDENCE_TABLE[codes.to_numpy()]
+    # Intertwined sequences: a single crossing before the RFID read
+    pre_movement = MOVEMENT_TABLE[pre_codes.to_numpy()]
+    fallback = (movement == 0) & ((pre_movement == 1) | (pre_movement == 2))
+    movement[fallback] = pre_movement[fallback]
+    confidence[fallback] = MovementCodes.FALLBACK_CONFIDENCE
+
+    # Position of the event of every row in codes, -1 (the trailing NaN) for the
+    # rows without IR logs
+    position = np.where(is_event, codes.index.get_indexer(event_ids), -1)
+    df['movement'] = pd.Series(np.append(MOVEMENTS[movement], np.nan)[position], index=df.index, dtype=object)
+    df['confidence'] = np.append(confidence, np.nan)[position]
+    return df
+
+# Movements through the gate, from one enclosure to the other
+CROSSINGS = ('entered', 'exited')
+
+def movement_events(df):
+    """
+    One row per animal and classified event of the logs: the movement table
+    (result_df) used by the crossing, co-movement and occupancy analyses.
+
+    Parameters:
+      df (pd.DataFrame): Logs labelled by classify_movements.
+
+    Returns:
+      pd.DataFrame: Sorted by 'time', with 'event_id', 'time' (first log of the
+                    event), 'monkey' (every animal read in the event), 'event'
+                    (the movement), 'confidence' and 'machineID' if df has it.
+    """
+    keys = ['machineID'] if 'machineID' in df else []
+    labelled = df[df['event_id'].notna() & df['movement'].notna()]
+    start = labelled.groupby('event_id')['datetime'].min()
+    rfid = labelled[labelled['object'] == 'rfid']
+    result_df = rfid[['event_id'] + keys + ['monkey', 'movement', 'confidence']].drop_duplicates(['event_id', 'monkey'])
+    result_df = result_df.rename(columns={'movement': 'event'})
+    result_df.insert(1, 'time', result_df['event_id'].map(start).to_numpy())
+    return result_df.sort_values(['time', 'event_id'], kind='stable').reset_index(drop=True)
+
+def _follower_pairs(result_df, window, same_direction, movements, index=None):
+    """
+    Every pair of crossings (i, j) of different animals where j happens within
+    `window` after i, through the same gate and, if same_direction, in the
+    same direction. The bounds of every window are found with searchsorted on
+    the sorted times, so the cost grows with the number of pairs and not with
+    the square of the crossings.
+
+    Returns:
+      tuple: (animal code of every row of result_df, -1 for the rows that are
+              not crossings, animal names, leading row of every pair,
+              following row of every pair)
+    """
+    if index is None:
+        index = movement_index(result_df)
+    crossing = result_df['event'].isin(movements).to_numpy() & result_df['monkey'].notna().to_numpy()
+    codes, animals = pd.factorize(result_df['monkey'].where(crossing), sort=True)
+    window = pd.Timedelta(window).value
+
+    groups = [(machine, [movement]) for machine in index.machines for movement in movements] if same_direction \
+        else [(machine, list(movements)) for machine in index.machines]
+    leaders, followers = [], []
+    for machine, kinds in groups:
+        times, rows = index.segment(machine, kinds)
+        # Followers of every crossing: (t, t + window]
+        lo = np.searchsorted(times, times, side='right')
+        hi = np.searchsorted(times, times + window, side='right')
+        positions, owner = _expand_intervals(lo, hi)
+        leaders.append(rows[owner])
+        followers.append(rows[positions])
+    leader = np.concatenate(leaders) if leaders else np.empty(0, dtype=np.int64)
+    follower = np.concatenate(followers) if followers else np.empty(0, dtype=np.int64)
+    other = (codes[leader] != codes[follower]) & (codes[leader] >= 0) & (codes[follower] >= 0)
+    return codes, np.asarray(animals), leader[other], follower[other]
+
+def movement_index(result_df):
+    """
+    EventIndex of a movement table (see movement_events), per gate when it
+    has a 'machineID', shared by the co-movement and leader analyses.
+    """
+    return EventIndex(result_df, time='time', kind='event', by=['machineID'] if 'machineID' in result_df else None)
+
+def co_movement_matrix(result_df, window=pd.Timedelta(seconds=10), same_direction=True, movements=CROSSINGS,
+                       index=None):
+    """
+    How many times every pair of animals moved through the gate together: the
+    second one crossed within `window` after the first one.
+
+    Parameters:
+      result_df (pd.DataFrame): Movements with 'time', 'monkey' and 'event' (see
+                                movement_events), 'machineID' to tell gates apart.
+      window (pd.Timedelta): Longest delay between the two crossings.
+      same_direction (bool): Only count crossings towards the same enclosure.
+      movements (tuple): Movements taken as crossings.
+      index (EventIndex): movement_index of result_df, built here if None.
+
+    Returns:
+      tuple: (N x N int64 symmetric matrix of counts, names of the N animals
+              indexing its rows and columns)
+    """
+    codes, animals, leader, follower = _follower_pairs(result_df, window, same_direction, movements, index)
+    n = len(animals)
+    pairs = np.bincount(codes[leader] * n + codes[follower], minlength=n * n).reshape(n, n)
+    return pairs + pairs.T, animals
+
+def leader_counts(result_df, window=pd.Timedelta(seconds=10), same_direction=True, movements=CROSSINGS,
+                  index=None):
+    """
+    How many times every animal led a group movement: each of its crossings
+    followed by a crossing of another animal within `window` counts once, as
+    in the original sketch. A crossing can both follow and lead, so every
+    animal of a chain but the last one gets credit; crossings of the same
+    animal do not count as followers.
+
+    Parameters: as co_movement_matrix.
+
+    Returns:
+      tuple: (int64 counts, names of the animals)
+    """
+    codes, animals, leader, follower = _follower_pairs(result_df, window, same_direction, movements, index)
+    leads = np.zeros(len(codes), dtype=bool)
+    leads[leader] = True
+    return np.bincount(codes[leads], minlength=len(animals)), animals
+
+# Enclosure an animal is in after every crossing, 0 is unknown in the grids
+CHAMBERS = {'entered': 1, 'exited': 2}
+
+def occupancy_intervals(result_df, end=None):
+    """
+    Where every animal was between its crossings: each crossing starts an
+    interval in the enclosure it leads to, that lasts until the next crossing
+    of the same animal.
+
+    Parameters:
+      result_df (pd.DataFrame): Movements with 'time', 'monkey' and 'event' (see
+                                movement_events), of a single gate.
+      end (pd.Timestamp): End of the last interval of every animal, by
+                          default the last crossing of result_df.
+
+    Returns:
+      pd.DataFrame: 'monkey', 'start', 'end' and uint8 'chamber' (CHAMBERS) of
+                    every interval, sorted by animal and start.
+    """
+    crossings = result_df[result_df['event'].isin(list(CHAMBERS)) & result_df['monkey'].notna()]
+    crossings = crossings.sort_values(['monkey', 'time'], kind='stable')
+    if end is None:
+        end = crossings['time'].max()
+    intervals = pd.DataFrame({'monkey': crossings['monkey'].to_numpy(),
+                              'start': crossings['time'].to_numpy(),
+                              'end': crossings.groupby('monkey', observed=True)['time'].shift(-1).to_numpy(),
+                              'chamber': crossings['event'].map(CHAMBERS).to_numpy(dtype=np.uint8)})
+    intervals['end'] = intervals['end'].fillna(pd.Timestamp(end))
+    return intervals
+
+def occupancy_grid(intervals, freq='1min', start=None, end=None):
+    """
+    Rasterize occupancy intervals into an animal x time bin matrix, for
+    heatmaps and presence queries. Every bin takes the chamber the animal was
+    in at its start.
+
+    Parameters:
+      intervals (pd.DataFrame): Output of occupancy_intervals.
+      freq (str): Size of the bins.
+      start, end (pd.Timestamp): Span of the grid, by default the span of the
+                                 intervals.
+
+    Returns:
+      tuple: (uint8 matrix of chambers, 0 where unknown, names of the animals
+              of its rows, pd.DatetimeIndex with the start of its bins)
+    """
+    codes, animals = pd.factorize(intervals['monkey'], sort=True)
+    step = pd.Timedelta(freq).value
+    origin = pd.Timestamp(start if start is not None else intervals['start'].min()).floor(freq)
+    last = pd.Timestamp(end if end is not None else intervals['end'].max())
+    bins = max(int(-(-(last - origin).value // step)), 0)
+
+    # Bins starting inside every interval: [ceil(start), ceil(end))
+    lo = -(-(intervals['start'] - origin).to_numpy().astype('timedelta64[ns]').astype(np.int64) // step)
+    hi = -(-(intervals['end'] - origin).to_numpy().astype('timedelta64[ns]').astype(np.int64) // step)
+    positions, owner = _expand_intervals(np.clip(lo, 0, bins), np.clip(hi, 0, bins))
+    grid = np.zeros((len(animals), bins), dtype=np.uint8)
+    grid[codes[owner], positions] = intervals['chamber'].to_numpy()[owner]
+    return grid, np.asarray(animals), pd.date_range(origin, periods=bins, freq=freq)
+
 if __name__ == '__main__':
     
+    parser = argparse.ArgumentParser(description='Analyze the movements logged by the monkey gates.')
+    parser.add_argument('--inspect', action='store_true',
+                        help='pause on every event to inspect its movement classification')
+    parser.add_argument('--store', default=None,
+                        help='read the logs from a session store (see FilesToDataframe.consolidateStore)')
+    parser.add_argument('--consolidate', action='store_true',
+                        help='refresh the session store from the raw logs before reading it')
+    args = parser.parse_args()
+    
     # Main folder that contains all data regarding the eSeesaw task
     mainPath = '/Volumes/G_IEA_PRS$/PS/2_ERC/AutomatedChallenges/MonkeyGate/pilotSessions'
     
@@ -57,6 +494,14 @@ if __name__ == '__main__':
         curPath = os.path.join(mainPath, machine)
         # Start helper libraries
         FTDF = FilesToDataframe(curPath)
+        
+        if args.store:
+            # Typed logs with precomputed sessions, no need to parse the raw files
+            if args.consolidate:
+                FTDF.consolidateStore(args.store, machine)
+            machineDataframes.append(FilesToDataframe.readStore(args.store, machines=[machine]))
+            continue
+        
         # Merge files to a single dataframe
         machineDF = FTDF.createSingleDf()
         # Add Machine name
@@ -70,12 +515,13 @@ if __name__ == '__main__':
     
     # Merges all dataframes from all machines in a single dataframe
     curDF = pd.concat(machineDataframes, ignore_index=True)
-    curDF = curDF.sort_values('datetime').reset_index(drop=True)
+    curDF = curDF.sort_values('datetime', kind='stable').reset_index(drop=True)
     # Remove non-sensor events (e.g., rows where object equals 'session')
     criDF = curDF[curDF['object'] != 'session'].reset_index(drop=True)
     
-    # Adds sessions across all machines based in days
-    curDF['global_session'] = (curDF['date'].diff().dt.days.fillna(0) > 0).cumsum() + 1
+    # Stable session (machine and day) and RFID event ids, that do not change
+    # when files or machines are added (see segment_events)
+    curDF = segment_events(curDF, by=['machineID'])
     
 
 
@@ -367,16 +813,9 @@ if __name__ == '__main__':
     
    
     # Jorge
+    # Every run of consecutive 'rfid' rows of a machine is an event, its
+    # event_id was set by segment_events
     df = curDF.copy()
-    # Create a boolean column identifying 'rfid' rows
-    df['is_rfid'] = df['object'] == 'rfid'
-    # Identify the start of a new 'rfid' event: a row is True and the previous row was not 'rfid'
-    df['event_id'] = (df['is_rfid'] & ~df['is_rfid'].shift(fill_value=False)).cumsum()
-    # Set event_id to NaN for rows that are not 'rfid'
-    df.loc[~df['is_rfid'], 'event_id'] = pd.NA
-    
-    # Remove the temporary boolean column if desired
-    df.drop(columns=['is_rfid'], inplace=True)
     
     # Take the easliest and latest rfid log per event and save the time difference in 
     # a column called 'idling_time'
@@ -386,33 +825,27 @@ if __name__ == '__main__':
     # plot the distribution of IR events happening before and after each rfid event.  
     
     # Group RFID rows by event_id to get the earliest (start) and latest (end) timestamp per event
-    rfid_events = df[df['object'] == 'rfid'].groupby('event_id').agg(start=('datetime', 'min'), end=('datetime', 'max')).reset_index()
+    rfid_events = df[df['object'] == 'rfid'].groupby('event_id').agg(start=('datetime', 'min'), end=('datetime', 'max'), machineID=('machineID', 'first')).reset_index()
     # Calculate idling_time (in seconds) for each RFID event
     rfid_events['idling_time'] = (rfid_events['end'] - rfid_events['start']).dt.total_seconds()
     # Merge the idling_time back into the main dataframe based on event_id
     df = df.merge(rfid_events[['event_id', 'idling_time']], on='event_id', how='left')
     
+    # Sorted index of the logs, shared by the windowed analyses below
+    index = EventIndex(df, by=['machineID'])
+    
     # ----
     # To know the distribution of IR events before and after of each RFID event
     # ----
-    # # Create a DataFrame with IR events
-    # ir_events = df[df['object'].isin(['innerIR', 'outerIR'])].copy().sort_values('datetime')
-    
-    # # Find the IR event immediately BEFORE the start of each RFID event using merge_asof
-    # rfid_before = pd.merge_asof(
-    #     rfid_events.sort_values('start'),
-    #     ir_events[['datetime']].rename(columns={'datetime': 'ir_before'}),
-    #     left_on='start', right_on='ir_before',
-    #     direction='backward')
-    # rfid_events['beforeIR'] = (rfid_events['start'] - rfid_before['ir_before']).dt.total_seconds()
-    
-    # # Find the IR event immediately AFTER the end of each RFID event using merge_asof
-    # rfid_after = pd.merge_asof(
-    #     rfid_events.sort_values('end'),
-    #     ir_events[['datetime']].rename(columns={'datetime': 'ir_after'}),
-    #     left_on='end', right_on='ir_after',
-    #     direction='forward')
-    # rfid_events['afterIR'] = (rfid_after['ir_after'] - rfid_events['end']).dt.total_seconds()
+    # # Find the IR event immediately BEFORE the start and AFTER the end of each RFID event
+    # times = df['datetime'].to_numpy()
+    # for machine in index.machines:
+    #     events = (rfid_events['machineID'] == machine).to_numpy()
+    #     start, end = rfid_events['start'][events].to_numpy(), rfid_events['end'][events].to_numpy()
+    #     ir_before = index.nearest_before(start, kinds=list(IR_SEQUENCE_BITS), machine=machine)
+    #     ir_after = index.nearest_after(end, kinds=list(IR_SEQUENCE_BITS), machine=machine)
+    #     rfid_events.loc[events, 'beforeIR'] = np.where(ir_before >= 0, (start - times[ir_before]) / np.timedelta64(1, 's'), np.nan)
+    #     rfid_events.loc[events, 'afterIR'] = np.where(ir_after >= 0, (times[ir_after] - end) / np.timedelta64(1, 's'), np.nan)
 
     # # Plot the distribution of the IR events before and after each RFID event
     # plt.figure(figsize=(12, 5))
@@ -436,130 +869,31 @@ if __name__ == '__main__':
     # ----- 
     # Parse RFID and IR events 
     # ----- 
-    # Sort the events by start time to ensure earlier events get precedence when assigning IR logs.
-    rfid_events.sort_values('start', inplace=True)
-    # Keep track of IR rows that have already been assigned
-    assigned_ir_indices = set()
-    
-   # Iterate over each RFID event to extend it with nearby IR logs.
-    for _, event in rfid_events.iterrows():
-        current_event = event['event_id']
-        t_first = event['start']
-        t_last = event['end']
-        
-        # Define the 2-second windows for before and after.
-        before_start = t_first - pd.Timedelta(seconds=2)
-        before_end = t_first
-        after_start = t_last
-        after_end = t_last + pd.Timedelta(seconds=2)
-        
-        # --- BEFORE window ---
-        candidates_before = df[(df['datetime'] >= before_start) & (df['datetime'] < before_end)]
-        candidates_before = candidates_before[~candidates_before.index.isin(assigned_ir_indices)]
-        
-        if 'rfid' in candidates_before['object'].values:
-            matches = candidates_before[candidates_before['object'] == 'rfid']
-            last_idx = matches.index[-1]
-            rfid_pos = candidates_before.index.get_loc(last_idx)
-            # Exclude the RFID row and everything before it
-            candidates_before = candidates_before.iloc[rfid_pos + 1:]
-        
-        df.loc[candidates_before.index, 'event_id'] = current_event
-        assigned_ir_indices.update(candidates_before.index)
-        
-        # --- AFTER window ---
-        candidates_after = df[(df['datetime'] > after_start) & (df['datetime'] <= after_end)]
-        candidates_after = candidates_after[~candidates_after.index.isin(assigned_ir_indices)]
-        
-        if 'rfid' in candidates_after['object'].values:
-            idx = (candidates_after['object'] == 'rfid').idxmax()
-            # Get the positional index of that label
-            rfid_pos = candidates_after.index.get_loc(idx)
-            # Exclude the RFID row and everything after it
-            candidates_after = candidates_after.iloc[:rfid_pos]
-        
-        df.loc[candidates_after.index, 'event_id'] = current_event
-        assigned_ir_indices.update(candidates_after.index)
+    # Extend every RFID event with the IR logs happening 2 seconds before and after
+    # it. Earlier events get precedence when assigning IR logs.
+    df = assign_ir_to_rfid_events(df, window=pd.Timedelta(seconds=2), by=['machineID'], index=index)
         
     # -----
     # Asign movement behavior
     # ----
-    # If single innerIR and outerIR confidence = 1.0 ENTER | EXIT
-    # If just innerIR or outerIR confidence = 1.0 SNIFF
-    # Temporary storage
-    movement_map = {}
-    confidence_map = {}
-    # Iterate over each RFID reading event to asign movement behavior
-    for event_id, event_df in df.groupby('event_id'):
-        
-        # Determine the order of IR sensor triggers (if any)
-        ir_events = event_df[event_df['object'].isin(['innerIR', 'outerIR'])].sort_values('datetime')
-        ir_order = ir_events['object'].tolist()
-        
-        # If all IR events are either only innerIR or outerIR. confidence = 1.0, movement = SNIFF
-        animal_movement = None
-        confidence      = None
-        if len(ir_events['object'].unique()) == 1:
-            if ir_order[0] == 'innerIR':
-                animal_movement = 'inSniff' 
-            else: 'outSniff'
-            confidence = 1.0
-        
-        # Count inner and outer
-        elif len(ir_events['object'].unique()) == 2 and len(ir_events) == 2:
-            # Determine direction
-            if ir_order == ['outerIR', 'innerIR']:
-                animal_movement = 'entered'
-            else: animal_movement = 'exited'
-            confidence = 1.0 
-            
-        # For those events that hold multiple innerIR and outerIR intertwined over time
-        # Based on the fact the most of the correct IR detected logs happen before
-        # the RFID logs. Priority will be given to IR logs happening before the RFID log
-        
-        # Which behaviors can be found?
-        # in -> out -> rfid -> in = animal exited and tail might have trigger the innerIR
-        
-        
-        # Given the problem that the combination of IR events can be big it is safer
-        # to plot the most common patterns across the data frame and based on that decide
-        # what to do with the movement asignation
-        
-        elif len(ir_events) > 2:
-            # First work on IR that happen before the RFID logs
-            matches = event_df[event_df['object'] == 'rfid']
-            first_idx = matches.index[0]
-            rfid_pos = event_df.index.get_loc(first_idx)
-            # Exclude the RFID row and everything after it
-            multiEvent_df = event_df.iloc[:rfid_pos]
-
-            # Now work with the upper part of the IR logs
-            if len(multiEvent_df['object'].unique()) == 2 and len(ir_events) == 2:
-                # Determine direction
-                if ir_order == ['outerIR', 'innerIR']:
-                    animal_movement = 'entered'
-                else: animal_movement = 'exited'
-                confidence = 1.0 
-                
-        
-        # # Store the results for this event
-        # movement_map[event_id] = animal_movement
-        # confidence_map[event_id] = confidence
-        
-        # Manual inspection: show candidates and pause before continuing.
-        input(
-            f"Processed event {event_id}.\n\n"
-            f"Processed group {event_df}.\n\n"
-            f"Processed ir events {ir_events}.\n\n"
-            f"Processed ir order {ir_order}.\n\n"
-            f"Animal movement: {animal_movement}.\n\n"
-            f"Confidence: {confidence}.\n\n"
-            "=============================="
-            "Press Enter to continue to the next event..."
-            )
-    # # Assign back to df using map
-    # df['movement'] = df['event_id'].map(movement_map)
-    # df['confidence'] = df['event_id'].map(confidence_map)
+    # Every event is labelled from the order of its IR logs (see classify_movements)
+    df = classify_movements(df)
+    # One row per animal and movement
+    result_df = movement_events(df)
+    
+    # Manual inspection: show every event and pause before continuing.
+    if args.inspect:
+        for event_id, event_df in df.groupby('event_id'):
+            ir_events = event_df[event_df['object'].isin(IR_SEQUENCE_BITS)]
+            input(
+                f"Processed event {event_id}.\n\n"
+                f"Processed group {event_df}.\n\n"
+                f"Processed ir order {ir_events['object'].tolist()}.\n\n"
+                f"Animal movement: {event_df['movement'].iloc[0]}.\n\n"
+                f"Confidence: {event_df['confidence'].iloc[0]}.\n\n"
+                "=============================="
+                "Press Enter to continue to the next event..."
+                )
     
         # # # --- BEFORE window ---
         # # # Check for conflicting RFID logs (from a different event) in the before window.
@@ -686,8 +1020,10 @@ if __name__ == '__main__':
     # result_df['chamber'] = result_df['event'].map({'entered': 1, 'exited': 2})
     
     # # Heatmap of monkey presence in chambers over time
-    # # Pivot table: rows = monkeys, columns = timestamps, values = chamber
-    # location_timeline = result_df.pivot(index='monkey', columns='time', values='chamber')
+    # # Rows = monkeys, columns = one minute bins, values = chamber
+    # intervals = occupancy_intervals(result_df)
+    # grid, animals, bins = occupancy_grid(intervals, freq='1min')
+    # location_timeline = pd.DataFrame(grid, index=animals, columns=bins)
     
     # # Plot heatmap of chamber presence
     # plt.figure(figsize=(12, 4))
@@ -713,22 +1049,7 @@ if __name__ == '__main__':
     
     
     # # Calculate time spent in each chamber before switching
-    # residence_times = []
-    
-    # for monkey, group in result_df.groupby('monkey'):
-    #     group = group.sort_values('time')
-    #     for i in range(1, len(group)):
-    #         prev = group.iloc[i - 1]
-    #         curr = group.iloc[i]
-    #         if prev['chamber'] != curr['chamber']:
-    #             duration = (curr['time'] - prev['time']).total_seconds()
-    #             residence_times.append({
-    #                 'monkey': monkey,
-    #                 'chamber': prev['chamber'],
-    #                 'duration_seconds': duration
-    #             })
-    
-    # residence_df = pd.DataFrame(residence_times)
+    # residence_df = intervals.assign(duration_seconds=(intervals['end'] - intervals['start']).dt.total_seconds())
     
     # # Plot boxplot of residence time
     # plt.figure(figsize=(8, 5))
@@ -740,35 +1061,14 @@ if __name__ == '__main__':
     # plt.tight_layout()
     
     
-    # from collections import defaultdict
-
     # # Detect monkey pairs that move together into the same chamber within a time window
     # time_threshold = pd.Timedelta(seconds=10)
-    # group_movements = []
-    
-    # for i in range(len(result_df)):
-    #     curr = result_df.iloc[i]
-    #     monkey = curr['monkey']
-    #     chamber = curr['chamber']
-    #     event = curr['event']
-    #     t_start = curr['time']
-    
-    #     # Find others who made same move to same chamber within threshold
-    #     window = result_df[(result_df['time'] > t_start) &
-    #                        (result_df['time'] <= t_start + time_threshold) &
-    #                        (result_df['event'] == event) &
-    #                        (result_df['chamber'] == chamber)]
-    
-    #     for _, other in window.iterrows():
-    #         if other['monkey'] != monkey:
-    #             pair = tuple(sorted([monkey, other['monkey']]))
-    #             group_movements.append(pair)
-    
-    # # Count how many times each pair moved together
-    # from collections import Counter
-    # pair_counts = Counter(group_movements)
-    
-    # pair_df = pd.DataFrame([{'monkey1': k[0], 'monkey2': k[1], 'count': v} for k, v in pair_counts.items()])
+    # movements = movement_index(result_df)
+    # pair_matrix, animals = co_movement_matrix(result_df, time_threshold, same_direction=True, index=movements)
+    # first, second = np.triu_indices(len(animals), k=1)
+    # pair_df = pd.DataFrame({'monkey1': animals[first], 'monkey2': animals[second],
+    #                         'count': pair_matrix[first, second]})
+    # pair_df = pair_df[pair_df['count'] > 0]
     
     # # Plot pairwise co-movements
     # plt.figure(figsize=(8, 5))
@@ -780,25 +1080,8 @@ if __name__ == '__main__':
     # plt.tight_layout()
 
     # # Count how often each monkey initiated a group movement
-    # leader_counts = defaultdict(int)
-    
-    # for i in range(len(result_df)):
-    #     curr = result_df.iloc[i]
-    #     monkey = curr['monkey']
-    #     chamber = curr['chamber']
-    #     event = curr['event']
-    #     time = curr['time']
-    
-    #     # Who follows this monkey within 10s doing same thing
-    #     group_window = result_df[(result_df['time'] > time) &
-    #                              (result_df['time'] <= time + time_threshold) &
-    #                              (result_df['event'] == event) &
-    #                              (result_df['chamber'] == chamber)]
-    
-    #     if not group_window.empty:
-    #         leader_counts[monkey] += 1
-    
-    # leader_df = pd.DataFrame(list(leader_counts.items()), columns=['monkey', 'lead_count'])
+    # leads, animals = leader_counts(result_df, time_threshold, same_direction=True, index=movements)
+    # leader_df = pd.DataFrame({'monkey': animals, 'lead_count': leads})
     
     # # Plot leaders
     # plt.figure(figsize=(8, 5))
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Thu May 22 09:18:26 2025
+
+@author: J. Cabrera-Moreno
+    Postdoctoral Fellow
+    Evolutionary Cognition Group
+    Institute of Evolutionary Anthropology
+    University of Zurich
+
+    Description: Runs the MovementAnalysis pipeline (event ids, IR windows and
+                movement classification) on every core, one partition per
+                machine and day of the session store (see
+                FilesToDataframe.consolidateStore).
+
+                Days are not cut at midnight but at the first safe cut after
+                it: a log that is not an RFID read and follows a silence longer
+                than two windows. No RFID event, window or tie of event ids
+                crosses a safe cut, so every partition gives the same rows as
+                analyzing the whole history at once. The cuts are searched in
+                a margin around midnight that grows until one is found, and
+                days without a safe cut are analyzed with the day before.
+                Partitions are merged in (machine, time) order, the order of
+                the serial analysis.
+
+                python3 ParallelAnalysis.py store Lima Kiwi --workers 32 --output results.pkl
+"""
+import os
+import glob
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+from FileManipulation import FilesToDataframe
+from MovementAnalysis import segment_events, assign_ir_to_rfid_events, classify_movements
+
+# Size of the before and after windows of every RFID event
+WINDOW = pd.Timedelta(seconds=2)
+# Margin around midnight searched for a safe cut, doubled until MAX_MARGIN
+MARGIN = pd.Timedelta(hours=1)
+MAX_MARGIN = pd.Timedelta(hours=12)
+
+
+def storeDays(storePath, machine):
+    """
+    Days of a machine in the session store, from its partition folders.
+    :return: Sorted list of pd.Timestamp (midnights).
+    """
+    folders = glob.glob(os.path.join(storePath, f"machineID={machine}", 'day=*'))
+    return sorted(pd.Timestamp(os.path.basename(folder)[len('day='):]) for folder in folders)
+
+
+def safeCut(storePath, machine, midnight, window=WINDOW, margin=MARGIN, maxMargin=MAX_MARGIN):
+    """
+    First safe cut at or after midnight: the time of a log that is not an RFID
+    read and comes more than 2 * window after the log before it.
+    :param storePath: Folder of the session store.
+    :param machine: Name of the machine.
+    :param midnight: Start of the day.
+    :param window: Size of the before and after windows of every RFID event.
+    :param margin: First margin searched after midnight, doubled until maxMargin.
+    :return: Timestamp of the cut, None if there is none before midnight + maxMargin.
+    """
+    midnight = pd.Timestamp(midnight)
+    gap = 2 * pd.Timedelta(window).value
+    while True:
+        # The margin before midnight has the logs before the first candidates
+        logs = FilesToDataframe.readStore(storePath, columns=['object'], machines=[machine],
+                                          start=midnight - margin, end=midnight + margin)
+        times = logs['datetime'].to_numpy().astype('datetime64[ns]').astype(np.int64)
+        # The log before the first one read is older than midnight - margin,
+        # more than 2 * window before any candidate
+        previous = np.r_[(midnight - margin).value - gap - 1, times[:-1]]
+        safe = (times >= midnight.value) & (times - previous > gap) & (logs['object'] != 'rfid').to_numpy()
+        if safe.any():
+            return logs['datetime'].iloc[safe.argmax()]
+        if margin >= maxMargin:
+            return None
+        margin = min(2 * margin, maxMargin)
+
+
+def consolidateMachine(mainPath, storePath, machine):
+    """
+    Refresh the partitions of a machine in the session store from its raw logs.
+    """
+    FilesToDataframe(os.path.join(mainPath, machine)).consolidateStore(storePath, machine)
+
+
+def analyzePartition(storePath, machine, start, end, window=WINDOW):
+    """
+    Analysis of the logs of a machine between two safe cuts.
+    :param start: First timestamp (inclusive), None for the first log.
+    :param end: Last timestamp (exclusive), None for the last log.
+    :return: DataFrame with 'session_id', 'event_id', 'movement' and 'confidence'.
+    """
+    df = FilesToDataframe.readStore(storePath, machines=[machine], start=start, end=end)
+    if df.empty:
+        return df
+    df['machineID'] = df['machineID'].astype(str)
+    df = segment_events(df, by=['machineID'])
+    df = assign_ir_to_rfid_events(df, window, by=['machineID'])
+    return classify_movements(df)
+
+
+def planPartitions(storePath, machines, window=WINDOW, executor=None):
+    """
+    Partitions of the machines, one per day unless a day has no safe cut.
+    :return: List of (machine, start, end) in (machine, time) order.
+    """
+    boundaries = [(machine, day) for machine in machines for day in storeDays(storePath, machine)[1:]]
+    mapper = executor.map if executor is not None else map
+    cuts = list(mapper(safeCut, [storePath] * len(boundaries), [machine for machine, _ in boundaries],
+                       [day for _, day in boundaries], [window] * len(boundaries)))
+    cutsOf = {machine: [] for machine in machines}
+    for (machine, _), cut in zip(boundaries, cuts):
+        if cut is not None:
+            cutsOf[machine].append(cut)
+
+    partitions = []
+    for machine in machines:
+        if not storeDays(storePath, machine):
+            continue
+        bounds = [None] + cutsOf[machine] + [None]
+        partitions.extend((machine, start, end) for start, end in zip(bounds[:-1], bounds[1:]))
+    return partitions
+
+
+def runParallel(storePath, machines, window=WINDOW, workers=None):
+    """
+    Analyze the machines of the session store on `workers` processes.
+    :param storePath: Folder of the session store.
+    :param machines: Names of the machines.
+    :param window: Size of the before and after windows of every RFID event.
+    :param workers: Number of processes, None for one per core.
+    :return: DataFrame sorted by machine and datetime, as the serial analysis.
+    """
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        partitions = planPartitions(storePath, machines, window, executor)
+        results = list(executor.map(analyzePartition, [storePath] * len(partitions),
+                                    *zip(*partitions) if partitions else ([], [], []), [window] * len(partitions)))
+    results = [result for result in results if not result.empty]
+    if not results:
+        return pd.DataFrame()
+    # Partitions come in the order of the machines given, the serial analysis sorts them
+    merged = pd.concat(results, ignore_index=True)
+    return merged.sort_values(['machineID', 'datetime'], kind='stable', ignore_index=True)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Analyze the machines of a session store on every core.')
+    parser.add_argument('store', help='folder of the session store')
+    parser.add_argument('machines', nargs='+', help='machines to analyze')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes, one per core by default')
+    parser.add_argument('--consolidate', default=None,
+                        help='folder with one log folder per machine, to refresh the store first')
+    parser.add_argument('--output', default='results.pkl', help='pickle file to write the results to')
+    args = parser.parse_args()
+
+    if args.consolidate:
+        # Every machine writes its own partitions
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            list(executor.map(consolidateMachine, [args.consolidate] * len(args.machines),
+                              [args.store] * len(args.machines), args.machines))
+
+    results = runParallel(args.store, args.machines, workers=args.workers)
+    results.to_pickle(args.output)
+    print(f"{args.output}: {len(results)} rows of {len(args.machines)} machines")
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon May 12 09:27:45 2025
+
+@author: J. Cabrera-Moreno
+    Postdoctoral Fellow
+    Evolutionary Cognition Group
+    Institute of Evolutionary Anthropology
+    University of Zurich
+
+    Description: Scaling benchmark of the MovementAnalysis pipeline. Synthetic
+                gate logs are built by resampling the bursts of activity of
+                sample.csv (so the IR/RFID interleavings are real ones) with
+                a larger pool of animals, written as raw daily log files, and
+                every stage of the pipeline is timed separately with its
+                wall time and peak memory.
+
+                python3 PipelineBenchmark.py --rows 10000 100000 1000000 --output scaling.json
+"""
+import os
+import gc
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+from FileManipulation import FilesToDataframe
+from MovementAnalysis import formatDate, createSession, segment_events, assign_ir_to_rfid_events, classify_movements, _expand_intervals
+
+SAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sample.csv')
+# Silence that separates two bursts of activity in sample.csv
+BURST_GAP = pd.Timedelta(seconds=10)
+# Objects logged by the gates, as stored in the synthetic logs
+OBJECTS = np.array(['outerIR', 'innerIR', 'rfid'])
+
+
+def _sampleBursts(samplePath=SAMPLE):
+    """
+    Bursts of activity of sample.csv.
+    :return: (offset of every row from the start of its burst in ns, object
+             code, animal code, start row of every burst, end row of every burst)
+    """
+    sample = pd.read_csv(samplePath)
+    sample = sample[sample['object'].isin(OBJECTS)]
+    times = pd.to_datetime(sample['datetime']).to_numpy()
+    order = np.argsort(times, kind='stable')
+    times = times[order]
+    objects = pd.Categorical(sample['object'].to_numpy()[order], categories=OBJECTS).codes
+    animals = pd.factorize(sample['animal'].fillna('-').to_numpy()[order])[0]
+
+    start = np.flatnonzero(np.r_[True, np.diff(times) > BURST_GAP.to_timedelta64()])
+    end = np.r_[start[1:], len(times)]
+    burst = np.repeat(np.arange(len(start)), end - start)
+    offsets = (times - times[start][burst]).astype(np.int64)
+    return offsets, objects, animals, start, end
+
+
+def synthesizeLogs(rows, path, animals=12, rowsPerDay=20000, seed=0, samplePath=SAMPLE):
+    """
+    Write raw gate logs (one file per day) with about `rows` rows, made of
+    bursts of sample.csv placed at random times.
+    :param rows: Number of IR and RFID rows to write.
+    :param path: Folder where the log files are written.
+    :param animals: Number of animals in the group.
+    :param rowsPerDay: Average number of rows logged per day.
+    :param seed: Seed of the random generator.
+    :return: Number of files written.
+    """
+    rng = np.random.default_rng(seed)
+    offsets, objects, sampleAnimals, start, end = _sampleBursts(samplePath)
+
+    # Pick bursts until there are enough rows
+    length = end - start
+    picks = rng.integers(0, len(start), int(rows / length.mean() * 1.1) + 1)
+    picks = picks[:np.searchsorted(np.cumsum(length[picks]), rows) + 1]
+    positions, owner = _expand_intervals(start[picks], end[picks])
+    positions, owner = positions[:rows], owner[:rows]
+
+    # Bursts start after exponential silences, tuned to rowsPerDay
+    meanGap = 86400e9 * length.mean() / rowsPerDay
+    duration = offsets[end - 1][picks]
+    burstStart = np.cumsum(rng.exponential(meanGap, len(picks)).astype(np.int64) + np.r_[0, duration[:-1]])
+    times = np.datetime64('2024-01-01T06:00:00', 'ns') + burstStart[owner] + offsets[positions]
+
+    # Every burst gets its own animals from the group
+    names = np.array([f"animal{i:02d}" for i in range(animals)])
+    tags = np.array([f"{rng.integers(0, 2**63):016x}" for _ in range(animals)])
+    shift = rng.integers(0, animals, len(picks))
+    animal = (sampleAnimals[positions] + shift[owner]) % animals
+    isRfid = objects[positions] == 2
+
+    df = pd.DataFrame({'datetime': times,
+                       'object': OBJECTS[objects[positions]],
+                       'state': np.where(isRfid, tags[animal], 'broke'),
+                       'monkey': np.where(isRfid, names[animal], '-')})
+    # Gate date format: YYYYMMDDHHMMSSffff
+    dt = df['datetime'].dt
+    date = dt.year.astype(np.int64)
+    for part in (dt.month, dt.day, dt.hour, dt.minute, dt.second):
+        date = date * 100 + part.astype(np.int64)
+    df['date'] = date * 10**4 + dt.microsecond // 100
+
+    if not os.path.exists(path):
+        os.makedirs(path)
+    files = 0
+    for day, dayDF in df.groupby(df['datetime'].dt.date):
+        # Every file starts with the session start, as written by the gate
+        session = pd.DataFrame({'date': [dayDF['date'].iloc[0]], 'object': ['session'],
+                                'state': ['start'], 'monkey': ['-']})
+        pd.concat([session, dayDF[['date', 'object', 'state', 'monkey']]]).to_csv(
+            os.path.join(path, f"{day:%Y%m%d}060000.txt"), index=False)
+        files += 1
+    return files
+
+
+def assignEventIds(df):
+    """
+    Stable session and RFID event ids, as computed by the main script of
+    MovementAnalysis (a single machine here).
+    """
+    return segment_events(df, by=[])
+
+
+# Stages of the pipeline, in order, every one gets the output of the previous one
+STAGES = [
+    ('createSingleDf', lambda path: FilesToDataframe(path, cachePath=None).createSingleDf()),
+    ('formatDate', formatDate),
+    ('createSession', createSession),
+    ('eventIds', assignEventIds),
+    ('assignWindows', assign_ir_to_rfid_events),
+    ('classifyMovements', classify_movements),
+]
+
+
+def runStage(function, data, memory=True):
+    """
+    Time a stage and, in a second run on a copy of its input, measure its
+    peak memory (tracemalloc slows the run down, so it is not timed).
+    :return: (output of the stage, seconds, peak MB or None)
+    """
+    gc.collect()
+    started = time.perf_counter()
+    output = function(data.copy() if isinstance(data, pd.DataFrame) else data)
+    seconds = time.perf_counter() - started
+
+    peak = None
+    if memory:
+        copy = data.copy() if isinstance(data, pd.DataFrame) else data
+        gc.collect()
+        tracemalloc.start()
+        function(copy)
+        peak = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    return output, seconds, peak
+
+
+def benchmark(rows, workPath, animals=12, rowsPerDay=20000, memory=True, seed=0):
+    """
+    Synthesize a log of `rows` rows and run every stage on it.
+    :return: Dictionary with the seconds, rows per second and peak MB of every stage.
+    """
+    logPath = os.path.join(workPath, f"rows{rows}")
+    files = synthesizeLogs(rows, logPath, animals, rowsPerDay, seed)
+
+    data = logPath
+    stages = {}
+    for name, function in STAGES:
+        data, seconds, peak = runStage(function, data, memory)
+        stages[name] = {'seconds': seconds, 'rows_per_second': rows / seconds if seconds else None,
+                        'peak_mb': peak}
+    return {'rows': rows, 'files': files, 'animals': animals, 'stages': stages}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark every stage of the MovementAnalysis pipeline.')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10**4, 10**5, 10**6],
+                        help='sizes of the synthetic logs (e.g. 10000 100000 1000000 10000000)')
+    parser.add_argument('--animals', type=int, default=12, help='animals in the group')
+    parser.add_argument('--rows-per-day', type=int, default=20000, help='rows logged per day')
+    parser.add_argument('--no-memory', action='store_true', help='skip the peak memory runs')
+    parser.add_argument('--work', default=None, help='folder for the synthetic logs (temporary by default)')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    workPath = args.work or tempfile.mkdtemp(prefix='MonkeyGateBenchmark')
+    results = []
+    try:
+        for rows in args.rows:
+            result = benchmark(rows, workPath, args.animals, args.rows_per_day, not args.no_memory)
+            results.append(result)
+            print(f"{rows} rows, {result['files']} files")
+            for name, stage in result['stages'].items():
+                peak = f"{stage['peak_mb']:10.1f} MB" if stage['peak_mb'] is not None else ''
+                print(f"    {name:<18} {stage['seconds']:10.3f} s {stage['rows_per_second']:14.0f} rows/s {peak}")
+    finally:
+        if args.work is None:
+            shutil.rmtree(workPath, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as doc:
+            json.dump(results, doc, indent=2)
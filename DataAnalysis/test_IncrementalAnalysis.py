@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of IncrementalAnalysis: analyzing the history in several runs gives the
+same rows as analyzing it at once.
+
+    python3 -m pytest test_IncrementalAnalysis.py
+"""
+import os
+import numpy as np
+import pandas as pd
+
+from MovementAnalysis import formatDate
+from IncrementalAnalysis import IncrementalAnalyzer, analyzeMachine
+
+SAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sample.csv')
+
+
+def gate_logs():
+    """
+    The rows of sample.csv as read from the log files of a gate, in log order.
+    Many IR and RFID rows share their ms.
+    """
+    sample = pd.read_csv(SAMPLE, index_col=0)
+    moments = pd.to_datetime(sample['datetime'])
+    df = pd.DataFrame({'date': moments.dt.strftime('%Y%m%d%H%M%S%f').str[:18].astype('int64'),
+                       'object': sample['object'],
+                       'state': np.where(sample['object'] == 'rfid', '0dcc92eb68bd0001', 'broke'),
+                       'monkey': sample['animal']})
+    df['machineID'] = 'Lima'
+    return df
+
+
+def labels(series):
+    return [None if pd.isna(value) else value for value in series]
+
+
+def test_runs_on_growing_logs_match_the_full_analysis(tmp_path):
+    logs = gate_logs()
+    moments = formatDate(logs.copy())['datetime']
+    assert moments.duplicated().any()
+    full = analyzeMachine(formatDate(logs.copy()))
+
+    # Every run reads the logs written so far, in file order
+    analyzer = IncrementalAnalyzer(tmp_path)
+    for rows in np.linspace(0, len(logs), 12).astype(int)[1:]:
+        analyzer.update('Lima', formatDate(logs.iloc[:rows].copy()))
+    result = analyzer.results('Lima')
+
+    assert len(result) == len(full)
+    for col in ('datetime', 'object', 'event_id', 'movement'):
+        assert labels(result[col]) == labels(full[col]), col
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of MovementAnalysis: the RFID/IR event-window assignment against the
+row-by-row loop it replaced, and the group movement analyses.
+
+    python3 -m pytest test_MovementAnalysis.py
+"""
+import os
+import numpy as np
+import pandas as pd
+
+from MovementAnalysis import assign_ir_to_rfid_events, co_movement_matrix, leader_counts
+
+SAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sample.csv')
+
+
+def reference_assign(df, window=pd.Timedelta(seconds=2)):
+    """
+    The original loop of the analysis: every RFID event, in start order, takes
+    the unassigned logs of its before and after windows. Events starting at
+    the same instant keep log order (the original used an unstable sort).
+    """
+    df = df.copy()
+    rfid_events = df[df['object'] == 'rfid'].groupby('event_id').agg(start=('datetime', 'min'),
+                                                                     end=('datetime', 'max')).reset_index()
+    rfid_events = rfid_events.sort_values('start', kind='stable')
+    assigned_ir_indices = set()
+
+    for _, event in rfid_events.iterrows():
+        current_event = event['event_id']
+        t_first = event['start']
+        t_last = event['end']
+
+        # --- BEFORE window ---
+        candidates_before = df[(df['datetime'] >= t_first - window) & (df['datetime'] < t_first)]
+        candidates_before = candidates_before[~candidates_before.index.isin(assigned_ir_indices)]
+        if 'rfid' in candidates_before['object'].values:
+            matches = candidates_before[candidates_before['object'] == 'rfid']
+            rfid_pos = candidates_before.index.get_loc(matches.index[-1])
+            candidates_before = candidates_before.iloc[rfid_pos + 1:]
+        df.loc[candidates_before.index, 'event_id'] = current_event
+        assigned_ir_indices.update(candidates_before.index)
+
+        # --- AFTER window ---
+        candidates_after = df[(df['datetime'] > t_last) & (df['datetime'] <= t_last + window)]
+        candidates_after = candidates_after[~candidates_after.index.isin(assigned_ir_indices)]
+        if 'rfid' in candidates_after['object'].values:
+            rfid_pos = candidates_after.index.get_loc((candidates_after['object'] == 'rfid').idxmax())
+            candidates_after = candidates_after.iloc[:rfid_pos]
+        df.loc[candidates_after.index, 'event_id'] = current_event
+        assigned_ir_indices.update(candidates_after.index)
+
+    return df
+
+
+def rfid_runs(df):
+    """
+    The event ids of the original analysis: a new id on every run of
+    consecutive RFID rows, NaN on the other rows.
+    """
+    df = df.copy()
+    is_rfid = df['object'] == 'rfid'
+    df['event_id'] = (is_rfid & ~is_rfid.shift(fill_value=False)).cumsum().astype(float)
+    df.loc[~is_rfid, 'event_id'] = np.nan
+    return df
+
+
+def logs(rows):
+    """
+    Logs from (seconds, object) pairs, sorted by time.
+    """
+    df = pd.DataFrame(rows, columns=['seconds', 'object'])
+    df['datetime'] = pd.Timestamp('2025-04-04 12:00') + pd.to_timedelta(df.pop('seconds'), unit='s')
+    return rfid_runs(df)
+
+
+def test_sample_matches_reference():
+    df = pd.read_csv(SAMPLE, index_col=0)
+    df['datetime'] = pd.to_datetime(df['datetime'])
+    df = rfid_runs(df.sort_values('datetime', kind='stable').reset_index(drop=True))
+
+    expected = reference_assign(df)
+    assert expected['event_id'].notna().sum() > (df['object'] == 'rfid').sum()
+    pd.testing.assert_frame_equal(assign_ir_to_rfid_events(df), expected)
+
+
+def test_no_ir_rows():
+    df = logs([(0, 'rfid'), (0.5, 'rfid'), (1, 'session'), (10, 'rfid')])
+    result = assign_ir_to_rfid_events(df)
+    pd.testing.assert_frame_equal(result, reference_assign(df))
+    assert result['event_id'].tolist() == [1.0, 1.0, 1.0, 2.0]
+
+
+def test_no_rfid_rows():
+    df = logs([(0, 'innerIR'), (0.5, 'outerIR'), (1, 'session')])
+    result = assign_ir_to_rfid_events(df)
+    pd.testing.assert_frame_equal(result, reference_assign(df))
+    assert result['event_id'].isna().all()
+
+
+def test_window_boundaries():
+    # Windows are [start - 2 s, start) and (end, end + 2 s]
+    df = logs([(7.999, 'outerIR'), (8, 'innerIR'), (10, 'rfid'), (11, 'rfid'),
+               (13, 'outerIR'), (13.001, 'innerIR')])
+    result = assign_ir_to_rfid_events(df)
+    pd.testing.assert_frame_equal(result, reference_assign(df))
+    assert result['event_id'].isna().tolist() == [True, False, False, False, False, True]
+
+
+def test_windows_stop_at_rfid_rows_and_earlier_events_win():
+    df = logs([(0, 'rfid'), (0.5, 'innerIR'), (1, 'outerIR'), (1.5, 'rfid'), (2, 'innerIR')])
+    result = assign_ir_to_rfid_events(df)
+    pd.testing.assert_frame_equal(result, reference_assign(df))
+    assert result['event_id'].tolist() == [1.0, 1.0, 1.0, 2.0, 2.0]
+
+
+def crossings(rows):
+    """
+    Movement table from (seconds, monkey, event) triples.
+    """
+    df = pd.DataFrame(rows, columns=['seconds', 'monkey', 'event'])
+    df.insert(0, 'time', pd.Timestamp('2025-04-04 12:00') + pd.to_timedelta(df.pop('seconds'), unit='s'))
+    return df
+
+
+def test_leaders_of_a_chain():
+    # A leads B and C, B leads C, C only follows, then C crosses back alone
+    df = crossings([(0, 'A', 'entered'), (3, 'B', 'entered'), (6, 'C', 'entered'),
+                    (30, 'C', 'exited'), (33, 'C', 'entered'), (60, 'A', 'exited')])
+    counts, animals = leader_counts(df, window=pd.Timedelta(seconds=10))
+    assert animals.tolist() == ['A', 'B', 'C']
+    assert counts.tolist() == [1, 1, 0]
+
+    # Crossings of the same animal are not followers in any direction
+    counts, _ = leader_counts(df, window=pd.Timedelta(seconds=10), same_direction=False)
+    assert counts.tolist() == [1, 1, 0]
+
+    pairs, _ = co_movement_matrix(df, window=pd.Timedelta(seconds=10))
+    assert pairs.tolist() == [[0, 1, 1], [1, 0, 1], [1, 1, 0]]
+
+
+def test_every_crossing_of_a_leader_counts():
+    # A leads twice, B once; directions are counted apart
+    df = crossings([(0, 'A', 'entered'), (5, 'B', 'entered'), (20, 'A', 'exited'), (25, 'B', 'exited'),
+                    (40, 'B', 'entered'), (45, 'A', 'exited')])
+    counts, animals = leader_counts(df, window=pd.Timedelta(seconds=10))
+    assert dict(zip(animals, counts.tolist())) == {'A': 2, 'B': 0}
+    counts, animals = leader_counts(df, window=pd.Timedelta(seconds=10), same_direction=False)
+    assert dict(zip(animals, counts.tolist())) == {'A': 2, 'B': 1}
@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon May 19 10:21:46 2025
+
+@author: J. Cabrera-Moreno
+Postdoctoral fellow
+Evolutionary Cognition Group
+Institute of Evolutionary Anthropology
+University of Zürich
+
+Description:
+    Compact binary version of the gate logs (date,object,state,monkey), so
+    that reading them back needs no string parsing.
+
+    After a header (magic, machineID) the file is a sequence of fixed width
+    19 byte items, struct '<qBQH':
+        time    int64   ns since 1970 of the local wall clock, as logged in
+                        the CSV files
+        object  uint8   row kind, index of EVENT_KINDS, or TEXT_KIND
+        tag     uint64  RFID tag (0 for the other rows), for TEXT_KIND the
+                        index of "object,state" in the names of the file
+        animal  uint16  0 for "-", i for the i-th name of the file
+    Items are appended in blocks. Every block starts with a marker item
+    (object BLOCK_RECORDS or BLOCK_NAMES, animal SYNC, tag the number of
+    records or bytes of the block, time the CRC32 of both). A block cut by a
+    power loss or damaged fails its CRC and is skipped, the writer cuts it off
+    before appending to the file again. Names blocks hold the new animal
+    names of the file, separated by newlines and padded with zeros.
+
+    RFID tags are stored in the tag item when they are 16 lowercase hex
+    digits, as the reader gives them. Other tags (other width, upper case)
+    and rows without a kind are kept as text in the names, so that every row
+    is logged and comes back exactly as the CSV writer would have logged it.
+
+    As every item has the same width, the whole file is a numpy.memmap of
+    record_dtype() (see memmap_binary_log).
+
+    python3 BinaryLog.py 20250519102146.bin --csv ~/exports/20250519102146.txt
+"""
+
+from datetime import datetime, timedelta
+import os
+import re
+import zlib
+import struct
+import argparse
+
+from FileManager import BufferedLogWriter
+
+MAGIC = b'MGBLOG01'
+# Magic and length of the machineID that follows
+HEADER_FORMAT = '<8sH'
+RECORD_FORMAT = '<qBQH'
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+# (object, state) of every kind of row, the state of RFID rows is the tag
+EVENT_KINDS = (('session', 'start'), ('outerIR', 'broke'), ('innerIR', 'broke'), ('rfid', None),
+               ('-', 'in'), ('-', 'out'), ('-', 'inSniff'), ('-', 'outSniff'))
+RFID_KIND = EVENT_KINDS.index(('rfid', None))
+# Rows whose object and state are kept as text
+TEXT_KIND = 253
+BLOCK_NAMES = 254
+BLOCK_RECORDS = 255
+SYNC = 0x4D47
+EPOCH = datetime(1970, 1, 1)
+
+_KIND_CODES = {kind: code for code, kind in enumerate(EVENT_KINDS)}
+# Tags that fit the tag item and are formatted back the same
+_PLAIN_TAG = re.compile('[0-9a-f]{16}')
+_RECORD = struct.Struct(RECORD_FORMAT)
+
+
+def record_dtype():
+    # Items of the file as a numpy structured dtype (19 bytes, no padding)
+    import numpy as np
+    return np.dtype([('time', '<i8'), ('object', 'u1'), ('tag', '<u8'), ('animal', '<u2')])
+
+
+def _block_checksum(count, payload):
+    return zlib.crc32(payload, zlib.crc32(struct.pack('<Q', count)))
+
+
+def _block(kind, count, payload):
+    # Marker item, followed by the payload padded to whole items
+    return _RECORD.pack(_block_checksum(count, payload), kind, count, SYNC) + payload + bytes(-len(payload) % RECORD_SIZE)
+
+
+def _read_header(file):
+    magic, length = struct.unpack(HEADER_FORMAT, file.read(struct.calcsize(HEADER_FORMAT)))
+    if magic != MAGIC:
+        raise ValueError(f"{file.name} is not a binary gate log")
+    return file.read(length).decode('utf-8'), struct.calcsize(HEADER_FORMAT) + length
+
+
+def memmap_binary_log(file_path):
+    """
+    Map a binary log without reading it.
+    :return: (machineID, numpy.memmap of record_dtype() with all the items of
+             the file, block markers included, None if there are none)
+    """
+    import numpy as np
+    with open(file_path, 'rb') as file:
+        machineID, offset = _read_header(file)
+    items = (os.path.getsize(file_path) - offset) // RECORD_SIZE
+    if items == 0:
+        return machineID, None
+    return machineID, np.memmap(file_path, dtype=record_dtype(), mode='r', offset=offset, shape=(items,))
+
+
+def _valid_blocks(items):
+    """
+    Blocks of a memmap of items whose checksum holds.
+    :return: List of (kind, start item, count) of the blocks, in file order.
+    """
+    import numpy as np
+    blocks = []
+    if items is None:
+        return blocks
+    raw = items.view(np.uint8).reshape(-1, RECORD_SIZE) if len(items) else None
+    markers = np.flatnonzero((items['object'] >= BLOCK_NAMES) & (items['animal'] == SYNC))
+    position = 0
+    for marker in markers:
+        if marker < position:
+            # Inside the block before, not a marker
+            continue
+        kind, count, checksum = int(items['object'][marker]), int(items['tag'][marker]), int(items['time'][marker])
+        size = count if kind == BLOCK_RECORDS else -(-count // RECORD_SIZE)
+        if marker + 1 + size > len(items):
+            continue
+        payload = raw[marker + 1:marker + 1 + size].tobytes()
+        if kind == BLOCK_NAMES:
+            payload = payload[:count]
+        if _block_checksum(count, payload) != checksum:
+            continue
+        blocks.append((kind, marker + 1, count))
+        position = marker + 1 + size
+    return blocks
+
+
+def _block_names(items, start, count):
+    # Names of a valid names block of count bytes
+    import numpy as np
+    size = -(-count // RECORD_SIZE)
+    payload = items[start:start + size].view(np.uint8).reshape(-1)[:count].tobytes()
+    return payload.decode('utf-8').split('\n')
+
+
+def iter_binary_log(file_path, chunk_records):
+    """
+    Read the valid records of a binary log in chunks, straight out of its
+    memmap, so that only one chunk is in memory.
+    :param chunk_records: Records per chunk, the last one can hold fewer.
+    :return: Generator of (machineID, names read so far (index 0 is "-"),
+             structured array of record_dtype()). The names of a record are
+             always written before it.
+    """
+    import numpy as np
+    machineID, items = memmap_binary_log(file_path)
+    names = ['-']
+    parts, count_parts = [], 0
+    for kind, start, count in _valid_blocks(items):
+        if kind == BLOCK_NAMES:
+            names.extend(_block_names(items, start, count))
+            continue
+        while count:
+            take = min(count, chunk_records - count_parts)
+            parts.append(items[start:start + take])
+            count_parts += take
+            start, count = start + take, count - take
+            if count_parts == chunk_records:
+                yield machineID, names, np.concatenate(parts)
+                parts, count_parts = [], 0
+    if parts:
+        yield machineID, names, np.concatenate(parts)
+
+
+def read_binary_log(file_path):
+    """
+    Read the valid records of a binary log.
+    :return: (machineID, animal names (index 0 is "-"), structured array of
+             record_dtype() with the records in file order)
+    """
+    import numpy as np
+    machineID, items = memmap_binary_log(file_path)
+    names = ['-']
+    parts = []
+    for kind, start, count in _valid_blocks(items):
+        if kind == BLOCK_NAMES:
+            names.extend(_block_names(items, start, count))
+        else:
+            parts.append(items[start:start + count])
+    records = np.concatenate(parts) if parts else np.empty(0, dtype=record_dtype())
+    return machineID, names, np.array(records)
+
+
+def _valid_length(file_path):
+    # Bytes of the file up to the end of its last valid block
+    with open(file_path, 'rb') as file:
+        _, offset = _read_header(file)
+    _, items = memmap_binary_log(file_path)
+    blocks = _valid_blocks(items)
+    if not blocks:
+        return offset
+    kind, start, count = blocks[-1]
+    size = count if kind == BLOCK_RECORDS else -(-count // RECORD_SIZE)
+    return offset + (start + size) * RECORD_SIZE
+
+
+class BinaryLogWriter(BufferedLogWriter):
+    mode = 'ab'
+
+    def __init__(self, file_path, machineID, max_lines=64, flush_interval=1.0, fsync=False, group=None):
+        """
+        Buffered writer of a binary log, see BufferedLogWriter. Every batch is
+        appended as one checksummed block. An existing file is continued after
+        its last valid block.
+        :param file_path: Path of the log file, usually from FileManager.create_binary_file.
+        :param machineID: Name of the gate, kept in the header.
+        """
+        self.names = {}
+        if os.path.exists(file_path) and os.path.getsize(file_path) > 0:
+            _, names, _ = read_binary_log(file_path)
+            self.names = {name: index for index, name in enumerate(names) if index}
+            # Cut off a block left half written by a power loss
+            with open(file_path, 'r+b') as file:
+                file.truncate(_valid_length(file_path))
+        else:
+            machine = machineID.encode('utf-8')
+            with open(file_path, 'wb') as file:
+                file.write(struct.pack(HEADER_FORMAT, MAGIC, len(machine)) + machine)
+        super().__init__(file_path, max_lines, flush_interval, fsync, group)
+
+    def write(self, log):
+        """
+        Queue a line of the CSV format (date,object,state,monkey), for callers
+        that only have the text. write_event avoids the parsing.
+        """
+        date, obj, state, monkey = log.split(',')
+        moment = datetime.strptime(date[:14], '%Y%m%d%H%M%S') + timedelta(microseconds=int(date[14:] or 0) * 100)
+        self.write_event(moment, obj, state, monkey)
+
+    def write_event(self, moment, obj, state, monkey):
+        """
+        Queue a row of the log. Safe to call from any thread.
+        :param moment: datetime of the event.
+        :param obj: Object column (e.g. "rfid", "outerIR", "-").
+        :param state: State column, the hex tag for RFID rows.
+        :param monkey: Name of the animal or "-".
+        """
+        if obj == 'rfid' and _PLAIN_TAG.fullmatch(state):
+            kind, tag = RFID_KIND, int(state, 16)
+        elif obj != 'rfid' and (obj, state) in _KIND_CODES:
+            kind, tag = _KIND_CODES[(obj, state)], 0
+        else:
+            # Numbered with the names when the block is written
+            kind, tag = TEXT_KIND, f"{obj},{state}"
+        time_ns = (moment - EPOCH) // timedelta(microseconds=1) * 1000
+        self._queue((time_ns, kind, tag, monkey))
+
+    def _encode(self, items):
+        # New names first, so a block of records never refers to an unknown name
+        new_names = []
+        records = bytearray()
+
+        def number(name):
+            index = self.names.get(name)
+            if index is None:
+                index = self.names[name] = len(self.names) + 1
+                new_names.append(name)
+            return index
+
+        for time_ns, kind, tag, monkey in items:
+            animal = number(monkey) if monkey != '-' else 0
+            if kind == TEXT_KIND:
+                tag = number(tag)
+            records += _RECORD.pack(time_ns, kind, tag, animal)
+
+        data = b''
+        if new_names:
+            payload = '\n'.join(new_names).encode('utf-8')
+            data = _block(BLOCK_NAMES, len(payload), payload)
+        return data + _block(BLOCK_RECORDS, len(items), bytes(records))
+
+
+def binary_log_to_dataframe(file_path):
+    """
+    Read a binary log as the rows of a CSV log (see
+    DataAnalysis/FileManipulation.readLogFile), with arithmetic only.
+    :return: (machineID, DataFrame with the int64 date (YYYYMMDDHHMMSSffff)
+             and the categorical object, state and monkey columns)
+    """
+    machineID, names, records = read_binary_log(file_path)
+    return machineID, records_to_dataframe(names, records)
+
+
+def records_to_dataframe(names, records):
+    """
+    Rows of a CSV log from records of a binary log, e.g. a chunk of
+    iter_binary_log.
+    :param names: Names of the file (index 0 is "-").
+    :return: DataFrame as binary_log_to_dataframe.
+    """
+    import numpy as np
+    import pandas as pd
+
+    # Date parts of the times, as written by FileManager.get_current_datetime
+    times = records['time'].astype('datetime64[ns]')
+    days = times.astype('datetime64[D]')
+    months = times.astype('datetime64[M]')
+    years = times.astype('datetime64[Y]')
+    seconds = (times - days).astype('timedelta64[s]').astype(np.int64)
+    date = (years.astype(np.int64) + 1970) * 10**4 + (months - years).astype(np.int64) * 100 + 100
+    date += (days - months).astype(np.int64) + 1
+    date = date * 10**6 + seconds // 3600 * 10**4 + seconds // 60 % 60 * 100 + seconds % 60
+    date = date * 10**4 + (records['time'] % 10**9) // 10**5
+
+    # Categories of every kind of row, looked up by the object code
+    objects = list(dict.fromkeys(obj for obj, _ in EVENT_KINDS))
+    states = list(dict.fromkeys(state for _, state in EVENT_KINDS if state))
+    kindObject = np.array([objects.index(obj) for obj, _ in EVENT_KINDS])
+    kindState = np.array([states.index(state) if state else -1 for _, state in EVENT_KINDS])
+    isRfid = records['object'] == RFID_KIND
+    isText = records['object'] == TEXT_KIND
+    kinds = np.where(isText, 0, records['object'])
+    objectCodes = kindObject[kinds]
+    stateCodes = kindState[kinds]
+    # States of the RFID rows are their tags, only the distinct ones are formatted
+    tags, tagCodes = np.unique(records['tag'][isRfid], return_inverse=True)
+    stateCodes[isRfid] = len(states) + tagCodes
+    states += [f"{tag:016x}" for tag in tags]
+    # Rows kept as text, a damaged names block leaves them as "-,-"
+    texts, textCodes = np.unique(records['tag'][isText], return_inverse=True)
+    texts = [(names[text] if text < len(names) else '-,-').split(',', 1) for text in texts]
+    objects += list(dict.fromkeys(obj for obj, _ in texts if obj not in objects))
+    states += list(dict.fromkeys(state for _, state in texts if state not in states))
+    objectCodes[isText] = np.array([objects.index(obj) for obj, _ in texts], dtype=np.int64)[textCodes]
+    stateCodes[isText] = np.array([states.index(state) for _, state in texts], dtype=np.int64)[textCodes]
+
+    df = pd.DataFrame({'date': date.astype(np.int64),
+                       'object': pd.Categorical.from_codes(objectCodes, objects),
+                       'state': pd.Categorical.from_codes(stateCodes, states),
+                       # A damaged names block leaves its animals as "-"
+                       'monkey': pd.Categorical.from_codes(np.where(records['animal'] < len(names),
+                                                                    records['animal'], 0), names)})
+    for col in ('object', 'state', 'monkey'):
+        df[col] = df[col].cat.remove_unused_categories()
+    return df
+
+
+def binary_log_to_csv(file_path, csv_path):
+    """
+    Convert a binary log to the CSV log written by the gates.
+    """
+    machineID, df = binary_log_to_dataframe(file_path)
+    with open(csv_path, 'w') as file:
+        file.write(f"MachineID: {machineID}\n")
+        df.to_csv(file, index=False)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Convert a binary gate log to the CSV log.')
+    parser.add_argument('log', help='binary log file')
+    # No default next to the log: the analysis reads every file of the gate
+    # folder and would count the rows of the export again
+    parser.add_argument('--csv', required=True, help='CSV file to write, outside the log folder of the gate')
+    args = parser.parse_args()
+
+    binary_log_to_csv(args.log, args.csv)
+    print(f"File created: {args.csv}")
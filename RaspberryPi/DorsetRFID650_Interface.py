@@ -12,6 +12,28 @@ import os
 import time
 import datetime
 import calendar
+import re
+from collections import deque
+
+def xorChecksum(data):
+    """ XOR of all the bytes of data (any bytes-like object). Long data is
+        folded as one big integer instead of looping over the bytes. Under 64
+        bytes, which covers every tag frame, the plain loop is the fastest
+        (faster than functools.reduce or the folds) and is kept.
+    """
+    if len(data) < 64:
+        value = 0
+        for element in data:
+            value ^= element
+        return value
+    value = int.from_bytes(data, 'little')
+    width = len(data)
+    while width > 1:
+        # XOR the upper half of the bytes onto the lower half
+        half = (width + 1) // 2
+        value = (value >> (8 * half)) ^ (value & ((1 << (8 * half)) - 1))
+        width = half
+    return value
 
 def byteToBinaryString(hex):
     
@@ -194,6 +216,116 @@ class ProtocolWrapper(object):
         self.message_time = None
         return ProtocolStatus.MSG_OK
     
+class FrameDecoder(object):
+    """ Streaming version of the ProtocolWrapper state machine. Instead of
+        one byte at a time, it is fed whole chunks of received bytes with
+        feed() and returns every frame completed by the chunk. Runs of
+        regular message bytes are copied in bulk into a bytearray, only
+        the DLE and footer bytes go through the state machine.
+        The frames are identical to the ProtocolWrapper .last_message,
+        including the kept header, footer, DLEs and checksum.
+    """
+    def __init__(self,
+            header=b'\x02',
+            footer=b'\x03',
+            dle=b'\x10',
+            after_dle_func=lambda x: x,
+            keep_header=True,
+            keep_footer=True,
+            keep_dle=True,
+            has_checksum_appended=True):
+        """ Same parameters as ProtocolWrapper.
+        """
+        self.header = header
+        self.footer = footer
+        self.dle = dle
+        self.after_dle_func = after_dle_func
+        self.keep_header = keep_header
+        self.keep_footer = keep_footer
+        self.has_checksum_appended = has_checksum_appended
+        self.append_dle = self.dle if keep_dle else b''
+
+        # Bytes that interrupt a run of regular message bytes
+        self._special = re.compile(b'[' + re.escape(dle) + re.escape(footer) + b']')
+
+        self.state = ProtocolWrapper.WAIT_HEADER
+        self.message_buf = bytearray()
+        self.message_time = None
+        self.skipped_bytes = 0
+
+    def reset(self):
+        """ Drop any partially received frame.
+        """
+        self.state = ProtocolWrapper.WAIT_HEADER
+        self.message_buf = bytearray()
+        self.message_time = None
+
+    def _end_of_message(self, frames):
+        if self.keep_footer:
+            self.message_buf += self.dle + self.footer
+        if self.has_checksum_appended:
+            self.state = ProtocolWrapper.AFTER_MSG
+        else:
+            self._finish_msg(frames)
+
+    def _finish_msg(self, frames):
+        frames.append((bytes(self.message_buf), self.message_time))
+        self.reset()
+
+    def feed(self, data, timestamp=None):
+        """ Feed a chunk of received bytes.
+            timestamp:
+                Reception time of the chunk, used as the time of the
+                frames starting in it (now if not given).
+            Returns a list of (frame, frame time) tuples, possibly empty.
+        """
+        if timestamp is None:
+            timestamp = datetime.datetime.now()
+
+        frames = []
+        i, n = 0, len(data)
+        while i < n:
+            if self.state == ProtocolWrapper.WAIT_HEADER:
+                j = data.find(self.header, i)
+                if j < 0:
+                    # not part of any frame
+                    self.skipped_bytes += n - i
+                    break
+                self.skipped_bytes += j - i
+                self.message_time = timestamp
+                if self.keep_header:
+                    self.message_buf += self.dle + self.header
+                self.state = ProtocolWrapper.IN_MSG
+                i = j + 1
+            elif self.state == ProtocolWrapper.IN_MSG:
+                match = self._special.search(data, i)
+                if match is None:
+                    # just regular message bytes
+                    self.message_buf += data[i:]
+                    break
+                j = match.start()
+                self.message_buf += data[i:j]
+                if data[j:j + 1] == self.dle:
+                    self.state = ProtocolWrapper.AFTER_DLE
+                else:
+                    self._end_of_message(frames)
+                i = j + 1
+            elif self.state == ProtocolWrapper.AFTER_DLE:
+                new_byte = data[i:i + 1]
+                if new_byte == self.footer:
+                    self._end_of_message(frames)
+                else:
+                    self.message_buf += self.append_dle + self.after_dle_func(new_byte)
+                    self.state = ProtocolWrapper.IN_MSG
+                i += 1
+            else: # add a single checksum byte to message
+                self.message_buf += data[i:i + 1]
+                self._finish_msg(frames)
+                i += 1
+
+        return frames
+
+
 class TimeObj():
     
     def __init__(self, year = None, month = None, day = None, hour = None, minute = None, second = None):
@@ -208,9 +340,11 @@ class TimeObj():
 
 class DorsetRFID650_Interface():
     
-    def __init__(self, COMPort = '/dev/ttyUSB0', baudrate = 57600, UnitNr = '01', Host = 'FE'):
-
-        self.ser = serial.Serial(
+    def __init__(self, COMPort = '/dev/ttyUSB0', baudrate = 57600, UnitNr = '01', Host = 'FE', ser = None):
+        
+        # An already open port (e.g. a fake one to replay recordings) can be given instead
+        if ser is None:
+            ser = serial.Serial(
                 port=COMPort,
                 baudrate = baudrate, # 19200,
                 parity=serial.PARITY_NONE,
@@ -218,6 +352,7 @@ class DorsetRFID650_Interface():
                 bytesize=serial.EIGHTBITS,
                 timeout=1
                 )
+        self.ser = ser
         
         self.messageIDs = {'start': b'\x02', 'stop': b'\x03', 'DLE': b'\x10'}
         
@@ -232,6 +367,18 @@ class DorsetRFID650_Interface():
             dle=self.messageIDs['DLE'],
             has_checksum_appended=True)
         
+        self.FrameDecoder = FrameDecoder(header=self.messageIDs['start'],
+            footer=self.messageIDs['stop'],
+            dle=self.messageIDs['DLE'],
+            has_checksum_appended=True)
+        # Frames decoded but not returned yet
+        self.pendingFrames = deque()
+        
+        # Bulk DLE stuffing and unstuffing
+        DLE = re.escape(self.messageIDs['DLE'])
+        self._stuffPattern = re.compile(b'([' + re.escape(self.messageIDs['start']) + re.escape(self.messageIDs['stop']) + DLE + b'])')
+        self._unstuffPattern = re.compile(DLE + b'(.?)', re.DOTALL)
+        
         curTime = datetime.datetime.now()
         self.leapYear = curTime.year
         while not calendar.isleap(self.leapYear):
@@ -272,6 +419,7 @@ class DorsetRFID650_Interface():
         
         self.ser.reset_output_buffer()
         self.ser.reset_input_buffer()
+        self.clearFrames()
         self.ser.write(message)
         
         returnedFrame, returnedTime = self.getFrame()   
@@ -295,6 +443,7 @@ class DorsetRFID650_Interface():
 
         self.ser.reset_output_buffer()
         self.ser.reset_input_buffer()
+        self.clearFrames()
         self.ser.write(self.timeRequest)
         
         returnedFrame, returnedTime = self.getFrame()
@@ -336,44 +485,63 @@ class DorsetRFID650_Interface():
 
         return returnedTime
     
+    def clearFrames(self):
+        """
+        Forget the frames decoded but not returned yet, e.g. after flushing
+        the serial input buffer.
+        """
+        self.pendingFrames.clear()
+        self.FrameDecoder.reset()
+    
+    def readFrames(self):
+        """
+        Read everything waiting on the serial port in one call (waiting up to
+        the port timeout for the first byte) and decode it.
+        :return: List of (frame, frame time) tuples completed by the read.
+        """
+        data = self.ser.read(max(1, self.ser.in_waiting))
+        if not data:
+            return []
+        return self.FrameDecoder.feed(data, datetime.datetime.now())
+    
+    def iterFrames(self, keepRunning = lambda: True):
+        """
+        Block on the serial port and yield every frame as soon as it is
+        complete, stamped with its arrival time. The thread sleeps in the
+        serial read while no data arrives, keepRunning is checked at least
+        once per port timeout.
+        :param keepRunning: Callable, the generator stops when it returns False.
+        """
+        while keepRunning():
+            if self.pendingFrames:
+                yield self.pendingFrames.popleft()
+                continue
+            for frame in self.readFrames():
+                yield frame
+    
     def getFrame(self, waitForStart = True):
         
-        datWaiting = self.ser.inWaiting()
-        if datWaiting > 0 or waitForStart == True:
-            flagProcessed = 0
-            while flagProcessed == 0:
-                # read the message one by one and return the latest message          
-                curByte = self.ser.read(size = 1)
-                 
-                statusMsg = self.ProtocolWrapper.input(curByte)
-                if ProtocolStatus.MSG_OK == statusMsg:
-                    Frame = self.ProtocolWrapper.last_message
-                    FrameTime = self.ProtocolWrapper.last_messagetime
-                    flagProcessed = 1            
+        if not self.pendingFrames and (waitForStart or self.ser.in_waiting > 0):
+            # read until at least one message is complete and return the oldest one
+            while not self.pendingFrames:
+                self.pendingFrames.extend(self.readFrames())
+        
+        if not self.pendingFrames:
+            return None, None
+        Frame, FrameTime = self.pendingFrames.popleft()
              
         return Frame, FrameTime
     
     def _createMessage(self, message):
         
-        messageDummy = b''
         if isinstance(message, tuple):
-            for el in message:
-                messageDummy += el
-            message = messageDummy          
+            message = b''.join(message)
 
-        # first stuff the message
-        wrapped = b''
-        for el in message:
-            if isinstance(el, int):
-                el = bytes([el])
-            if el in (self.messageIDs['start'], self.messageIDs['stop'], self.messageIDs['DLE']):
-                wrapped += (self.messageIDs['DLE'] + el)
-            else:
-                wrapped += el     
+        # first stuff the message: a DLE before every start, stop and DLE byte
+        wrapped = self._stuffPattern.sub(self.messageIDs['DLE'] + b'\\1', message)
                 
         # create full message
-        message = b''
-        message += self.messageIDs['DLE'] + self.messageIDs['start'] # add header
+        message = bytearray(self.messageIDs['DLE'] + self.messageIDs['start']) # add header
         message += bytes.fromhex(self.Host + self.UnitNr) # add Host and Unit
         message += wrapped # add the message
         message += self.messageIDs['DLE'] + self.messageIDs['stop'] # add footer
@@ -382,29 +550,30 @@ class DorsetRFID650_Interface():
 #        print(binascii.b2a_hex(message))
 
         # create and add checksum
-        message += self._HexChecksum(message) # always add the checksum
+        message.append(xorChecksum(message)) # always add the checksum
         
 #        print(message)
 #        print(binascii.b2a_hex(message))
         
-        return message
+        return bytes(message)
     
     
     def validateMessage(self, message, checksum = 0):
         
+        # Compare the checksums as ints, no bytes objects on every frame
         valid = 0
-        if bytes([checksum]) == self._HexChecksum(message):
+        if xorChecksum(message) == checksum:
             valid = 1
             
         return valid
     
     def _HexChecksum(self, message):
         
-        checksum = 0
-        for element in message:
-            checksum ^= element
+        return bytes([xorChecksum(message)])
 
-        return bytes([checksum])
+    def _unstuff(self, message):
+        # Drop every DLE and keep the byte after it
+        return self._unstuffPattern.sub(b'\\1', message)
     
     def parseFrame(self, message, messageTime = None):
         
@@ -416,18 +585,37 @@ class DorsetRFID650_Interface():
    
         Host, Unit, command, message = message[messageStart+2:messageStart+3:], message[messageStart+3:messageStart+4:], message[messageStart+4:messageStart+5:], message[messageStart+5:messageStop:]
         
-        messageDummy = b''
-        after_dle = 0
-        for el in message:
-            el = bytes([el])
-            if el == self.messageIDs['DLE'] and after_dle == 0:
-                after_dle = 1
-            else:
-                messageDummy += el
-                after_dle = 0
+        messageDummy = self._unstuff(message) if self.messageIDs['DLE'] in message else message
                     
         return Host, Unit, command, messageDummy, messageTime
     
+    def parseFrameBuffer(self, buffer, start = 0, end = None):
+        """
+        Parse the first frame of buffer[start:end] without copying it, e.g.
+        straight out of the bytearray a serial port reads into.
+        :param buffer: bytes or bytearray with the received data.
+        :return: (Host, Unit, command, message, frame end) with memoryviews of
+                 the buffer (message is new bytes only if it held stuffed
+                 bytes), frame end is the offset right after the checksum.
+                 None if the buffer holds no complete frame.
+        """
+        if end is None:
+            end = len(buffer)
+        messageStart = buffer.find(self.messageIDs['DLE'] + self.messageIDs['start'], start, end) # frame start
+        if messageStart < 0:
+            return None
+        messageStop = buffer.find(self.messageIDs['DLE'] + self.messageIDs['stop'], messageStart + 2, end) # frame stop
+        if messageStop < 0 or messageStop + 3 > end:
+            return None
+        
+        view = memoryview(buffer)
+        if buffer.find(self.messageIDs['DLE'], messageStart + 5, messageStop) >= 0:
+            message = self._unstuff(buffer[messageStart+5:messageStop])
+        else:
+            message = view[messageStart+5:messageStop]
+        
+        return view[messageStart+2:messageStart+3], view[messageStart+3:messageStart+4], view[messageStart+4:messageStart+5], message, messageStop + 3
+    
     def processFrame(self):
         
         return self.parseFrame(self.getFrame())
@@ -485,26 +673,17 @@ if __name__ == '__main__':
     
 #    print('RFIDDecoder set to time: ' + RFID.setTime().isoformat())
 
-    flag = 1
-    while flag:
-        try:
-            time.sleep(0.1)
+    try:
+        # wakes up as soon as a frame arrives, no polling
+        for returnedFrame in RFID.iterFrames():
             
-            datWaiting = RFID.ser.inWaiting()
-            if datWaiting > 0:
-                
-                returnedData = RFID.processFrame()
+            returnedData = RFID.parseFrame(returnedFrame)
 
-                print('Message timestamp: ' + returnedData[-1].isoformat())
-                print('Transponder type: ' + binascii.b2a_hex(returnedData[2]).decode("utf-8"))
-                print('Tag: ' + binascii.b2a_hex(returnedData[3]).decode("utf-8"))
-                
-        except KeyboardInterrupt:
-            print('finished')  # Add final newline
+            print('Message timestamp: ' + returnedData[-1].isoformat())
+            print('Transponder type: ' + binascii.b2a_hex(returnedData[2]).decode("utf-8"))
+            print('Tag: ' + binascii.b2a_hex(returnedData[3]).decode("utf-8"))
             
-            RFID.ser.close()
-            
-            flag = 0
-            break
-    
-    
\ No newline at end of file
+    except KeyboardInterrupt:
+        print('finished')  # Add final newline
+        
+        RFID.ser.close()
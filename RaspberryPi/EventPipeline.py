@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Apr 22 10:05:12 2025
+
+@author: J. Cabrera-Moreno
+Postdoctoral fellow
+Evolutionary Cognition Group
+Institute of Evolutionary Anthropology
+University of Zürich
+
+Description:
+    Single consumer of the gate events. The IR and RFID loops put their events
+    in a priority queue ordered by capture time and never wait. One thread
+    takes them out in that order, keeps the last ones in a fixed size ring
+    buffer and runs the crossing detection, so the sequence of events is only
+    ever touched by that thread. Several gates can share one pipeline, and
+    its thread, by putting their events with their own handler.
+"""
+
+from collections import namedtuple, deque
+from threading import Thread
+from datetime import datetime
+import itertools
+import queue
+import time
+
+# An event of the gate. monotonic_ns orders the events of all the sources,
+# wall_clock is the time written to the logs. source is "ir" or "rfid", name
+# the IR sensor or the animal and tag the RFID tag ("-" for IR events).
+GateEvent = namedtuple('GateEvent', ['monotonic_ns', 'wall_clock', 'source', 'name', 'tag'])
+
+
+def monotonic_ns_of(wall_clock):
+    """
+    Monotonic time of a recent wall clock moment, for sources that only stamp
+    their events with datetime.now() (as the RFID frames).
+    :param wall_clock: datetime of the event.
+    :return: time.monotonic_ns() at that moment.
+    """
+    age = datetime.now() - wall_clock
+    return time.monotonic_ns() - int(age.total_seconds() * 1e9)
+
+
+class EventPipeline:
+    def __init__(self, handler, size=6, reorder_delay=0.05, idle_handler=None, idle_interval=0.5):
+        """
+        :param handler: Called by the consumer thread with the ring buffer
+                        (deque, oldest event first) after every new event.
+        :param size: Number of events kept in the ring buffer.
+        :param reorder_delay: Seconds an event waits in the queue, so that an
+                              event captured earlier but put later by another
+                              loop is still handled first.
+        :param idle_handler: Called by the consumer thread with the current
+                             time.monotonic_ns() when no event arrived for
+                             idle_interval seconds, e.g. to expire timeouts.
+                             While events keep coming it is still called every
+                             idle_interval seconds, with the capture time of
+                             the last event handled, so the gates of a shared
+                             pipeline do not wait for the others to be quiet.
+        :param idle_interval: Seconds between calls to idle_handler.
+        """
+        self.handler = handler
+        self.idle_handler = idle_handler
+        self.idle_interval = idle_interval
+        self.size = size
+        self.events = deque(maxlen=size)
+        # Ring buffers of the events put with their own handler
+        self._buffers = {}
+        self.reorder_delay_ns = int(reorder_delay * 1e9)
+
+        self._queue = queue.PriorityQueue()
+        # Breaks the ties between events captured at the same time
+        self._order = itertools.count()
+        self._closed = False
+
+        self._thread = Thread(target=self._consume, daemon=True)
+        self._thread.start()
+
+    def put(self, event, handler=None):
+        """
+        Queue a GateEvent. Safe to call from any thread, it never blocks.
+        :param handler: Handler of the event instead of the one of the
+                        pipeline, with its own ring buffer, for the gates of a
+                        shared pipeline.
+        """
+        self._queue.put_nowait((event.monotonic_ns, next(self._order), event, handler))
+
+    def close(self):
+        """
+        Handle the events still in the queue and stop the consumer thread.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        # Sorted after every real event
+        self._queue.put_nowait((float('inf'), next(self._order), None, None))
+        self._thread.join()
+
+    def _idle(self, now_ns):
+        self._next_idle = time.monotonic() + self.idle_interval
+        if self.idle_handler is not None:
+            try:
+                self.idle_handler(now_ns)
+            except Exception as e:
+                print(f"Error in idle handler: {e}")
+
+    def _consume(self):
+        self._next_idle = time.monotonic() + self.idle_interval
+        while True:
+            try:
+                item = self._queue.get(timeout=self.idle_interval)
+            except queue.Empty:
+                self._idle(time.monotonic_ns())
+                continue
+            captured, _, event, handler = item
+            if event is None:
+                break
+
+            # Too recent, an earlier event could still be on its way
+            wait = captured + self.reorder_delay_ns - time.monotonic_ns()
+            if wait > 0 and not self._closed:
+                self._queue.put_nowait(item)
+                time.sleep(wait / 1e9)
+                continue
+
+            if handler is None:
+                handler, events = self.handler, self.events
+            else:
+                events = self._buffers.setdefault(handler, deque(maxlen=self.size))
+            events.append(event)
+            try:
+                handler(events)
+            except Exception as e:
+                print(f"Error in event handler: {e}")
+            # Every later event was captured after this one
+            if time.monotonic() >= self._next_idle:
+                self._idle(captured)
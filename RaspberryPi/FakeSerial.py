@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue May  6 09:41:27 2025
+
+@author: J. Cabrera-Moreno
+Postdoctoral fellow
+Evolutionary Cognition Group
+Institute of Evolutionary Anthropology
+University of Zürich
+
+Description:
+    Stand-in for serial.Serial used to run the RFID code without a reader
+    (replays, benchmarks).
+"""
+
+from threading import Condition
+import os
+
+
+class FakeSerial:
+    def __init__(self, timeout=1):
+        """
+        In memory stand-in for serial.Serial: the bytes given to feed() are
+        returned by read() as if the reader had sent them.
+        :param timeout: Seconds read() waits for the first byte.
+        """
+        self.timeout = timeout
+        self.is_open = True
+        self._buffer = bytearray()
+        self._condition = Condition()
+        # (read, write) pipe behind fileno(), only created if it is used
+        self._pipe = None
+
+    @property
+    def in_waiting(self):
+        return len(self._buffer)
+
+    def inWaiting(self):
+        return len(self._buffer)
+
+    def fileno(self):
+        """
+        Descriptor that is readable while there are bytes to read, so that the
+        port can be watched with select/selectors like a real one.
+        """
+        with self._condition:
+            if self._pipe is None:
+                self._pipe = os.pipe()
+                os.set_blocking(self._pipe[0], False)
+                self._update_pipe(False)
+            return self._pipe[0]
+
+    def _update_pipe(self, was_readable):
+        # The pipe holds one byte while the buffer holds any
+        if self._pipe is None or was_readable == bool(self._buffer):
+            return
+        if self._buffer:
+            os.write(self._pipe[1], b'\0')
+        else:
+            try:
+                os.read(self._pipe[0], 1)
+            except BlockingIOError:
+                pass
+
+    def feed(self, data):
+        """
+        Make bytes available to read().
+        """
+        with self._condition:
+            was_readable = bool(self._buffer)
+            self._buffer += data
+            self._update_pipe(was_readable)
+            self._condition.notify_all()
+
+    def read(self, size=1):
+        with self._condition:
+            self._condition.wait_for(lambda: self._buffer or not self.is_open, self.timeout)
+            was_readable = bool(self._buffer)
+            data = bytes(self._buffer[:size])
+            del self._buffer[:size]
+            self._update_pipe(was_readable)
+            return data
+
+    def write(self, data):
+        # Commands to the reader are not answered
+        return len(data)
+
+    def reset_input_buffer(self):
+        with self._condition:
+            was_readable = bool(self._buffer)
+            self._buffer.clear()
+            self._update_pipe(was_readable)
+
+    def close(self):
+        with self._condition:
+            self.is_open = False
+            if self._pipe is not None:
+                for fd in self._pipe:
+                    os.close(fd)
+                self._pipe = None
+            self._condition.notify_all()
@@ -19,21 +19,27 @@ import os
 import socket
 import sys
 import csv
+import atexit
+import time
+from collections import deque
+from threading import Thread, Condition
 from datetime import datetime
 
 class FileManager:
-    def __init__(self, directory):
+    def __init__(self, directory, machineID=None):
         self.directory = os.path.expanduser(directory)
         self.ensure_directory_exists()
-        self.machineID = socket.gethostname()
+        # Several gates of the same Pi are told apart by their own ID
+        self.machineID = machineID or socket.gethostname()
 
     def ensure_directory_exists(self):
         if not os.path.exists(self.directory):
             os.makedirs(self.directory)
 
-    def get_current_datetime(self, filename):
-        # Get the current date and time
-        now = datetime.now()
+    def get_current_datetime(self, filename, now=None):
+        # Get the current date and time, unless the moment to format is given
+        if now is None:
+            now = datetime.now()
         
         # Format the date and time in the specified format
         if not filename:
@@ -60,6 +66,11 @@ class FileManager:
         
         return file_path
 
+    def create_binary_file(self):
+        # Path of a new binary log (see BinaryLog.py), its header is written by BinaryLogWriter
+        formatted_datetime = self.get_current_datetime(True)
+        return os.path.join(self.directory, f"{formatted_datetime}.bin")
+
     def log_to_file(self, file_path, log):
         # Append a new line to the existing file
         with open(file_path, 'a') as file:
@@ -83,6 +94,227 @@ class FileManager:
                 print(f"Error reading file: {e}")
         return None
 
+class AnimalRegistry:
+    def __init__(self, file_path, check_interval=5.0):
+        """
+        Tag to animal name index loaded from a CSV file (name,tag per row). The
+        file is reloaded automatically when its modification time changes.
+        :param file_path: Path of the CSV file with the animal names and tags.
+        :param check_interval: Minimum seconds between two checks of the file.
+        """
+        self.file_path = file_path
+        self.check_interval = check_interval
+        self._animals = {}
+        self._mtime = None
+        self._next_check = 0.0
+        self.reload()
+
+    @staticmethod
+    def normalize_tag(animal_tag):
+        # Tags are compared as lowercase hex strings
+        return str(animal_tag).strip().lower()
+
+    def reload(self):
+        """
+        Load the CSV file again. On error the previous index is kept.
+        """
+        try:
+            mtime = os.stat(self.file_path).st_mtime_ns
+            animals = {}
+            with open(self.file_path, mode='r') as file:
+                for row in csv.reader(file):
+                    if len(row) >= 2:
+                        animals[self.normalize_tag(row[1])] = row[0].strip()
+        except Exception as e:
+            print(f"Error reading file: {e}")
+            return
+        # Swap the whole index at once, lookups from other threads see the old or the new one
+        self._animals = animals
+        self._mtime = mtime
+
+    def _check_file(self):
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        self._next_check = now + self.check_interval
+        try:
+            if os.stat(self.file_path).st_mtime_ns != self._mtime:
+                self.reload()
+        except OSError as e:
+            print(f"Error reading file: {e}")
+
+    def lookup(self, animal_tag):
+        """
+        Search for the animal name based on its tag.
+        :return: Name of the animal or None if not found.
+        """
+        self._check_file()
+        return self._animals.get(self.normalize_tag(animal_tag))
+
+class LogWriterGroup:
+    def __init__(self):
+        """
+        Background thread appending the queued lines of several
+        BufferedLogWriter to their files, e.g. the log files of all the gates
+        of MultiGateControl. A writer created without a group gets its own.
+        """
+        self._writers = []
+        self._condition = Condition()
+        self._closed = False
+
+        self._thread = Thread(target=self._flush_loop, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _add(self, writer):
+        with self._condition:
+            if self._closed:
+                raise ValueError("add a writer to a closed LogWriterGroup")
+            self._writers.append(writer)
+
+    def close(self):
+        """
+        Close every writer of the group and stop the background thread.
+        """
+        for writer in list(self._writers):
+            writer.close()
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+        atexit.unregister(self.close)
+
+    def _flush_loop(self):
+        while True:
+            with self._condition:
+                deadline = time.monotonic() + min((writer.flush_interval for writer in self._writers), default=1.0)
+                # Wait until a batch is full, it is due, or someone asks for it
+                while not self._closed and not any(writer._due() for writer in self._writers):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                batches = [(writer, writer._take()) for writer in self._writers]
+                closing = self._closed
+
+            # Lines are written whole and by this thread only, they never interleave
+            for writer, (items, _, last) in batches:
+                writer._write(items, last)
+
+            with self._condition:
+                for writer, (_, request, last) in batches:
+                    writer._flushed = request
+                    if last:
+                        self._writers.remove(writer)
+                self._condition.notify_all()
+            if closing:
+                break
+
+
+class BufferedLogWriter:
+    # Mode the log file is opened with, binary formats use 'ab'
+    mode = 'a'
+
+    def __init__(self, file_path, max_lines=64, flush_interval=1.0, fsync=False, group=None):
+        """
+        Collect log lines in memory and append them to the log file from a
+        background thread, instead of opening the file for every line.
+        :param file_path: Path of the log file.
+        :param max_lines: Lines kept in memory before they are written.
+        :param flush_interval: Maximum seconds a line waits in memory.
+        :param fsync: Force every written batch to the SD card with os.fsync.
+        :param group: LogWriterGroup whose thread writes the lines, shared with
+                      other writers. None starts a thread for this writer only.
+        """
+        self.file_path = file_path
+        self.max_lines = max_lines
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+
+        self._own_group = group is None
+        self._group = LogWriterGroup() if group is None else group
+        self._condition = self._group._condition
+        self._file = None
+        self._lines = deque()
+        self._flush_requested = 0
+        self._flushed = 0
+        self._closed = False
+
+        self._group._add(self)
+        atexit.register(self.close)
+
+    def write(self, log):
+        """
+        Queue a line (without newline) to be appended to the log file. Safe to
+        call from any thread, it never waits for the file.
+        """
+        self._queue(log + '\n')
+
+    def _queue(self, item):
+        with self._condition:
+            if self._closed:
+                raise ValueError(f"write to a closed {type(self).__name__}")
+            self._lines.append(item)
+            if len(self._lines) >= self.max_lines:
+                self._condition.notify_all()
+
+    def _encode(self, items):
+        # Data written to the file for a batch of queued items
+        return ''.join(items)
+
+    def _due(self):
+        # Called with the condition held
+        return len(self._lines) >= self.max_lines or self._closed or self._flushed != self._flush_requested
+
+    def _take(self):
+        # Called with the condition held: the queued items, the flush request
+        # they answer and whether it is the last batch of the writer
+        items = list(self._lines)
+        self._lines.clear()
+        return items, self._flush_requested, self._closed
+
+    def _write(self, items, last):
+        # Called by the thread of the group only
+        if self._file is None:
+            self._file = open(self.file_path, self.mode)
+        batch = self._encode(items) if items else None
+        if batch:
+            self._file.write(batch)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+        if last:
+            self._file.close()
+
+    def flush(self):
+        """
+        Write all the queued lines now and wait until they are in the file.
+        """
+        with self._condition:
+            self._flush_requested += 1
+            request = self._flush_requested
+            self._condition.notify_all()
+            while self._flushed < request and self._group._thread.is_alive():
+                self._condition.wait()
+
+    def close(self):
+        """
+        Write the remaining lines and close the file, and stop the background
+        thread if it is not shared.
+        """
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify_all()
+            while self in self._group._writers and self._group._thread.is_alive():
+                self._condition.wait()
+        atexit.unregister(self.close)
+        if self._own_group:
+            self._group.close()
+
 if __name__ == "__main__":
     # Example usage
     directory = '/home/pi/Documents/Data'  # Replace with pertinent directory
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Apr 28 15:42:09 2025
+
+@author: J. Cabrera-Moreno
+Postdoctoral fellow
+Evolutionary Cognition Group
+Institute of Evolutionary Anthropology
+University of Zürich
+
+Description:
+    Streaming detector of the gate crossings. Consumes the IR beam breaks and
+    the RFID identifications in time order (as delivered by EventPipeline) and
+    decides, per animal, whether it entered, exited or sniffed at the gate.
+
+    Events follow the offline analysis (DataAnalysis/MovementAnalysis.py): a
+    run of consecutive RFID reads is an event, it gets the IR breaks up to
+    `window` before its first read and up to `window` after its last one, a
+    break in the windows of two events stays with the earlier one, and the IR
+    sequence is classified with the rules in MovementCodes. Online, a run also
+    ends when nothing arrives for `window` after its last read, so that the
+    decision is not held back until the next animal.
+"""
+
+from collections import namedtuple, deque
+
+from MovementCodes import EMPTY_SEQUENCE, append_ir, classify
+
+# Decision for an animal identified in an event. start and end are the wall
+# clock of the first and last RFID read of the event.
+Crossing = namedtuple('Crossing', ['animal', 'movement', 'confidence', 'start', 'end'])
+
+
+class _OpenEvent:
+    __slots__ = ('animals', 'start', 'end', 'end_ns', 'code', 'pre_rfid_code', 'in_run')
+
+    def __init__(self, animal, wall_clock, monotonic_ns, before):
+        self.animals = [animal]
+        self.start = self.end = wall_clock
+        self.end_ns = monotonic_ns
+        self.code = EMPTY_SEQUENCE
+        for sensor in before:
+            self.code = append_ir(self.code, sensor)
+        self.pre_rfid_code = self.code
+        # True until an IR break arrives after the last RFID read
+        self.in_run = True
+
+
+class GateCrossingDetector:
+    def __init__(self, window=2.0):
+        """
+        :param window: Seconds of the before and after windows of every event,
+                       as in the offline analysis.
+        """
+        self.window_ns = int(window * 1e9)
+        # IR breaks not claimed by any event yet, (monotonic_ns, sensor)
+        self.pending = deque()
+        self.current = None
+
+    def feed(self, event):
+        """
+        Process the next gate event, in capture time order.
+        :param event: GateEvent (see EventPipeline). IR events are beam breaks
+                      named "outerIR"/"innerIR", RFID events are named after the
+                      animal ("-" when the tag is unknown).
+        :return: List of Crossing decided by this event, usually empty.
+        """
+        decisions = self.expire(event.monotonic_ns)
+        current = self.current
+
+        if event.source == "ir":
+            if current is not None:
+                # After window of the open event
+                current.code = append_ir(current.code, event.name)
+                current.in_run = False
+            else:
+                self.pending.append((event.monotonic_ns, event.name))
+                # Too old for the before window of any later RFID read
+                while self.pending[0][0] < event.monotonic_ns - self.window_ns:
+                    self.pending.popleft()
+
+        elif event.source == "rfid":
+            if current is not None and current.in_run:
+                # Same run of RFID reads
+                if event.name not in current.animals:
+                    current.animals.append(event.name)
+                current.end = event.wall_clock
+                current.end_ns = event.monotonic_ns
+            else:
+                if current is not None:
+                    decisions += self._close()
+                start_ns = event.monotonic_ns - self.window_ns
+                before = [sensor for captured, sensor in self.pending if captured >= start_ns]
+                self.pending.clear()
+                self.current = _OpenEvent(event.name, event.wall_clock, event.monotonic_ns, before)
+
+        return decisions
+
+    def expire(self, now_ns):
+        """
+        Close the open event once its after window is over. Call it when no
+        event arrived for a while, so that decisions are not delayed until the
+        next event.
+        :param now_ns: Current time.monotonic_ns().
+        :return: List of Crossing decided.
+        """
+        if self.current is not None and now_ns > self.current.end_ns + self.window_ns:
+            return self._close()
+        return []
+
+    def _close(self):
+        event, self.current = self.current, None
+        movement, confidence = classify(event.code, event.pre_rfid_code)
+        if movement is None:
+            return []
+
+        decisions = []
+        for animal in event.animals:
+            if animal == "-":
+                continue
+            decisions.append(Crossing(animal, movement, confidence, event.start, event.end))
+        return decisions
@@ -17,8 +17,15 @@ Explanation:
 """
 
 from gpiozero import Button
+from collections import namedtuple
+from datetime import datetime
+import queue
 import time
 
+# A beam edge captured by the GPIO callbacks. monotonic_ns orders the edges of
+# both sensors, wall_clock is the time written to the logs.
+BeamEdge = namedtuple('BeamEdge', ['sensor', 'edge', 'monotonic_ns', 'wall_clock'])
+
 class IRDirectionDetector:
     def __init__(self, sensor_1_pin, sensor_2_pin):
         """
@@ -32,6 +39,10 @@ class IRDirectionDetector:
         
         self.sensor_1_prev_state = False
         self.sensor_2_prev_state = False
+        
+        # Edges captured by the callbacks of start_edge_capture
+        self.edges = queue.SimpleQueue()
+        self.on_edge = None
 
     def detect_movement(self):
         """
@@ -82,6 +93,46 @@ class IRDirectionDetector:
 
         return None
 
+    def start_edge_capture(self, on_edge=None):
+        """
+        Capture every beam edge from the GPIO callbacks instead of polling the
+        sensors. Breaks ("broke") and releases ("restored") of both sensors are
+        pushed to self.edges as BeamEdge records, read them with get_edge.
+        :param on_edge: Called without arguments by the callback thread after
+                        every edge, e.g. to wake up a select loop.
+        """
+        self.on_edge = on_edge
+        self.sensor_1.when_pressed = lambda: self._push_edge("outerIR", "broke")
+        self.sensor_1.when_released = lambda: self._push_edge("outerIR", "restored")
+        self.sensor_2.when_pressed = lambda: self._push_edge("innerIR", "broke")
+        self.sensor_2.when_released = lambda: self._push_edge("innerIR", "restored")
+
+    def stop_edge_capture(self):
+        """
+        Detach the callbacks of start_edge_capture. Edges already captured stay
+        in the queue.
+        """
+        for sensor in (self.sensor_1, self.sensor_2):
+            sensor.when_pressed = None
+            sensor.when_released = None
+
+    def _push_edge(self, sensor, edge):
+        # Runs in the GPIO callback thread: stamp the edge first and return fast
+        self.edges.put(BeamEdge(sensor, edge, time.monotonic_ns(), datetime.now()))
+        if self.on_edge is not None:
+            self.on_edge()
+
+    def get_edge(self, timeout=None):
+        """
+        Wait for the next beam edge captured by start_edge_capture.
+        :param timeout: Seconds to wait, None waits forever.
+        :return: BeamEdge or None if no edge arrived before the timeout.
+        """
+        try:
+            return self.edges.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
 
 if __name__ == "__main__":
 
@@ -93,20 +144,13 @@ if __name__ == "__main__":
     detector = IRDirectionDetector(SENSOR_1_PIN, SENSOR_2_PIN)
 
     print("Starting Tunnel Direction Detector. Press Ctrl+C to exit.")
+    detector.start_edge_capture()
 
     try:
         while True:
-            result = detector.detect_movement()
-            if result:  # If a movement event is detected
-                direction, timestamp = result
-                print(f"Animal moved {direction} at {timestamp}")
-
-                
-            beam_break = detector.log_beam_break()
-            if beam_break:  # If a beam break is detected
-                sensor, timestamp = beam_break
-                print(f"{sensor} at {timestamp}")
-
-            time.sleep(0.1)  # Small delay to reduce CPU usage
+            # Sleeps until a beam edge arrives
+            edge = detector.get_edge()
+            print(f"{edge.sensor} {edge.edge} at {edge.wall_clock.isoformat()} ({edge.monotonic_ns} ns)")
     except KeyboardInterrupt:
+        detector.stop_edge_capture()
         print("Exiting Tunnel Direction Detector.")
@@ -13,155 +13,275 @@ Description:
     Main code control for the ComfortBox experiment. takes into account
     the IR beam breaks, the RFID readings and based on that switches ON/OFF
     the IR light. All events are logged to a file with timestamp.
+    The logic lives in GateController, which gets its IR detector and RFID
+    reader from the caller, so it can also run on recorded data (see
+    ReplayHarness.py) or next to other gates (see MultiGateControl.py).
 """
 from gpiozero import OutputDevice
 from threading import Thread, Event
 import os
 import time
 import binascii
-import re
+from datetime import datetime
 
 # Local libraries
 from IRDirectionDetector import IRDirectionDetector
 from DorsetRFID650_Interface import DorsetRFID650_Interface
-from FileManager import FileManager
+from FileManager import FileManager, BufferedLogWriter, AnimalRegistry
+from BinaryLog import BinaryLogWriter
+from EventPipeline import EventPipeline, GateEvent, monotonic_ns_of
+from GateCrossingDetector import GateCrossingDetector
 
 # Define the GPIO pins
 # RELAY_PIN = 21     # GPIO pin for the relay
 IR_SENSOR_1 = 16  # GPIO pin for the outer sensor
 IR_SENSOR_2 = 20  # GPIO pin for the inner sensor
 
-# Initialize devices
-# relay = OutputDevice(RELAY_PIN)                          # Initialize relay
-detector = IRDirectionDetector(IR_SENSOR_1, IR_SENSOR_2) # Initialize IRDirectionDetector
-RFID = DorsetRFID650_Interface(baudrate = 57600)         # Initialize RFID reader
-
-# Initialize file manager
-directory =  "~/Documents/Data"  # Replace with pertinent directory
-file_logger = FileManager(directory)
-column_names = "date,object,state,monkey\n"
-log_file_path = file_logger.create_file(column_names)
-print(f"File created: {log_file_path}")
-
-# Log Task initializing
-# currentTimestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
-currentTimestamp = file_logger.get_current_datetime(False)
-file_logger.log_to_file(log_file_path,f"{currentTimestamp},session,start,-")
-
 script_dir = os.path.dirname(os.path.abspath(__file__)) # Get the directory of the currently running script
 animalsID_file = "animalsID.csv"
-animalID_searcher = FileManager(script_dir)
 
-# Event storage
-events_vector = []
-events_timestamp_vector = []
-end_task = Event()
-end_task.set()
-experimental_condition = 1 # 0 = I-, 1 = I+. I- = No interdependance, I+ = Interdependace
-animals_in_box = []
+# State logged for every movement
+MOVEMENT_STATES = {'entered': 'in', 'exited': 'out', 'inSniff': 'inSniff', 'outSniff': 'outSniff'}
 
-# Helper functions
-def detect_pattern():
-    """
-    Finds the right pattern of events in the event_vector for determining IN or 
-    OUT of the box. Matches patterns where the first and last items are fixed 
-    ("OUTER"/"INNER") and the middle is any lowercase string (name of the animal).
-    """
-    print(f"Events list {events_vector}")
-    
-    if len(events_vector) >= 3:
-        last_three = events_vector[-3:]
+
+class GateController:
+    def __init__(self, detector, RFID, directory="~/Documents/Data",
+                 animals_file=os.path.join(script_dir, animalsID_file), window=2.0, verbose=True,
+                 machine_id=None, log_format="csv", log_group=None, event_pipeline=None):
+        """
+        :param detector: IRDirectionDetector of the two IR beams of the tunnel.
+        :param RFID: DorsetRFID650_Interface of the RFID antenna.
+        :param directory: Folder where the log file of the session is created.
+        :param animals_file: CSV with the name and tag of every animal.
+        :param window: Seconds of the windows of the crossing detector.
+        :param verbose: Print every event.
+        :param machine_id: MachineID written to the log file, the host name by default.
+        :param log_format: "csv" for the text log, "binary" for the compact one
+                           of BinaryLog.py.
+        :param log_group: LogWriterGroup whose thread writes the log file, None
+                          for a thread of this gate only.
+        :param event_pipeline: EventPipeline shared with other gates, None for
+                               a pipeline of this gate only. The owner of a
+                               shared pipeline closes it and calls
+                               expire_crossings when it is idle.
+        """
+        self.detector = detector
+        self.RFID = RFID
+        self.verbose = verbose
+        
+        # Initialize file manager
+        self.file_logger = FileManager(directory, machine_id)
+        # All events go through a single buffered writer shared by the IR and RFID loops
+        self.binary_log = log_format == "binary"
+        if self.binary_log:
+            self.log_file_path = self.file_logger.create_binary_file()
+            self.log_writer = BinaryLogWriter(self.log_file_path, self.file_logger.machineID, group=log_group)
+        elif log_format == "csv":
+            column_names = "date,object,state,monkey\n"
+            self.log_file_path = self.file_logger.create_file(column_names)
+            self.log_writer = BufferedLogWriter(self.log_file_path, group=log_group)
+        else:
+            raise ValueError(f"Unknown log format: {log_format}")
+        print(f"File created: {self.log_file_path}")
+        
+        # Tag to name index kept in memory, reloaded when animalsID.csv changes
+        self.animal_registry = AnimalRegistry(animals_file)
+        
+        self.end_task = Event()
+        self.experimental_condition = 1 # 0 = I-, 1 = I+. I- = No interdependance, I+ = Interdependace
+        self.animals_in_box = []
+        
+        # Online version of the movement classification of the offline analysis
+        self.crossing_detector = GateCrossingDetector(window=window)
+        # Event storage: the IR and RFID loops only put events, a single thread orders
+        # them by capture time and runs detect_pattern
+        self.shared_pipeline = event_pipeline is not None
+        if self.shared_pipeline:
+            self.event_pipeline = event_pipeline
+        else:
+            self.event_pipeline = EventPipeline(self.detect_pattern, idle_handler=self.expire_crossings)
         
-        # Animal got in
-        if last_three[0] == "outer" and last_three[2] == "inner" and re.fullmatch(r"[a-z]+", last_three[1]):
-            print(f"{events_timestamp_vector[-1]}, {last_three[1]}, in")
-            file_logger.log_to_file(log_file_path,f"{events_timestamp_vector[-1]},-,in,{last_three[1]}")
-        # Animal got out
-        elif last_three[0] == "inner" and last_three[2] == "outer" and re.fullmatch(r"[a-z]+", last_three[1]):
-            print(f"{events_timestamp_vector[-1]}, {last_three[1]}, out")
-            file_logger.log_to_file(log_file_path,f"{events_timestamp_vector[-1]},-,out,{last_three[1]}")
+        self.threads = []
     
-    if len(events_vector) == 6:
-        del events_vector[0]
-        del events_timestamp_vector[0]
-
-# IR Detection Loop
-def ir_loop():
-    print("Starting IR Direction Detector. Press Ctrl+C to exit.")
-    try:
-        while end_task.is_set():
-            beam_break = detector.log_beam_break()
-            if beam_break:
-                sensorID, timestampIR = beam_break
-                # Log event to file
-                currentTimestamp = file_logger.get_current_datetime(False)
-                file_logger.log_to_file(log_file_path,f"{currentTimestamp},{sensorID},broke,-")
-                # Append event to vector
-                events_vector.append(sensorID)
-                events_timestamp_vector.append(timestampIR)
-                # print(f"{sensorID} sensor broken at {timestampIR}")
-                
-                # Detect pattern
-                detect_pattern()
-                
-            time.sleep(0.1)  # Small delay to reduce CPU usage
-    except Exception as e:
-        print(f"Error in IR loop: {e}")
-    finally:
-        print("Exiting IR Direction Detector.")
-
-# RFID Loop
-def rfid_loop():
-    print("Starting RFID")
-    try:
-        while end_task.is_set():
-            time.sleep(0.1)      
-            datWaiting = RFID.ser.inWaiting()
-            if datWaiting > 0:
-                returnedData = RFID.processFrame()
-                monkey_tag = binascii.b2a_hex(returnedData[3]).decode("utf-8")
-                print(f"Tag: {monkey_tag}")
-                timestampRFID = returnedData[-1].isoformat()
-                animal_name = animalID_searcher.get_animal_name_from_file(animalsID_file, monkey_tag)
-                
-                if animal_name:
-                    print(f'Animal: {animal_name}')
-                    if not events_vector or events_vector[-1] != animal_name:
-                        events_vector.append(animal_name)
-                        events_timestamp_vector.append(timestampRFID)
-                        detect_pattern()  # Detect pattern after a valid event is recorded
-                        
-                # Log to file all RFID readings event those when the name of the animals is not know
-                else:
-                    animal_name = "-"
+    # Helper functions
+    def log_event(self, moment, obj, state, monkey):
+        """
+        Queue a row (date,object,state,monkey) of the log file. A row that
+        cannot be logged is reported and skipped, it never stops the loops.
+        :param moment: datetime of the event.
+        """
+        try:
+            if self.binary_log:
+                self.log_writer.write_event(moment, obj, state, monkey)
+            else:
+                currentTimestamp = self.file_logger.get_current_datetime(False, moment)
+                self.log_writer.write(f"{currentTimestamp},{obj},{state},{monkey}")
+        except ValueError as e:
+            print(f"Error logging {obj},{state},{monkey}: {e}")
+    
+    def log_crossings(self, crossings):
+        """
+        Log the movements decided by the crossing detector and keep track of the
+        animals inside the box.
+        """
+        for crossing in crossings:
+            state = MOVEMENT_STATES[crossing.movement]
+            if self.verbose:
+                print(f"{crossing.end.isoformat()}, {crossing.animal}, {state} ({crossing.confidence})")
+            self.log_event(crossing.end, "-", state, crossing.animal)
+            
+            if crossing.movement == 'entered' and crossing.animal not in self.animals_in_box:
+                self.animals_in_box.append(crossing.animal)
+            elif crossing.movement == 'exited' and crossing.animal in self.animals_in_box:
+                self.animals_in_box.remove(crossing.animal)
+    
+    def detect_pattern(self, events):
+        """
+        Feeds the newest event of the ring buffer of the event pipeline to the
+        crossing detector, which decides whether an animal got IN or OUT of the
+        box. Only runs in the consumer thread of the pipeline.
+        """
+        self.log_crossings(self.crossing_detector.feed(events[-1]))
+    
+    def expire_crossings(self, now_ns):
+        """
+        Decides the crossing of the last animal once nothing happened at the gate
+        for the length of the window.
+        """
+        self.log_crossings(self.crossing_detector.expire(now_ns))
+    
+    def queue_event(self, event):
+        """
+        Put a GateEvent in the event pipeline, with the handler of this gate
+        when the pipeline is shared.
+        """
+        self.event_pipeline.put(event, self.detect_pattern if self.shared_pipeline else None)
+    
+    def handle_edge(self, beam_edge):
+        """
+        Log a beam edge of the detector and queue it for the pattern detection.
+        """
+        # Only the breaks are logged and matched, releases are not part of the logs
+        if beam_edge and beam_edge.edge == "broke":
+            sensorID = beam_edge.sensor
+            # Log event to file with the time of the edge
+            self.log_event(beam_edge.wall_clock, sensorID, "broke", "-")
+            if self.verbose:
+                print(f"{sensorID} sensor broken at {beam_edge.wall_clock.isoformat()}")
+            
+            # Pattern detection runs in the pipeline
+            self.queue_event(GateEvent(beam_edge.monotonic_ns, beam_edge.wall_clock, "ir", sensorID, "-"))
+    
+    def handle_frame(self, returnedFrame):
+        """
+        Log a (frame, frame time) tuple of the RFID reader and queue the read
+        for the pattern detection.
+        """
+        returnedData = self.RFID.parseFrame(returnedFrame)
+        monkey_tag = binascii.b2a_hex(returnedData[3]).decode("utf-8")
+        animal_name = self.animal_registry.lookup(monkey_tag)
+        if self.verbose:
+            print(f"Tag: {monkey_tag}")
+            # print('Transponder type: ' + binascii.b2a_hex(returnedData[2]).decode("utf-8"))
+        
+        if animal_name:
+            if self.verbose:
+                print(f'Animal: {animal_name}')
                 
-                currentTimestamp = file_logger.get_current_datetime(False)
-                file_logger.log_to_file(log_file_path,f"{currentTimestamp},rfid,{monkey_tag},{animal_name}")
+        # Log to file all RFID readings event those when the name of the animals is not know
+        else:
+            animal_name = "-"
+        
+        # Pattern detection runs in the pipeline, unknown tags still delimit the events
+        self.queue_event(GateEvent(monotonic_ns_of(returnedData[-1]), returnedData[-1],
+                                   "rfid", animal_name, monkey_tag))
+        
+        # Log the arrival time of the frame rather than the processing time
+        self.log_event(returnedData[-1], "rfid", monkey_tag, animal_name)
+    
+    # IR Detection Loop
+    def ir_loop(self):
+        print("Starting IR Direction Detector. Press Ctrl+C to exit.")
+        try:
+            while self.end_task.is_set():
+                beam_edge = self.detector.get_edge(timeout=1.0)
+                try:
+                    self.handle_edge(beam_edge)
+                except Exception as e:
+                    print(f"Error handling a beam edge: {e}")
+                    
+        except Exception as e:
+            print(f"Error in IR loop: {e}")
+        finally:
+            print("Exiting IR Direction Detector.")
+    
+    # RFID Loop
+    def rfid_loop(self):
+        print("Starting RFID")
+        try:
+            # Blocks on the serial port and wakes up as soon as a frame arrives
+            for returnedFrame in self.RFID.iterFrames(self.end_task.is_set):
+                # An odd frame is skipped, the reader keeps being read
+                try:
+                    self.handle_frame(returnedFrame)
+                except Exception as e:
+                    print(f"Error handling an RFID frame: {e}")
+                    
+        except Exception as e:
+            print(f"Error in RFID loop: {e}")
+        finally:
+            print("Exiting RFID.")
+    
+    def start(self, threaded=True, on_edge=None):
+        """
+        Log the start of the session and start the IR and RFID loops.
+        :param threaded: False starts no loop, the caller reads the detector and
+                         the reader and hands their edges and frames to
+                         handle_edge and handle_frame.
+        :param on_edge: Called by the GPIO callbacks after every beam edge.
+        """
+        # Log Task initializing
+        self.log_event(datetime.now(), "session", "start", "-")
+        
+        self.end_task.set()
+        # Beam edges are captured by the GPIO callbacks, the IR loop sleeps until one arrives
+        self.detector.start_edge_capture(on_edge)
+        if not threaded:
+            return
+        self.threads = [Thread(target=self.ir_loop), Thread(target=self.rfid_loop)]
+        for thread in self.threads:
+            thread.start()
+    
+    def stop(self):
+        """
+        Stop the loops, handle the pending events and close the log file.
+        """
+        self.end_task.clear()
+        for thread in self.threads:
+            thread.join()
+        self.detector.stop_edge_capture()
+        if not self.shared_pipeline:
+            self.event_pipeline.close()
+        # Decide the crossing of the last event, its window is not waited for
+        self.log_crossings(self.crossing_detector.expire(float('inf')))
+        self.log_writer.close()
 
-                    # print('Message timestamp: ' + timestampRFID)
-                    # print('Transponder type: ' + binascii.b2a_hex(returnedData[2]).decode("utf-8"))
-                    # print('Tag: ' + monkey_tag)
-                
-    except Exception as e:
-        print(f"Error in RFID loop: {e}")
-    finally:
-        print("Exiting RFID.")
 
 # Main execution
 if __name__ == "__main__":
-    ir_thread = Thread(target=ir_loop)
-    rfid_thread = Thread(target=rfid_loop)
-
-    ir_thread.start()
-    rfid_thread.start()
+    # Initialize devices
+    # relay = OutputDevice(RELAY_PIN)                          # Initialize relay
+    detector = IRDirectionDetector(IR_SENSOR_1, IR_SENSOR_2) # Initialize IRDirectionDetector
+    RFID = DorsetRFID650_Interface(baudrate = 57600)         # Initialize RFID reader
+    
+    directory =  "~/Documents/Data"  # Replace with pertinent directory
+    controller = GateController(detector, RFID, directory)
+    controller.start()
 
     try:
         while True:
             time.sleep(1)
     except KeyboardInterrupt:
         print("Exiting program...")
-        end_task.clear()
-
-    ir_thread.join()
-    rfid_thread.join()
 
+    controller.stop()
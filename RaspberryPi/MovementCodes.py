@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Apr 28 11:20:37 2025
+
+@author: J. Cabrera-Moreno
+Postdoctoral fellow
+Evolutionary Cognition Group
+Institute of Evolutionary Anthropology
+University of Zürich
+
+Description:
+    Movement rules of the monkey gate, shared by the online detector running
+    on the gate (GateCrossingDetector.py) and the offline classifier of the
+    logs (DataAnalysis/MovementAnalysis.py), so that both label an event the
+    same way. Pure Python on purpose, the gate does not need numpy.
+
+    The IR logs of an event, in time order, are encoded as an integer: the
+    i-th log is stored in bit i (1 = innerIR, 0 = outerIR) and a leading 1
+    marks the length, e.g. ['outerIR', 'innerIR'] -> 0b110. The empty
+    sequence is 1 and 0 stands for a sequence too long to be classified.
+"""
+
+# Bit used for every IR sensor when encoding the IR sequence of an event
+IR_SEQUENCE_BITS = {'outerIR': 0, 'innerIR': 1}
+# Longest IR sequence that is classified, longer events stay unclassified
+MAX_IR_SEQUENCE = 12
+# Movement labels, indexed by movement code (0 = not classified)
+MOVEMENTS = (None, 'entered', 'exited', 'inSniff', 'outSniff')
+# Confidence of a single crossing found before the first RFID read of an
+# event whose whole IR sequence is intertwined
+FALLBACK_CONFIDENCE = 0.8
+
+EMPTY_SEQUENCE = 1
+
+
+def encode_ir_sequence(sequence):
+    """
+    Encode a sequence of IR logs, in time order, as an integer.
+    """
+    code = EMPTY_SEQUENCE
+    for sensor in sequence:
+        code = append_ir(code, sensor)
+    return code
+
+
+def append_ir(code, sensor):
+    """
+    Code of the sequence `code` followed by one more IR log, in O(1).
+    """
+    if code == 0:
+        return 0
+    length = code.bit_length() - 1
+    if length >= MAX_IR_SEQUENCE:
+        return 0
+    # The length marker becomes the bit of the new log and moves one bit up
+    return (code ^ (1 << length)) | (IR_SEQUENCE_BITS[sensor] << length) | (1 << (length + 1))
+
+
+def movement_of(code):
+    """
+    Movement code and confidence of an IR sequence code.
+    :return: (movement, confidence), (0, None) if the sequence is not classified.
+    """
+    if code <= EMPTY_SEQUENCE:
+        return 0, None
+    length = code.bit_length() - 1
+    bits = code ^ (1 << length)
+    # Only innerIR or only outerIR: the animal sniffed from that side
+    if bits == (1 << length) - 1:
+        return 3, 1.0
+    if bits == 0:
+        return 4, 1.0
+    # A single outerIR -> innerIR or innerIR -> outerIR crossing
+    if length == 2:
+        return (1 if bits == 0b10 else 2), 1.0
+    return 0, None
+
+
+def classify(code, pre_rfid_code):
+    """
+    Movement of an event from the code of its whole IR sequence and the code
+    of the IR logs before its first RFID read. Intertwined sequences fall back
+    to a single crossing before the RFID read.
+    :return: (label in MOVEMENTS, confidence), (None, None) if not classified.
+    """
+    movement, confidence = movement_of(code)
+    if movement == 0:
+        pre_movement, _ = movement_of(pre_rfid_code)
+        if pre_movement in (1, 2):
+            movement, confidence = pre_movement, FALLBACK_CONFIDENCE
+    return MOVEMENTS[movement], confidence
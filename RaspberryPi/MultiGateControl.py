@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Wed May 14 11:02:37 2025
+
+@author: J. Cabrera-Moreno
+Postdoctoral fellow
+Evolutionary Cognition Group
+Institute of Evolutionary Anthropology
+University of Zürich
+
+Description:
+    Runs several gates (e.g. the two antennas of a tunnel or adjacent
+    enclosures) from one Pi and one process. Every gate has its own serial
+    port, pair of IR beams and log folder, and keeps its own GateController:
+    crossing detector and log file. Instead of an IR and an RFID thread per
+    gate, a single selectors loop waits on all the serial ports at once and is
+    woken up by the GPIO callbacks of every beam. The gates also share one
+    event pipeline and one log writer thread, so the number of threads does
+    not grow with the number of gates.
+
+    The gates are read from a JSON file:
+        {"animals_file": "animalsID.csv",
+         "window": 2.0,
+         "log_format": "csv",
+         "gates": [{"name": "gate1", "port": "/dev/ttyUSB0", "ir_pins": [16, 20],
+                    "directory": "~/Documents/Data/gate1"},
+                   {"name": "gate2", "port": "/dev/ttyUSB1", "ir_pins": [19, 26]}]}
+    baudrate defaults to 57600, directory to ~/Documents/Data/<name> and the
+    MachineID of the logs to the name of the gate, so that the analysis (one
+    folder per machine) tells the gates apart. log_format is "csv" or "binary"
+    (see BinaryLog.py).
+
+    python3 MultiGateControl.py --config gates.json
+"""
+from threading import Thread, Event
+import os
+import json
+import time
+import argparse
+import selectors
+
+# Local libraries
+from IRDirectionDetector import IRDirectionDetector
+from DorsetRFID650_Interface import DorsetRFID650_Interface
+from MainMonkeyGateControl import GateController, script_dir, animalsID_file
+from FileManager import LogWriterGroup
+from EventPipeline import EventPipeline
+
+config_file = "gates.json"
+DEFAULT_DIRECTORY = "~/Documents/Data"
+DEFAULT_BAUDRATE = 57600
+
+
+def load_config(file_path=os.path.join(script_dir, config_file)):
+    """
+    Read and check the gates of a JSON config file.
+    :param file_path: Path of the config file.
+    :return: Dictionary with animals_file, window, log_format and the list of
+             gates, the defaults filled in. Relative paths are taken from the
+             folder of the config file.
+    """
+    with open(os.path.expanduser(file_path)) as file:
+        config = json.load(file)
+    base = os.path.dirname(os.path.abspath(os.path.expanduser(file_path)))
+
+    gates = config.get('gates') or []
+    if not gates:
+        raise ValueError(f"No gates in {file_path}")
+    for gate in gates:
+        for key in ('name', 'port', 'ir_pins'):
+            if key not in gate:
+                raise ValueError(f"Gate {gate.get('name', '?')} has no {key}")
+        if len(gate['ir_pins']) != 2:
+            raise ValueError(f"Gate {gate['name']} needs two IR pins (outer, inner)")
+        gate.setdefault('baudrate', DEFAULT_BAUDRATE)
+        gate.setdefault('directory', os.path.join(DEFAULT_DIRECTORY, gate['name']))
+        gate.setdefault('machine_id', gate['name'])
+        gate['directory'] = os.path.join(base, os.path.expanduser(gate['directory']))
+
+    # Two gates cannot share a port, a pin or a log folder
+    for key, values in (('name', [gate['name'] for gate in gates]),
+                        ('port', [gate['port'] for gate in gates]),
+                        ('IR pin', [pin for gate in gates for pin in gate['ir_pins']]),
+                        ('directory', [os.path.normpath(gate['directory']) for gate in gates])):
+        repeated = {value for value in values if values.count(value) > 1}
+        if repeated:
+            raise ValueError(f"Gates share the same {key}: {', '.join(map(str, sorted(repeated)))}")
+
+    return {'animals_file': os.path.join(base, config.get('animals_file', animalsID_file)),
+            'window': config.get('window', 2.0),
+            'log_format': config.get('log_format', 'csv'),
+            'gates': gates}
+
+
+def create_gates(config):
+    """
+    Open the IR beams and the RFID reader of every gate of the config.
+    :return: List of dictionaries with the name, detector, RFID, directory and
+             machine_id of every gate, as taken by MultiGateController.
+    """
+    return [{'name': gate['name'],
+             'detector': IRDirectionDetector(*gate['ir_pins']),
+             'RFID': DorsetRFID650_Interface(gate['port'], baudrate=gate['baudrate']),
+             'directory': gate['directory'],
+             'machine_id': gate['machine_id']}
+            for gate in config['gates']]
+
+
+class MultiGateController:
+    def __init__(self, gates, animals_file=os.path.join(script_dir, animalsID_file), window=2.0, verbose=True,
+                 log_format="csv"):
+        """
+        :param gates: List of dictionaries with the name, detector
+                      (IRDirectionDetector), RFID (DorsetRFID650_Interface) and
+                      directory of every gate, optionally its machine_id.
+        :param animals_file: CSV with the name and tag of every animal.
+        :param window: Seconds of the windows of the crossing detectors.
+        :param verbose: Print every event.
+        :param log_format: "csv" or "binary" log files.
+        """
+        # Single consumer of the events and single writer of the logs of all the gates
+        self.event_pipeline = EventPipeline(None, idle_handler=self._expire_crossings)
+        self.log_group = LogWriterGroup()
+        self.controllers = {gate['name']: GateController(gate['detector'], gate['RFID'], gate['directory'],
+                                                         animals_file, window, verbose,
+                                                         gate.get('machine_id', gate['name']), log_format,
+                                                         self.log_group, self.event_pipeline)
+                            for gate in gates}
+
+        self.selector = selectors.DefaultSelector()
+        # Written by the GPIO callbacks to wake up the loop
+        self._wake_read, self._wake_write = os.pipe()
+        os.set_blocking(self._wake_read, False)
+        os.set_blocking(self._wake_write, False)
+
+        self.end_task = Event()
+        self.thread = None
+
+    def _wake(self):
+        try:
+            os.write(self._wake_write, b'\0')
+        except BlockingIOError:
+            # The loop has plenty of wake ups pending already
+            pass
+
+    def _expire_crossings(self, now_ns):
+        # Idle handler of the shared pipeline, runs in its consumer thread
+        for name, controller in self.controllers.items():
+            try:
+                controller.expire_crossings(now_ns)
+            except Exception as e:
+                print(f"Error expiring the crossings of {name}: {e}")
+
+    def _handle_edges(self):
+        # Beam edges captured by the GPIO callbacks of every gate
+        for name, controller in self.controllers.items():
+            while True:
+                beam_edge = controller.detector.get_edge(timeout=0)
+                if beam_edge is None:
+                    break
+                try:
+                    controller.handle_edge(beam_edge)
+                except Exception as e:
+                    print(f"Error in IR of {name}: {e}")
+
+    def io_loop(self):
+        """
+        Wait on the serial ports of all the gates and the wake up pipe of the
+        beams, and hand every frame and beam edge to its gate.
+        """
+        print(f"Starting gates {', '.join(self.controllers)}. Press Ctrl+C to exit.")
+        while self.end_task.is_set():
+            for key, _ in self.selector.select(timeout=1.0):
+                if key.data is None:
+                    try:
+                        while os.read(self._wake_read, 4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+
+                name, controller = key.data
+                try:
+                    frames = controller.RFID.readFrames()
+                except Exception as e:
+                    # A lost reader does not stop the other gates
+                    print(f"Error reading the RFID of {name}, closing it: {e}")
+                    self.selector.unregister(key.fileobj)
+                    continue
+                for returnedFrame in frames:
+                    try:
+                        controller.handle_frame(returnedFrame)
+                    except Exception as e:
+                        print(f"Error in RFID of {name}: {e}")
+
+            self._handle_edges()
+        print("Exiting gates.")
+
+    def start(self):
+        """
+        Log the start of the session of every gate and start the loop.
+        """
+        for name, controller in self.controllers.items():
+            controller.start(threaded=False, on_edge=self._wake)
+            self.selector.register(controller.RFID.ser, selectors.EVENT_READ, (name, controller))
+        self.selector.register(self._wake_read, selectors.EVENT_READ, None)
+
+        self.end_task.set()
+        self.thread = Thread(target=self.io_loop)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the loop and close every gate, handling the pending events.
+        """
+        self.end_task.clear()
+        if self.thread is not None:
+            self.thread.join()
+        self._handle_edges()
+        # Pending events of every gate are handled before the gates decide their last crossing
+        self.event_pipeline.close()
+        for controller in self.controllers.values():
+            controller.stop()
+        self.log_group.close()
+        self.selector.close()
+        os.close(self._wake_read)
+        os.close(self._wake_write)
+
+
+# Main execution
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Run several gates from one process.')
+    parser.add_argument('--config', default=os.path.join(script_dir, config_file),
+                        help='JSON file with the serial port, IR pins and log folder of every gate')
+    parser.add_argument('--quiet', action='store_true', help='do not print every event')
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    controller = MultiGateController(create_gates(config), config['animals_file'], config['window'],
+                                     verbose=not args.quiet, log_format=config['log_format'])
+    controller.start()
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("Exiting program...")
+
+    controller.stop()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue May  6 10:12:03 2025
+
+@author: J. Cabrera-Moreno
+Postdoctoral fellow
+Evolutionary Cognition Group
+Institute of Evolutionary Anthropology
+University of Zürich
+
+Description:
+    Throughput and latency of the RFID protocol code. Synthetic Dorset tag
+    frames, some with DLE stuffed payloads and some with a bad checksum, go
+    through every stage of the stack one frame at a time and the frames per
+    second and per frame latency of every stage are reported as JSON, so
+    runs on different gates or versions can be compared.
+
+    python3 ProtocolBenchmark.py --frames 5000 --output benchmark.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+
+# Local libraries
+from DorsetRFID650_Interface import DorsetRFID650_Interface, ProtocolWrapper, FrameDecoder
+from FakeSerial import FakeSerial
+
+# Command byte of the synthetic tag frames
+TAG_COMMAND = b'\x01'
+# Tag bytes that are sent after a DLE. A stuffed 0x03 reads as the footer
+# (DLE ETX), so the decoders cannot get it back and it is left out.
+SPECIAL_BYTES = (0x02, 0x10)
+TAG_BYTES = [value for value in range(256) if value != 0x03]
+
+
+def make_frames(count, stuffed_ratio=0.3, bad_checksum_ratio=0.05, seed=0):
+    """
+    Synthetic tag frames as sent by the reader.
+    :param count: Number of frames.
+    :param stuffed_ratio: Fraction of the tags holding bytes that need a DLE.
+    :param bad_checksum_ratio: Fraction of the frames with a wrong checksum.
+    :param seed: Seed of the random tags.
+    :return: (frames, payloads, number of bad checksums)
+    """
+    rng = random.Random(seed)
+    RFID = DorsetRFID650_Interface(ser=FakeSerial())
+    frames, payloads, bad = [], [], 0
+    for _ in range(count):
+        tag = bytearray(rng.choice(TAG_BYTES) for _ in range(8))
+        if rng.random() < stuffed_ratio:
+            for position in rng.sample(range(8), 2):
+                tag[position] = rng.choice(SPECIAL_BYTES)
+        payload = TAG_COMMAND + bytes(tag)
+        frame = RFID._createMessage(payload)
+        if rng.random() < bad_checksum_ratio:
+            frame = frame[:-1] + bytes([frame[-1] ^ 0xFF])
+            bad += 1
+        frames.append(frame)
+        payloads.append(payload)
+    return frames, payloads, bad
+
+
+def measure(function, items):
+    """
+    Call function on every item and time every call.
+    :return: Dictionary with the frames per second and the latencies in microseconds.
+    """
+    latencies = []
+    for item in items:
+        started = time.perf_counter_ns()
+        function(item)
+        latencies.append(time.perf_counter_ns() - started)
+
+    latencies.sort()
+    total = sum(latencies)
+    def percentile(q):
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))] / 1e3
+    return {'frames_per_second': len(latencies) / (total / 1e9) if total else None,
+            'latency_us': {'mean': total / len(latencies) / 1e3,
+                           'p50': percentile(0.5),
+                           'p99': percentile(0.99),
+                           'max': percentile(1.0)}}
+
+
+def run_benchmark(count=2000, stuffed_ratio=0.3, bad_checksum_ratio=0.05, seed=0):
+    """
+    Benchmark every stage of the RFID protocol stack.
+    :return: Dictionary with the results, ready to be written as JSON.
+    """
+    frames, payloads, bad = make_frames(count, stuffed_ratio, bad_checksum_ratio, seed)
+    RFID = DorsetRFID650_Interface(ser=FakeSerial())
+
+    wrapper = ProtocolWrapper(header=b'\x02', footer=b'\x03', dle=b'\x10', has_checksum_appended=True)
+    def wrapper_input(frame):
+        # As read from the port before FrameDecoder: one byte at a time
+        for i in range(len(frame)):
+            wrapper.input(frame[i:i + 1])
+
+    decoder = FrameDecoder(header=b'\x02', footer=b'\x03', dle=b'\x10', has_checksum_appended=True)
+    decoded = [decoder.feed(frame)[0][0] for frame in frames]
+
+    stages = {
+        'ProtocolWrapper.input': measure(wrapper_input, frames),
+        'FrameDecoder.feed': measure(decoder.feed, frames),
+        'parseFrame': measure(RFID.parseFrame, decoded),
+        'parseFrameBuffer': measure(RFID.parseFrameBuffer, decoded),
+        '_HexChecksum': measure(lambda frame: RFID._HexChecksum(frame[:-1]), decoded),
+        'validateMessage': measure(lambda frame: RFID.validateMessage(frame[:-1], frame[-1]), decoded),
+        '_createMessage': measure(RFID._createMessage, payloads),
+    }
+
+    # The benchmark is only meaningful if the stack still works
+    valid = sum(RFID.validateMessage(frame[:-1], frame[-1]) for frame in decoded)
+    tags_ok = all(RFID.parseFrame(frame)[3] == payload[1:] == RFID.parseFrameBuffer(frame)[3]
+                  for frame, payload in zip(decoded, payloads))
+
+    return {'machine': platform.node(),
+            'platform': platform.platform(),
+            'python': sys.version.split()[0],
+            'frames': count,
+            'stuffed_ratio': stuffed_ratio,
+            'bad_checksums': bad,
+            'valid_checksums': valid,
+            'checks_passed': valid == count - bad and tags_ok,
+            'stages': stages}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the RFID protocol stack.')
+    parser.add_argument('--frames', type=int, default=2000, help='number of synthetic frames')
+    parser.add_argument('--stuffed', type=float, default=0.3, help='fraction of DLE stuffed tags')
+    parser.add_argument('--bad', type=float, default=0.05, help='fraction of frames with a bad checksum')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic frames')
+    parser.add_argument('--output', help='also write the results to this JSON file')
+    args = parser.parse_args()
+
+    results = run_benchmark(args.frames, args.stuffed, args.bad, args.seed)
+    report = json.dumps(results, indent=2)
+    print(report)
+    if args.output:
+        with open(os.path.expanduser(args.output), 'w') as file:
+            file.write(report + '\n')
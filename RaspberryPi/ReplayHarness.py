@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Fri May  2 14:18:53 2025
+
+@author: J. Cabrera-Moreno
+Postdoctoral fellow
+Evolutionary Cognition Group
+Institute of Evolutionary Anthropology
+University of Zürich
+
+Description:
+    Replays recorded gate data through the live controller logic
+    (MainMonkeyGateControl.GateController) without a Pi, IR beams or RFID
+    reader. The IR beams are gpiozero mock pins and the RFID reader gets a
+    FakeSerial port, so the events go through the same callbacks, frame
+    decoder, event pipeline and crossing detector as on the gate.
+
+    Sources: a gate log (raw log files or DataAnalysis/sample.csv) or a
+    capture of the bytes sent by the reader. Replays run at real time, at a
+    speed factor, or as fast as possible, and report the throughput and the
+    latency from every injected event to its detection.
+
+    The windows of the crossing detector are divided by the speed factor, so
+    accelerated replays keep their decisions as long as the scaled window
+    stays well above the scheduling jitter. At maximum speed the timing
+    between events is lost, only use it to measure throughput.
+"""
+
+from gpiozero import Device
+from gpiozero.pins.mock import MockFactory
+from threading import Condition
+from collections import deque
+from datetime import datetime, timedelta
+import os
+import csv
+import json
+import time
+import argparse
+import tempfile
+
+# Local libraries
+from IRDirectionDetector import IRDirectionDetector
+from DorsetRFID650_Interface import DorsetRFID650_Interface
+from FakeSerial import FakeSerial
+from MainMonkeyGateControl import GateController, IR_SENSOR_1, IR_SENSOR_2, script_dir, animalsID_file
+
+# GPIO pin of every IR sensor as logged
+IR_PINS = {'outerIR': IR_SENSOR_1, 'innerIR': IR_SENSOR_2}
+# Command byte of the replayed tag frames
+TAG_COMMAND = b'\x01'
+# Tag replayed for animals missing from the animals file
+UNKNOWN_TAG = 'ffffffffffffffff'
+
+
+def _parse_time(value):
+    # Raw logs: YYYYMMDDHHMMSSffff, sample.csv: ISO dates
+    value = value.strip()
+    if value.isdigit():
+        return datetime.strptime(value[:14], '%Y%m%d%H%M%S') + timedelta(microseconds=int(value[14:] or 0) * 100)
+    return datetime.fromisoformat(value)
+
+
+def load_gate_log(file_path, animals_file=os.path.join(script_dir, animalsID_file)):
+    """
+    Read the IR and RFID events of a gate log, either a raw log file
+    (date,object,state,monkey) or a table like DataAnalysis/sample.csv
+    (object,animal,datetime).
+    :param file_path: Path of the log.
+    :param animals_file: CSV with the name and tag of every animal, used when
+                         the log only holds the animal names.
+    :return: List of (seconds since the first event, object, tag) in time order.
+    """
+    tags = {}
+    with open(animals_file) as file:
+        for row in csv.reader(file):
+            if len(row) >= 2:
+                tags[row[0].strip()] = row[1].strip().lower()
+
+    with open(file_path) as file:
+        lines = file.read().splitlines()
+    # Raw logs can start with a line that is not part of the table
+    if lines and ':' in lines[0] and ',' not in lines[0]:
+        lines = lines[1:]
+
+    events = []
+    for row in csv.DictReader(lines):
+        obj = row.get('object')
+        if obj not in IR_PINS and obj != 'rfid':
+            continue
+        try:
+            moment = _parse_time(row['datetime'] if 'datetime' in row else row['date'])
+        except (TypeError, ValueError):
+            continue
+        tag = None
+        if obj == 'rfid':
+            tag = row['state'] if 'state' in row else tags.get(row.get('animal'), UNKNOWN_TAG)
+        events.append((moment, obj, tag))
+
+    events.sort(key=lambda event: event[0])
+    if not events:
+        return []
+    first = events[0][0]
+    return [((moment - first).total_seconds(), obj, tag) for moment, obj, tag in events]
+
+
+class ReplayHarness:
+    def __init__(self, directory=os.path.join(tempfile.gettempdir(), 'MonkeyGateReplay'), speed=1.0,
+                 animals_file=os.path.join(script_dir, animalsID_file), window=2.0, verbose=False):
+        """
+        :param directory: Folder for the log files written by the controller.
+        :param speed: Replay speed factor, 1 for real time, None for as fast as possible.
+        :param animals_file: CSV with the name and tag of every animal.
+        :param window: Seconds of the windows of the crossing detector at real time.
+        :param verbose: Let the controller print every event.
+        """
+        self.speed = speed
+        # The IR beams are mock pins driven by the replay
+        Device.pin_factory = MockFactory()
+        self.pins = {sensor: Device.pin_factory.pin(pin) for sensor, pin in IR_PINS.items()}
+        self.serial = FakeSerial()
+        self.detector = IRDirectionDetector(IR_SENSOR_1, IR_SENSOR_2)
+        self.RFID = DorsetRFID650_Interface(ser=self.serial)
+        self.controller = GateController(self.detector, self.RFID, directory, animals_file,
+                                         window=window / speed if speed else window, verbose=verbose)
+
+        # Injection time of the events not handled yet, per source, and the results
+        self._injected = {'ir': deque(), 'rfid': deque()}
+        self._condition = Condition()
+        self.handled = 0
+        self.latencies_ns = []
+        self.crossings = []
+        # Time every event from its injection until the detector handled it
+        handler = self.controller.event_pipeline.handler
+        def timed_handler(events):
+            try:
+                handler(events)
+            finally:
+                handled = time.monotonic_ns()
+                with self._condition:
+                    self.handled += 1
+                    injected = self._injected[events[-1].source]
+                    # Frames of a serial capture were not injected one by one
+                    if injected:
+                        self.latencies_ns.append(handled - injected.popleft())
+                    self._condition.notify_all()
+        self.controller.event_pipeline.handler = timed_handler
+        log_crossings = self.controller.log_crossings
+        def recorded_log_crossings(crossings):
+            self.crossings.extend(crossings)
+            log_crossings(crossings)
+        self.controller.log_crossings = recorded_log_crossings
+
+    def tag_frame(self, tag):
+        """
+        Frame sent by the reader when it reads a tag (hex string).
+        """
+        return self.RFID._createMessage(TAG_COMMAND + bytes.fromhex(tag))
+
+    def _wait_until(self, started, offset):
+        if self.speed:
+            delay = started + offset / self.speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+    def _inject(self, source):
+        with self._condition:
+            self._injected[source].append(time.monotonic_ns())
+
+    def replay_log(self, events):
+        """
+        Drive the IR pins and the serial port with the events of load_gate_log.
+        Every IR break is followed by the release of the beam.
+        """
+        started = time.monotonic()
+        for offset, obj, tag in events:
+            self._wait_until(started, offset)
+            if obj == 'rfid':
+                frame = self.tag_frame(tag)
+                self._inject('rfid')
+                self.serial.feed(frame)
+            else:
+                self._inject('ir')
+                self.pins[obj].drive_low()
+                self.pins[obj].drive_high()
+
+    def replay_serial(self, data, baudrate=57600, chunk=64):
+        """
+        Feed a capture of the bytes sent by the reader, paced at the baudrate.
+        Latencies are not measured, the frames in the capture are not known
+        in advance.
+        """
+        started = time.monotonic()
+        for i in range(0, len(data), chunk):
+            # 10 bits per byte on the wire
+            self._wait_until(started, i * 10 / baudrate)
+            self.serial.feed(data[i:i + chunk])
+
+    def run(self, events=None, capture=None, timeout=10.0):
+        """
+        Replay a gate log and/or a serial capture through the controller.
+        :param events: Events from load_gate_log.
+        :param capture: Bytes captured from the reader.
+        :param timeout: Seconds to wait for the last events to be handled.
+        :return: Dictionary with the throughput, latencies and crossings.
+        """
+        self.controller.start()
+        started = time.monotonic()
+        if events:
+            self.replay_log(events)
+        if capture:
+            self.replay_serial(capture)
+        replayed = time.monotonic() - started
+
+        with self._condition:
+            self._condition.wait_for(lambda: not any(self._injected.values()), timeout)
+        handled = time.monotonic() - started
+        self.controller.stop()
+        self.serial.close()
+
+        latencies = sorted(self.latencies_ns)
+        def percentile(q):
+            return latencies[min(len(latencies) - 1, int(q * len(latencies)))] / 1e6 if latencies else None
+        return {'events': self.handled,
+                'replay_seconds': replayed,
+                'handled_seconds': handled,
+                'events_per_second': self.handled / handled if handled > 0 else None,
+                'latency_ms': {'p50': percentile(0.5), 'p95': percentile(0.95), 'p99': percentile(0.99),
+                               'max': percentile(1.0)},
+                'log_file': self.controller.log_file_path,
+                'crossings': [[crossing.animal, crossing.movement, crossing.confidence]
+                              for crossing in self.crossings]}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Replay recorded gate data through the controller logic.')
+    parser.add_argument('--log', help='gate log to replay (raw log file or sample.csv)')
+    parser.add_argument('--capture', help='file with the bytes captured from the RFID reader')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='speed factor, 1 is real time and 0 as fast as possible')
+    parser.add_argument('--output', help='write the report, with every crossing, to this JSON file')
+    args = parser.parse_args()
+
+    harness = ReplayHarness(speed=args.speed or None)
+    events = load_gate_log(args.log) if args.log else None
+    capture = None
+    if args.capture:
+        with open(args.capture, 'rb') as file:
+            capture = file.read()
+
+    report = harness.run(events, capture)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    summary = {key: value for key, value in report.items() if key != 'crossings'}
+    summary['crossings'] = len(report['crossings'])
+    print(json.dumps(summary, indent=2))